@@ -36,16 +36,159 @@ class HIPT_4K(torch.nn.Module):
 	def __init__(self, 
 		model256_path: str = '../Checkpoints/vit256_small_dino.pth',
 		model4k_path: str = '../Checkpoints/vit4k_xs_dino.pth', 
-		device256=torch.device('cuda:0'), 
-		device4k=torch.device('cuda:1')):
+		device256=None, 
+		device4k=None,
+		tile_batch_size: int = 256,
+		skip_background: bool = False,
+		tissue_threshold: float = 0.01,
+		saturation_threshold: int = 8,
+		mean: tuple = (0.5, 0.5, 0.5),
+		std: tuple = (0.5, 0.5, 0.5)):
 
 		super().__init__()
+		# both stages on the GPU when there is one, on the CPU otherwise
+		default_device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+		device256 = default_device if device256 is None else device256
+		device4k = default_device if device4k is None else device4k
 		self.model256 = get_vit256(pretrained_weights=model256_path).to(device256)
 		self.model4k = get_vit4k(pretrained_weights=model4k_path).to(device4k)
 		self.device256 = device256
 		self.device4k = device4k
-	
-	def forward(self, x):
+		self.tile_batch_size = tile_batch_size
+		# tissue-aware skipping of background [256 x 256] tiles, see encode_tiles
+		self.skip_background = skip_background
+		self.tissue_threshold = tissue_threshold
+		self.saturation_threshold = saturation_threshold
+		# normalization the input tiles come with (eval_transforms by default), undone to find background
+		self.mean = tuple(float(m) for m in mean)
+		self.std = tuple(float(s) for s in std)
+		# a buffer rather than a lazy cache, so nn.DataParallel replicas get it too
+		self.register_buffer('blank_cls256', self.encode_blank_tile(), persistent=False)
+
+	def forward(self, x, tissue=None, return_skip_counts=False):
+		"""
+		Batched forward pass of HIPT, outputting the [CLS] token from ViT-4K for every region.
+		1. Every region is center-cropped to a multiple of 256 and unfolded into [256 x 256] tiles.
+		2. ViT-256 runs over the tiles of all regions together, in chunks of tile_batch_size
+		   (with skip_background, only over the tiles holding tissue, see encode_tiles).
+		3. The [CLS]_256 tokens stay on the compute device and are reshaped into one feature grid per region.
+		4. ViT-4K runs on all grids at once; grids of different sizes (edge regions) are zero-padded to the largest one
+		   and the padding is masked out of the attention (VisionTransformer4K.forward_padded).
+		The output of each region matches forward_single on it, up to floating point error.
+		
+		Args:
+			- x (torch.Tensor or list): [B x C x W' x H'] image tensor, or a list of [1 x C x W_i' x H_i'] tensors of different sizes.
+			- tissue (list, optional): [w_256 x h_256] tissue fraction of the tiles of every region (e.g. from the segmentation mask),
+			  used by skip_background instead of the saturation test.
+			- return_skip_counts (bool): also return the tile counts of skip_background.
+		
+		Return:
+			- features_cls4k (torch.Tensor): [B x 192] cls tokens (d_4k = 192 by default).
+			- skip_counts (torch.Tensor): [1 x 2] tiles seen and tiles skipped, if return_skip_counts. Returned rather than kept
+			  on the module, so nn.DataParallel gathers the counts of every replica ([n_replicas x 2]).
+		"""
+		if isinstance(x, torch.Tensor):
+			batch_256, w_256, h_256 = self.prepare_img_tensor(x)                            # 1. regions of one size are cropped together
+			batch_256 = batch_256.unfold(2, 256, 256).unfold(3, 256, 256)
+			batch_256 = rearrange(batch_256, 'b c p1 p2 w h -> (b p1 p2) c w h')
+			sizes = [(w_256, h_256)] * x.shape[0]
+		else:
+			batch_256, sizes = [], []
+			for region in x:
+				region, w_256, h_256 = self.prepare_img_tensor(region if region.dim() == 4 else region.unsqueeze(dim=0))
+				region = region.unfold(2, 256, 256).unfold(3, 256, 256)
+				batch_256.append(rearrange(region, 'b c p1 p2 w h -> (b p1 p2) c w h'))
+				sizes.append((w_256, h_256))
+			batch_256 = torch.cat(batch_256, dim=0)                                    # 1. [sum(w_i*h_i) x 3 x 256 x 256]
+
+		if tissue is not None:
+			tissue = torch.cat([torch.as_tensor(t, dtype=torch.float32).flatten() for t in tissue])  # unfold order, as the tiles
+		features_cls256, n_skipped = self.encode_tiles(batch_256, tissue)                   # 2. [sum(w_i*h_i) x 384]
+		features_cls4k = self.forward_grids(features_cls256.to(self.device4k, non_blocking=True), sizes)
+		if return_skip_counts:
+			return features_cls4k, torch.tensor([[batch_256.shape[0], n_skipped]], device=features_cls4k.device)
+		return features_cls4k
+
+	def encode_tiles(self, batch_256, tissue=None):
+		"""
+		ViT-256 [CLS] tokens of [256 x 256] tiles, in chunks of tile_batch_size. With skip_background, tiles whose tissue
+		fraction is below tissue_threshold are not encoded and get the embedding of a blank (white) tile instead.
+		
+		Args:
+			- batch_256 (torch.Tensor): [N x 3 x 256 x 256] tiles.
+			- tissue (torch.Tensor, optional): [N] tissue fraction of every tile, from the saturation test if None.
+		
+		Return:
+			- features_cls256 (torch.Tensor): [N x 384] tokens, on device256.
+			- n_skipped (int): number of tiles not encoded.
+		"""
+		keep = torch.arange(batch_256.shape[0])
+		if self.skip_background:
+			tissue = self.tile_tissue_fraction(batch_256) if tissue is None else tissue
+			keep = torch.nonzero(tissue.cpu() >= self.tissue_threshold).flatten()
+		n_skipped = batch_256.shape[0] - len(keep)
+
+		features_cls256 = []
+		for mini_bs in range(0, len(keep), self.tile_batch_size):
+			minibatch_256 = batch_256[keep[mini_bs:mini_bs+self.tile_batch_size]].to(self.device256, non_blocking=True)
+			features_cls256.append(self.model256(minibatch_256))
+		if n_skipped == 0:
+			return torch.cat(features_cls256, dim=0), 0
+
+		dtype = features_cls256[0].dtype if len(features_cls256) > 0 else self.blank_cls256.dtype
+		features_all = self.blank_cls256.to(dtype).expand(batch_256.shape[0], -1).clone()
+		if len(features_cls256) > 0:
+			features_all[keep.to(features_all.device)] = torch.cat(features_cls256, dim=0)
+		return features_all, n_skipped
+
+	def tile_tissue_fraction(self, batch_256):
+		"""
+		Fraction of tissue pixels of every tile by the saturation test of the slide segmentation (HSV saturation above
+		saturation_threshold out of 255, as sthresh in create_patches_fp.py), on 4x downsampled tiles.
+		Tiles are expected normalized with the mean and std given to the model.
+		"""
+		mean = torch.tensor(self.mean, device=batch_256.device).view(1, 3, 1, 1)
+		std = torch.tensor(self.std, device=batch_256.device).view(1, 3, 1, 1)
+		rgb = torch.nn.functional.avg_pool2d(batch_256.float() * std + mean, 4)
+		max_c, min_c = rgb.max(dim=1)[0], rgb.min(dim=1)[0]
+		saturation = (max_c - min_c) / max_c.clamp(min=1e-6)
+		return (saturation > self.saturation_threshold / 255).float().mean(dim=(1, 2))
+
+	def encode_blank_tile(self):
+		"""
+		ViT-256 [CLS] token of a white tile, normalized as the input tiles
+		"""
+		mean = torch.tensor(self.mean, device=self.device256).view(1, 3, 1, 1)
+		std = torch.tensor(self.std, device=self.device256).view(1, 3, 1, 1)
+		blank = (torch.ones(1, 3, 256, 256, device=self.device256) - mean) / std
+		with torch.no_grad():
+			return self.model256(blank)
+
+	def forward_grids(self, features_cls256, sizes):
+		"""
+		ViT-4K over the [CLS]_256 tokens of several regions.
+		
+		Args:
+			- features_cls256 (torch.Tensor): [sum(w_i*h_i) x 384] tokens, region after region, each in unfold order.
+			- sizes (list): (w_256, h_256) grid size of every region.
+		
+		Return:
+			- features_cls4k (torch.Tensor): [B x 192] cls tokens.
+		"""
+		dim = features_cls256.shape[1]
+		if len(set(sizes)) == 1:                                                        # 3. [B x 384 x w_256 x h_256]
+			w_256, h_256 = sizes[0]
+			features_grid256 = features_cls256.reshape(len(sizes), w_256, h_256, dim).permute(0, 3, 1, 2)
+			return self.model4k.forward(features_grid256)                               # 4. [B x 192]
+		max_w, max_h = max(w for w, h in sizes), max(h for w, h in sizes)
+		features_grid256 = features_cls256.new_zeros(len(sizes), dim, max_w, max_h)
+		start = 0
+		for i, (w_256, h_256) in enumerate(sizes):
+			features_grid256[i, :, :w_256, :h_256] = features_cls256[start:start+w_256*h_256].reshape(w_256, h_256, dim).permute(2, 0, 1)
+			start += w_256 * h_256
+		return self.model4k.forward_padded(features_grid256, sizes)                     # 4. [B x 192]
+
+	def forward_single(self, x):
 		"""
 		Forward pass of HIPT (given an image tensor x), outputting the [CLS] token from ViT-4K.
 		1. x is center-cropped such that the W / H is divisible by the patch token size in ViT-4K (e.g. - 256 x 256).
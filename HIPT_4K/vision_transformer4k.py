@@ -122,12 +122,15 @@ class Attention(nn.Module):
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]
 
         attn = (q @ k.transpose(-2, -1)) * self.scale
+        if mask is not None:
+            # [B x N] bool, padding tokens are never attended to
+            attn = attn.masked_fill(~mask[:, None, None, :], float('-inf'))
         attn = attn.softmax(dim=-1)
         attn = self.attn_drop(attn)
 
@@ -149,8 +152,8 @@ class Block(nn.Module):
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-    def forward(self, x, return_attention=False):
-        y, attn = self.attn(self.norm1(x))
+    def forward(self, x, return_attention=False, mask=None):
+        y, attn = self.attn(self.norm1(x), mask=mask)
         if return_attention:
             return attn
         x = x + self.drop_path(y)
@@ -245,6 +248,39 @@ class VisionTransformer4K(nn.Module):
         x = self.norm(x)
         return x[:, 0]
 
+    def prepare_padded_tokens(self, x, sizes):
+        """
+        Tokens of a batch of feature grids zero-padded to a common [W x H]: region i fills the top left sizes[i] = (w_i, h_i)
+        of its grid and gets the positional encoding interpolated for (w_i, h_i), as prepare_tokens would.
+        Returns the tokens and a [B x 1+W*H] mask of the real ones ([CLS] and the w_i x h_i grid tokens).
+        """
+        B, embed_dim, W, H = x.shape
+        x = x.flatten(2, 3).transpose(1,2)
+        x = self.phi(x)
+        cls_tokens = self.cls_token.expand(B, -1, -1)
+        x = torch.cat((cls_tokens, x), dim=1)
+
+        pos = torch.zeros_like(x)
+        mask = torch.zeros(B, 1 + W * H, dtype=torch.bool, device=x.device)
+        for i, (w, h) in enumerate(sizes):
+            valid = torch.zeros(W, H, dtype=torch.bool, device=x.device)
+            valid[:w, :h] = True
+            mask[i] = torch.cat((valid.new_ones(1), valid.flatten()))
+            # row-major over the w_i x h_i grid, the order prepare_tokens flattens it in
+            pos[i, mask[i]] = self.interpolate_pos_encoding(x[i:i+1, :1 + w * h], w, h)[0].to(x.dtype)
+        x = x + pos
+        return self.pos_drop(x), mask
+
+    def forward_padded(self, x, sizes):
+        """
+        forward of a batch of grids of different sizes, zero-padded to a common size (see prepare_padded_tokens)
+        """
+        x, mask = self.prepare_padded_tokens(x, sizes)
+        for blk in self.blocks:
+            x = blk(x, mask=mask)
+        x = self.norm(x)
+        return x[:, 0]
+
     def get_last_selfattention(self, x):
         x = self.prepare_tokens(x)
         for i, blk in enumerate(self.blocks):
@@ -0,0 +1,21 @@
+## scan slide directories once and store their metadata (dimensions, levels, resolution) in a csv catalog,
+## so patching and heatmap runs can plan without opening every slide (--slide_catalog)
+import time
+import argparse
+
+from wsi_core.slide_catalog import build_catalog
+
+parser = argparse.ArgumentParser(description='Build or update a slide metadata catalog')
+parser.add_argument('--slide_dirs', type=str, nargs='+', required=True,
+                    help='directories containing the slides')
+parser.add_argument('--catalog_path', type=str, required=True,
+                    help='csv to write, rows of an existing catalog are reused for unchanged slides')
+parser.add_argument('--slide_ext', type=str, nargs='+', default=None,
+                    help='only catalog files with these extensions (e.g. .svs .tif)')
+parser.add_argument('--num_workers', type=int, default=8)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    start = time.time()
+    df = build_catalog(args.slide_dirs, args.catalog_path, slide_ext=args.slide_ext, num_workers=args.num_workers)
+    print('catalogued {} slides in {:.1f} s: {}'.format(len(df), time.time() - start, args.catalog_path))
@@ -19,6 +19,10 @@ import yaml
 from wsi_core.batch_process_utils import initialize_df
 from vis_utils.heatmap_utils import initialize_wsi, drawHeatmap, compute_from_patches
 from wsi_core.wsi_utils import sample_rois
+from wsi_core.seg_cache import Segmentation_Cache
+from wsi_core.slide_catalog import Slide_Catalog
+from wsi_core.slide_staging import Slide_Stager
+from wsi_core.slide_reader import format_read_stats
 from utils.file_utils import save_hdf5
 from HIPT_4K.hipt_4k import HIPT_4K
 
@@ -193,6 +197,32 @@ if __name__ == '__main__':
 
         os.makedirs(exp_args.production_save_dir, exist_ok=True)
         os.makedirs(exp_args.raw_save_dir, exist_ok=True)
+        # optional, reuses segmentations from earlier runs (and create_patches_fp.py --seg_cache_dir) with the same parameters
+        seg_cache_dir = getattr(data_args, 'seg_cache_dir', None)
+        seg_cache = Segmentation_Cache(seg_cache_dir, int(getattr(data_args, 'seg_cache_size_gb', 1.0) * 2**30)) if seg_cache_dir else None
+
+        # optional, slide metadata written by build_catalog.py: slides are only opened once pixels are read
+        slide_catalog = getattr(data_args, 'slide_catalog', None)
+        catalog = Slide_Catalog(slide_catalog) if slide_catalog else None
+
+        def get_slide_path(i):
+                slide_name = str(process_stack.loc[i, 'slide_id'])
+                if data_args.slide_ext not in slide_name:
+                        slide_name+=data_args.slide_ext
+                if isinstance(data_args.data_dir, str):
+                        return os.path.join(data_args.data_dir, slide_name)
+                elif isinstance(data_args.data_dir, dict):
+                        data_dir_key = process_stack.loc[i, data_args.data_dir_key]
+                        return os.path.join(data_args.data_dir[data_dir_key], slide_name)
+                else:
+                        raise NotImplementedError
+
+        # optional, copies the next slides from slow storage to local scratch while the current one is processed
+        stage_dir = getattr(data_args, 'stage_dir', None)
+        stager = Slide_Stager(stage_dir, int(getattr(data_args, 'stage_gb', 50) * 2**30), prefetch=getattr(data_args, 'prefetch', 2)) if stage_dir else None
+        if stager is not None:
+                stager.schedule([get_slide_path(i) for i in range(len(process_stack))])
+
         blocky_wsi_kwargs = {'top_left': None, 'bot_right': None, 'patch_size': patch_size, 'step_size': patch_size, 
         'custom_downsample':patch_args.custom_downsample, 'level': patch_args.patch_level, 'use_center_shift': heatmap_args.use_center_shift}
 
@@ -232,13 +262,10 @@ if __name__ == '__main__':
                 print('slide id: ', slide_id)
                 print('top left: ', top_left, ' bot right: ', bot_right)
 
-                if isinstance(data_args.data_dir, str):
-                        slide_path = os.path.join(data_args.data_dir, slide_name)
-                elif isinstance(data_args.data_dir, dict):
-                        data_dir_key = process_stack.loc[i, data_args.data_dir_key]
-                        slide_path = os.path.join(data_args.data_dir[data_dir_key], slide_name)
-                else:
-                        raise NotImplementedError
+                slide_path = get_slide_path(i)
+                src_path = slide_path
+                if stager is not None:
+                        slide_path = stager.local_path(slide_path)
 
                 mask_file = os.path.join(r_slide_save_dir, slide_id+'_mask.pkl')
                 
@@ -273,7 +300,8 @@ if __name__ == '__main__':
                         print('{}: {}'.format(key, val))
                 
                 print('Initializing WSI object')
-                wsi_object = initialize_wsi(slide_path, seg_mask_path=mask_file, seg_params=seg_params, filter_params=filter_params)
+                wsi_object = initialize_wsi(slide_path, seg_mask_path=mask_file, seg_params=seg_params, filter_params=filter_params, seg_cache=seg_cache,
+                                            catalog=catalog, catalog_key=src_path)
                 print('Done!')
 
                 wsi_ref_downsample = wsi_object.level_downsamples[patch_args.patch_level]
@@ -443,6 +471,11 @@ if __name__ == '__main__':
                                 else:
                                         heatmap.save(os.path.join(p_slide_save_dir, heatmap_save_name))
 
+                print('slide reads: ' + format_read_stats(wsi_object.wsi.stats()))
+
+        if stager is not None:
+                stager.close()
+
         with open(os.path.join(exp_args.raw_save_dir, exp_args.save_exp_code, 'config.yaml'), 'w') as outfile:
                 yaml.dump(config_dict, outfile, default_flow_style=False)
 
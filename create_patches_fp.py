@@ -1,7 +1,13 @@
 # internal imports
 from wsi_core.WholeSlideImage import WholeSlideImage
-from wsi_core.wsi_utils import StitchCoords
+from wsi_core.wsi_utils import StitchCoords, PREFILTER_MODES
 from wsi_core.batch_process_utils import initialize_df
+from wsi_core.patching_pool import Patching_Pool
+from wsi_core.seg_cache import Segmentation_Cache
+from wsi_core.slide_staging import Slide_Stager
+from wsi_core.pyramid import preflight_pyramids, find_pyramid
+from wsi_core.slide_catalog import Slide_Catalog
+from wsi_core.multi_scale import magnification_name, base_magnification, magnification_patch_params
 # other imports
 import os
 import numpy as np
@@ -9,6 +15,9 @@ import time
 import argparse
 import pdb
 import pandas as pd
+import multiprocessing as mp
+import traceback
+import h5py
 
 def stitching(file_path, wsi_object, downscale = 64):
         start = time.time()
@@ -17,12 +26,15 @@ def stitching(file_path, wsi_object, downscale = 64):
         
         return heatmap, total_time
 
-def segment(WSI_object, seg_params = None, filter_params = None, mask_file = None):
+def segment(WSI_object, seg_params = None, filter_params = None, mask_file = None, seg_cache = None, slide_path = None, **cache_extra):
         ### Start Seg Timer
         start_time = time.time()
         # Use segmentation file
         if mask_file is not None:
                 WSI_object.initSegmentation(mask_file)
+        # Reuse an earlier segmentation of the same slide with the same parameters
+        elif seg_cache is not None:
+                seg_cache.segment(WSI_object, slide_path, seg_params, filter_params, **cache_extra)
         # Segment       
         else:
                 WSI_object.segmentTissue(**seg_params, filter_params=filter_params)
@@ -44,6 +56,198 @@ def patching(WSI_object, **kwargs):
         return file_path, patch_time_elapsed
 
 
+def process_slide(slide, row, source, patch_save_dir, mask_save_dir, stitch_save_dir,
+                                  seg_params, filter_params, vis_params, patch_params,
+                                  patch_size = 256, step_size = 256, patch_level = 0,
+                                  use_default_params = False, legacy_support = False,
+                                  seg = False, save_mask = True, stitch = False, patch = False,
+                                  auto_skip = True, pad_slide = False, pool = None, compression = None, seg_cache = None,
+                                  stager = None, pyramid_dir = None, catalog = None, magnifications = None, base_mag = None,
+                                  prefilter = 'none'):
+        """
+        Segment, patch and stitch a single slide.
+        row holds the slide's entry of the process list, the fields to update in it are returned as a dict
+        magnifications: patch the one segmentation at each of these magnifications (patch_size pixels at every one),
+                into patch_save_dir/<magnification>/. base_mag is used for slides that do not record their objective power
+        """
+        updates = {}
+        def set_field(key, val):
+                row[key] = val
+                updates[key] = val
+
+        slide_id, _ = os.path.splitext(slide)
+        # with several magnifications the highest one stands for the slide when stitching
+        main_patch_dir = multi_scale_patch_dir(patch_save_dir, magnifications)
+
+        if auto_skip and patches_exist(patch_save_dir, slide_id, magnifications):
+                print('{} already exist in destination location, skipped'.format(slide_id))
+                set_field('status', 'already_exist')
+                return updates
+
+        # Inialize WSI
+        full_path = os.path.join(source, slide)
+        src_path = full_path
+        if stager is not None:
+                full_path = stager.local_path(full_path)
+        # small levels of single-level slides come from their sidecar pyramid
+        pyramid_path = find_pyramid(full_path, pyramid_dir)
+        # catalogued slides are only opened once pixels are read (not at all for cached segmentations without stitching)
+        if pad_slide:
+            WSI_object = WholeSlideImage(full_path,patch_size,pyramid_path=pyramid_path,catalog=catalog,catalog_key=src_path)
+        else:
+            WSI_object = WholeSlideImage(full_path,pyramid_path=pyramid_path,catalog=catalog,catalog_key=src_path)
+
+        if use_default_params:
+                current_vis_params = vis_params.copy()
+                current_filter_params = filter_params.copy()
+                current_seg_params = seg_params.copy()
+                current_patch_params = patch_params.copy()
+                
+        else:
+                current_vis_params = {}
+                current_filter_params = {}
+                current_seg_params = {}
+                current_patch_params = {}
+
+
+                for key in vis_params.keys():
+                        if legacy_support and key == 'vis_level':
+                                set_field(key, -1)
+                        current_vis_params.update({key: row[key]})
+
+                for key in filter_params.keys():
+                        if legacy_support and key == 'a_t':
+                                old_area = row['a']
+                                seg_level = row['seg_level']
+                                scale = WSI_object.level_downsamples[seg_level]
+                                adjusted_area = int(old_area * (scale[0] * scale[1]) / (512 * 512))
+                                current_filter_params.update({key: adjusted_area})
+                                set_field(key, adjusted_area)
+                        current_filter_params.update({key: row[key]})
+
+                for key in seg_params.keys():
+                        if legacy_support and key == 'seg_level':
+                                set_field(key, -1)
+                        current_seg_params.update({key: row[key]})
+
+                for key in patch_params.keys():
+                        current_patch_params.update({key: row[key]})
+
+        if current_vis_params['vis_level'] < 0:
+                if len(WSI_object.level_dim) == 1:
+                        current_vis_params['vis_level'] = 0
+                
+                else:   
+                        wsi = WSI_object.getOpenSlide()
+                        best_level = wsi.get_best_level_for_downsample(64)
+                        current_vis_params['vis_level'] = best_level
+
+        if current_seg_params['seg_level'] < 0:
+                if len(WSI_object.level_dim) == 1:
+                        current_seg_params['seg_level'] = 0
+                
+                else:
+                        wsi = WSI_object.getOpenSlide()
+                        best_level = wsi.get_best_level_for_downsample(64)
+                        current_seg_params['seg_level'] = best_level
+
+        keep_ids = str(current_seg_params['keep_ids'])
+        if keep_ids != 'none' and len(keep_ids) > 0:
+                str_ids = current_seg_params['keep_ids']
+                current_seg_params['keep_ids'] = np.array(str_ids.split(',')).astype(int)
+        else:
+                current_seg_params['keep_ids'] = []
+
+        exclude_ids = str(current_seg_params['exclude_ids'])
+        if exclude_ids != 'none' and len(exclude_ids) > 0:
+                str_ids = current_seg_params['exclude_ids']
+                current_seg_params['exclude_ids'] = np.array(str_ids.split(',')).astype(int)
+        else:
+                current_seg_params['exclude_ids'] = []
+
+        set_field('vis_level', current_vis_params['vis_level'])
+        set_field('seg_level', current_seg_params['seg_level'])
+
+
+        seg_time_elapsed = -1
+        if seg:
+                WSI_object, seg_time_elapsed = segment(WSI_object, current_seg_params, current_filter_params, seg_cache=seg_cache,
+                                                       slide_path=full_path)
+
+        w, h = WSI_object.level_dim[current_vis_params['vis_level']]
+        if save_mask and w * h > 1e8:
+                # large levels are segmented in tiles, but the mask preview still needs the whole vis_level
+                print('vis_level dim {} x {} is too large for the mask preview, skipping it'.format(w, h))
+        elif save_mask:
+                mask = WSI_object.visWSI(**current_vis_params)
+                mask_path = os.path.join(mask_save_dir, slide_id+'.jpg')
+                mask.save(mask_path)
+
+        patch_time_elapsed = -1 # Default time
+        if patch and magnifications:
+            # aligned grids: every magnification starts from the same contour origins, with steps of its own patch footprint
+            start_time = time.time()
+            slide_mag = base_magnification(WSI_object.getOpenSlide(), base_mag)
+            # lowest first, so an interrupted slide never looks complete through its main (highest) magnification
+            for mag in sorted(magnifications):
+                mag_level, mag_patch_size, _ = magnification_patch_params(WSI_object.getOpenSlide(), slide_mag, mag, patch_size)
+                mag_save_dir = os.path.join(patch_save_dir, magnification_name(mag))
+                os.makedirs(mag_save_dir, exist_ok=True)
+                current_patch_params.update({'patch_level': mag_level, 'patch_size': mag_patch_size, 'step_size': mag_patch_size,
+                                              'save_path': mag_save_dir, 'pool': pool, 'compression': compression, 'prefilter': prefilter})
+                WSI_object.process_contours(**current_patch_params)
+                file_path = os.path.join(mag_save_dir, slide_id+'.h5')
+                if os.path.isfile(file_path):
+                    with h5py.File(file_path, 'a') as f:
+                        f['coords'].attrs['magnification'] = mag
+                        f['coords'].attrs['base_magnification'] = slide_mag
+            patch_time_elapsed = time.time() - start_time
+        elif patch:
+            current_patch_params.update({'patch_level': patch_level, 'patch_size': patch_size, 'step_size': step_size,'save_path': patch_save_dir, 'pool': pool,
+                                          'compression': compression, 'prefilter': prefilter})
+            file_path, patch_time_elapsed = patching(WSI_object = WSI_object,  **current_patch_params,)
+        
+        stitch_time_elapsed = -1
+        if stitch:
+                file_path = os.path.join(main_patch_dir, slide_id+'.h5')
+                if os.path.isfile(file_path):
+                        heatmap, stitch_time_elapsed = stitching(file_path, WSI_object, downscale=64)
+                        stitch_path = os.path.join(stitch_save_dir, slide_id+'.jpg')
+                        heatmap.save(stitch_path)
+
+        print("segmentation took {} seconds".format(seg_time_elapsed))
+        print("patching took {} seconds".format(patch_time_elapsed))
+        print("stitching took {} seconds".format(stitch_time_elapsed))
+        set_field('status', 'processed')
+        set_field('seg_time', seg_time_elapsed)
+        set_field('patch_time', patch_time_elapsed)
+        set_field('stitch_time', stitch_time_elapsed)
+
+        return updates
+
+def multi_scale_patch_dir(patch_save_dir, magnifications=None):
+        if not magnifications:
+                return patch_save_dir
+        return os.path.join(patch_save_dir, magnification_name(max(magnifications)))
+
+def patches_exist(patch_save_dir, slide_id, magnifications=None):
+        """
+        True if the patch .h5 of slide_id exists, at every magnification when patching several
+        """
+        patch_dirs = [os.path.join(patch_save_dir, magnification_name(mag)) for mag in magnifications] if magnifications else [patch_save_dir]
+        return all(os.path.isfile(os.path.join(patch_dir, slide_id + '.h5')) for patch_dir in patch_dirs)
+
+def _process_slide_task(task):
+        # entry point for slide workers, a failing slide is recorded instead of stopping the whole run
+        idx, slide, kwargs = task
+        print('processing {}'.format(slide))
+        try:
+                updates = process_slide(slide, **kwargs)
+        except Exception:
+                traceback.print_exc()
+                updates = {'status': 'failed'}
+        return idx, updates
+
 def seg_and_patch(source, save_dir, patch_save_dir, mask_save_dir, stitch_save_dir, 
                                   patch_size = 256, step_size = 256, 
                                   seg_params = {'seg_level': -1, 'sthresh': 8, 'mthresh': 7, 'close': 4, 'use_otsu': False,
@@ -55,7 +259,11 @@ def seg_and_patch(source, save_dir, patch_save_dir, mask_save_dir, stitch_save_d
                                   use_default_params = False, 
                                   seg = False, save_mask = True, 
                                   stitch= False, 
-                                  patch = False, auto_skip=True, process_list = None):
+                                  patch = False, auto_skip=True, process_list = None, num_workers = 4,
+                                  num_slide_workers = 1, pad_slide = False, compression = None, seg_cache_dir = None,
+                                  seg_cache_size = 2**30, stage_dir = None, stage_size = 50*2**30, prefetch = 2,
+                                  pyramid_dir = None, slide_catalog = None, magnifications = None, base_mag = None,
+                                  prefilter = 'none'):
         
 
 
@@ -82,147 +290,90 @@ def seg_and_patch(source, save_dir, patch_save_dir, mask_save_dir, stitch_save_d
                 'line_thickness': np.full((len(df)), int(vis_params['line_thickness']), dtype=np.uint32),
                 'contour_fn': np.full((len(df)), patch_params['contour_fn'])})
 
+        for key in ['seg_time', 'patch_time', 'stitch_time']:
+                if key not in df.columns:
+                        df[key] = np.nan
+
         seg_times = 0.
         patch_times = 0.
         stitch_times = 0.
 
-        for i in range(total):
-                df.to_csv(os.path.join(save_dir, 'process_list_autogen.csv'), index=False)
-                idx = process_stack.index[i]
-                slide = process_stack.loc[idx, 'slide_id']
-                print("\n\nprogress: {:.2f}, {}/{}".format(i/total, i, total))
-                print('processing {}'.format(slide))
-                
-                df.loc[idx, 'process'] = 0
-                slide_id, _ = os.path.splitext(slide)
-
-                if auto_skip and os.path.isfile(os.path.join(patch_save_dir, slide_id + '.h5')):
-                        print('{} already exist in destination location, skipped'.format(slide_id))
-                        df.loc[idx, 'status'] = 'already_exist'
-                        continue
-
-                # Inialize WSI
-                full_path = os.path.join(source, slide)
-                if args.pad_slide:
-                    WSI_object = WholeSlideImage(full_path,args.patch_size)
-                else:
-                    WSI_object = WholeSlideImage(full_path)
-
-                if use_default_params:
-                        current_vis_params = vis_params.copy()
-                        current_filter_params = filter_params.copy()
-                        current_seg_params = seg_params.copy()
-                        current_patch_params = patch_params.copy()
-                        
-                else:
-                        current_vis_params = {}
-                        current_filter_params = {}
-                        current_seg_params = {}
-                        current_patch_params = {}
-
-
-                        for key in vis_params.keys():
-                                if legacy_support and key == 'vis_level':
-                                        df.loc[idx, key] = -1
-                                current_vis_params.update({key: df.loc[idx, key]})
-
-                        for key in filter_params.keys():
-                                if legacy_support and key == 'a_t':
-                                        old_area = df.loc[idx, 'a']
-                                        seg_level = df.loc[idx, 'seg_level']
-                                        scale = WSI_object.level_downsamples[seg_level]
-                                        adjusted_area = int(old_area * (scale[0] * scale[1]) / (512 * 512))
-                                        current_filter_params.update({key: adjusted_area})
-                                        df.loc[idx, key] = adjusted_area
-                                current_filter_params.update({key: df.loc[idx, key]})
-
-                        for key in seg_params.keys():
-                                if legacy_support and key == 'seg_level':
-                                        df.loc[idx, key] = -1
-                                current_seg_params.update({key: df.loc[idx, key]})
-
-                        for key in patch_params.keys():
-                                current_patch_params.update({key: df.loc[idx, key]})
-
-                if current_vis_params['vis_level'] < 0:
-                        if len(WSI_object.level_dim) == 1:
-                                current_vis_params['vis_level'] = 0
-                        
-                        else:   
-                                wsi = WSI_object.getOpenSlide()
-                                best_level = wsi.get_best_level_for_downsample(64)
-                                current_vis_params['vis_level'] = best_level
-
-                if current_seg_params['seg_level'] < 0:
-                        if len(WSI_object.level_dim) == 1:
-                                current_seg_params['seg_level'] = 0
-                        
-                        else:
-                                wsi = WSI_object.getOpenSlide()
-                                best_level = wsi.get_best_level_for_downsample(64)
-                                current_seg_params['seg_level'] = best_level
-
-                keep_ids = str(current_seg_params['keep_ids'])
-                if keep_ids != 'none' and len(keep_ids) > 0:
-                        str_ids = current_seg_params['keep_ids']
-                        current_seg_params['keep_ids'] = np.array(str_ids.split(',')).astype(int)
-                else:
-                        current_seg_params['keep_ids'] = []
-
-                exclude_ids = str(current_seg_params['exclude_ids'])
-                if exclude_ids != 'none' and len(exclude_ids) > 0:
-                        str_ids = current_seg_params['exclude_ids']
-                        current_seg_params['exclude_ids'] = np.array(str_ids.split(',')).astype(int)
-                else:
-                        current_seg_params['exclude_ids'] = []
-
-                w, h = WSI_object.level_dim[current_seg_params['seg_level']] 
-                if w * h > 1e8:
-                    print('level_dim {} x {} is likely too large for successful segmentation, aborting'.format(w, h))
-                    df.loc[idx, 'status'] = 'failed_seg'
-                    continue
-
-                df.loc[idx, 'vis_level'] = current_vis_params['vis_level']
-                df.loc[idx, 'seg_level'] = current_seg_params['seg_level']
+        autogen_path = os.path.join(save_dir, 'process_list_autogen.csv')
+        df.to_csv(autogen_path, index=False)
+
+        slide_kwargs = {'source': source, 'patch_save_dir': patch_save_dir, 'mask_save_dir': mask_save_dir, 'stitch_save_dir': stitch_save_dir,
+                        'seg_params': seg_params, 'filter_params': filter_params, 'vis_params': vis_params, 'patch_params': patch_params,
+                        'patch_size': patch_size, 'step_size': step_size, 'patch_level': patch_level,
+                        'use_default_params': use_default_params, 'legacy_support': legacy_support,
+                        'seg': seg, 'save_mask': save_mask, 'stitch': stitch, 'patch': patch,
+                        'auto_skip': auto_skip, 'pad_slide': pad_slide, 'compression': compression,
+                        'seg_cache': Segmentation_Cache(seg_cache_dir, seg_cache_size) if seg_cache_dir is not None else None,
+                        'pyramid_dir': pyramid_dir,
+                        'catalog': Slide_Catalog(slide_catalog) if slide_catalog is not None else None,
+                        'magnifications': magnifications, 'base_mag': base_mag, 'prefilter': prefilter}
+
+        if pyramid_dir is not None and (seg or stitch or save_mask):
+                # pre-flight: slides without usable downsampled levels get a sidecar pyramid before anything reads them
+                preflight_pyramids([os.path.join(source, slide) for slide in process_stack['slide_id']], pyramid_dir,
+                                   num_workers=max(num_workers, num_slide_workers, 1))
+
+        order = list(process_stack.index)
+        if num_slide_workers > 1:
+                # largest slides first so the run does not end with one huge slide running alone
+                def slide_size(idx):
+                        slide_path = os.path.join(source, df.loc[idx, 'slide_id'])
+                        return os.path.getsize(slide_path) if os.path.isfile(slide_path) else 0
+                order = sorted(order, key=slide_size, reverse=True)
+                # slide workers are daemonic and cannot own a patching pool, they patch in-process
+                pool = None
+                stager = None
+                if stage_dir is not None:
+                        print('slide staging is only used with num_slide_workers = 1, reading slides in place')
+        else:
+                # one pool of patching workers for the whole run instead of one per contour
+                pool = Patching_Pool(num_workers) if patch else None
+                stager = Slide_Stager(stage_dir, stage_size, prefetch=prefetch) if stage_dir is not None else None
+
+        tasks = [(idx, df.loc[idx, 'slide_id'], dict(slide_kwargs, row=df.loc[idx].to_dict(), pool=pool, stager=stager)) for idx in order]
+        if stager is not None:
+                # slides that will be skipped are not worth copying
+                stager.schedule([os.path.join(source, slide) for _, slide, _ in tasks
+                                 if not (auto_skip and patches_exist(patch_save_dir, os.path.splitext(slide)[0], magnifications))])
+
+        if num_slide_workers > 1:
+                slide_pool = mp.Pool(num_slide_workers)
+                results = slide_pool.imap_unordered(_process_slide_task, tasks)
+        else:
+                results = map(_process_slide_task, tasks)
 
+        for i, (idx, updates) in enumerate(results):
+                # status and timings are written as soon as each slide finishes so an interrupted run can be resumed
+                for key, val in updates.items():
+                        df.loc[idx, key] = val
+                df.loc[idx, 'process'] = 0
+                df.to_csv(autogen_path, index=False)
+                print("\n\nprogress: {:.2f}, {}/{}, finished {} ({})".format((i+1)/total, i+1, total, df.loc[idx, 'slide_id'], updates['status']))
 
-                seg_time_elapsed = -1
-                if seg:
-                        WSI_object, seg_time_elapsed = segment(WSI_object, current_seg_params, current_filter_params) 
+                if updates['status'] == 'processed':
+                        seg_times += updates['seg_time']
+                        patch_times += updates['patch_time']
+                        stitch_times += updates['stitch_time']
 
-                if save_mask:
-                        mask = WSI_object.visWSI(**current_vis_params)
-                        mask_path = os.path.join(mask_save_dir, slide_id+'.jpg')
-                        mask.save(mask_path)
+        if num_slide_workers > 1:
+                slide_pool.close()
+                slide_pool.join()
 
-                patch_time_elapsed = -1 # Default time
-                if patch:
-                    current_patch_params.update({'patch_level': patch_level, 'patch_size': patch_size, 'step_size': step_size,'save_path': patch_save_dir})
-                    file_path, patch_time_elapsed = patching(WSI_object = WSI_object,  **current_patch_params,)
-                
-                stitch_time_elapsed = -1
-                if stitch:
-                        file_path = os.path.join(patch_save_dir, slide_id+'.h5')
-                        if os.path.isfile(file_path):
-                                heatmap, stitch_time_elapsed = stitching(file_path, WSI_object, downscale=64)
-                                stitch_path = os.path.join(stitch_save_dir, slide_id+'.jpg')
-                                heatmap.save(stitch_path)
-
-                print("segmentation took {} seconds".format(seg_time_elapsed))
-                print("patching took {} seconds".format(patch_time_elapsed))
-                print("stitching took {} seconds".format(stitch_time_elapsed))
-                df.loc[idx, 'status'] = 'processed'
-
-                seg_times += seg_time_elapsed
-                patch_times += patch_time_elapsed
-                stitch_times += stitch_time_elapsed
+        if pool is not None:
+                pool.close()
+        if stager is not None:
+                stager.close()
 
         print("total time: {}".format(seg_times+patch_times+stitch_times))
-        seg_times /= total
-        patch_times /= total
-        stitch_times /= total
+        seg_times /= max(total, 1)
+        patch_times /= max(total, 1)
+        stitch_times /= max(total, 1)
 
-        df.to_csv(os.path.join(save_dir, 'process_list_autogen.csv'), index=False)
+        df.to_csv(autogen_path, index=False)
         print("average segmentation time in s per slide: {}".format(seg_times))
         print("average patching time in s per slide: {}".format(patch_times))
         print("average stiching time in s per slide: {}".format(stitch_times))
@@ -261,8 +412,36 @@ parser.add_argument('--preset', default=None, type=str,
                                         help='predefined profile of default segmentation and filter parameters (.csv)')
 parser.add_argument('--patch_level', type=int, default=0, 
                                         help='downsample level at which to patch')
+parser.add_argument('--magnifications', type=float, nargs='+', default=None,
+                                        help='patch every slide at these magnifications from one segmentation (patch_size pixels at each, patch_level is ignored), into patches/<magnification>/')
+parser.add_argument('--base_magnification', type=float, default=None,
+                                        help='scanning magnification of slides that do not record their objective power')
 parser.add_argument('--process_list',  type = str, default=None,
                                         help='name of list of images to process with parameters (.csv)')
+parser.add_argument('--num_workers', type=int, default=4,
+                                        help='number of patching worker processes, 0 to patch in the main process')
+parser.add_argument('--num_slide_workers', type=int, default=1,
+                                        help='number of slides processed in parallel worker processes')
+parser.add_argument('--resume', default=False, action='store_true',
+                                        help='continue from process_list_autogen.csv in save_dir, skipping slides already finished')
+parser.add_argument('--h5_compression', type=str, choices=['none', 'lzf', 'gzip'], default='none',
+                                        help='compression of the coords .h5 files')
+parser.add_argument('--prefilter', type=str, choices=PREFILTER_MODES, default='none',
+                                        help='additional background filter from thumbnail statistics, drops coords written without it (coords-only patching has no white/black check): safe uses conservative bounds of the white/black check (near-black patches only at the default thresholds), fast compares thumbnail means to the thresholds')
+parser.add_argument('--seg_cache_dir', type=str, default=None,
+                                        help='directory caching segmentation results across runs, keyed by slide and segmentation parameters')
+parser.add_argument('--seg_cache_size_gb', type=float, default=1.0,
+                                        help='size budget of the segmentation cache, least recently used entries are evicted beyond it')
+parser.add_argument('--stage_dir', type=str, default=None,
+                                        help='local scratch directory slides are copied to ahead of processing (for slides on network mounts)')
+parser.add_argument('--stage_gb', type=float, default=50,
+                                        help='disk budget of the staging directory')
+parser.add_argument('--prefetch', type=int, default=2,
+                                        help='number of upcoming slides copied to the staging directory in the background')
+parser.add_argument('--pyramid_dir', type=str, default=None,
+                                        help='directory for sidecar pyramids, built up front for slides without usable downsampled levels')
+parser.add_argument('--slide_catalog', type=str, default=None,
+                                        help='slide metadata catalog written by build_catalog.py, catalogued slides are opened lazily')
 parser.add_argument('--pad_slide', default=False, action='store_true', help='pad slides a minimum of 4096x4096 for use in the ATEC23 test data')
 
 
@@ -279,6 +458,11 @@ if __name__ == '__main__':
         else:
                 process_list = None
 
+        autogen_path = os.path.join(args.save_dir, 'process_list_autogen.csv')
+        if args.resume and os.path.isfile(autogen_path):
+                print('resuming from {}'.format(autogen_path))
+                process_list = autogen_path
+
         print('source: ', args.source)
         print('patch_save_dir: ', patch_save_dir)
         print('mask_save_dir: ', mask_save_dir)
@@ -327,4 +511,11 @@ if __name__ == '__main__':
                                                                                         seg = args.seg,  use_default_params=False, save_mask = True, 
                                                                                         stitch= args.stitch,
                                                                                         patch_level=args.patch_level, patch = args.patch,
-                                                                                        process_list = process_list, auto_skip=args.no_auto_skip)
+                                                                                        process_list = process_list, auto_skip=args.no_auto_skip,
+                                                                                        num_workers=args.num_workers, num_slide_workers=args.num_slide_workers,
+                                                                                        pad_slide=args.pad_slide, compression=args.h5_compression,
+                                                                                        seg_cache_dir=args.seg_cache_dir, seg_cache_size=int(args.seg_cache_size_gb * 2**30),
+                                                                                        stage_dir=args.stage_dir, stage_size=int(args.stage_gb * 2**30), prefetch=args.prefetch,
+                                                                                        pyramid_dir=args.pyramid_dir, slide_catalog=args.slide_catalog,
+                                                                                        magnifications=args.magnifications, base_mag=args.base_magnification,
+                                                                                        prefilter=args.prefilter)
@@ -2,6 +2,9 @@
 from wsi_core.WholeSlideImageGraph import WholeSlideImage
 from wsi_core.wsi_utils import StitchCoords
 from wsi_core.batch_process_utils import initialize_df
+from wsi_core.patching_pool import Patching_Pool
+from wsi_core.seg_cache import Segmentation_Cache
+from wsi_core.slide_catalog import Slide_Catalog
 # other imports
 import os
 import numpy as np
@@ -17,12 +20,15 @@ def stitching(file_path, wsi_object, downscale = 64):
         
         return heatmap, total_time
 
-def segment(WSI_object, seg_params = None, filter_params = None, mask_file = None):
+def segment(WSI_object, seg_params = None, filter_params = None, mask_file = None, seg_cache = None, slide_path = None, **cache_extra):
         ### Start Seg Timer
         start_time = time.time()
         # Use segmentation file
         if mask_file is not None:
                 WSI_object.initSegmentation(mask_file)
+        # Reuse an earlier segmentation of the same slide with the same parameters
+        elif seg_cache is not None:
+                seg_cache.segment(WSI_object, slide_path, seg_params, filter_params, **cache_extra)
         # Segment       
         else:
                 WSI_object.segmentTissue(**seg_params, filter_params=filter_params)
@@ -55,7 +61,8 @@ def seg_and_patch(source, save_dir, patch_save_dir, mask_save_dir, stitch_save_d
                                   use_default_params = False, 
                                   seg = False, save_mask = True, 
                                   stitch= False, 
-                                  patch = False, auto_skip=True, process_list = None):
+                                  patch = False, auto_skip=True, process_list = None, num_workers = 4, compression = None,
+                                  seg_cache_dir = None, seg_cache_size = 2**30, slide_catalog = None):
         
 
 
@@ -86,6 +93,12 @@ def seg_and_patch(source, save_dir, patch_save_dir, mask_save_dir, stitch_save_d
         patch_times = 0.
         stitch_times = 0.
 
+        # one pool of patching workers for the whole run instead of one per contour
+        pool = Patching_Pool(num_workers) if patch else None
+        seg_cache = Segmentation_Cache(seg_cache_dir, seg_cache_size) if seg_cache_dir is not None else None
+        # catalogued slides are only opened once pixels are read
+        catalog = Slide_Catalog(slide_catalog) if slide_catalog is not None else None
+
         for i in range(total):
                 df.to_csv(os.path.join(save_dir, 'process_list_autogen.csv'), index=False)
                 idx = process_stack.index[i]
@@ -104,9 +117,9 @@ def seg_and_patch(source, save_dir, patch_save_dir, mask_save_dir, stitch_save_d
                 # Inialize WSI
                 full_path = os.path.join(source, slide)
                 if args.pad_slide:
-                    WSI_object = WholeSlideImage(full_path,args.patch_size)
+                    WSI_object = WholeSlideImage(full_path,args.patch_size,catalog=catalog)
                 else:
-                    WSI_object = WholeSlideImage(full_path)
+                    WSI_object = WholeSlideImage(full_path,catalog=catalog)
 
                 if use_default_params:
                         current_vis_params = vis_params.copy()
@@ -176,28 +189,28 @@ def seg_and_patch(source, save_dir, patch_save_dir, mask_save_dir, stitch_save_d
                 else:
                         current_seg_params['exclude_ids'] = []
 
-                w, h = WSI_object.level_dim[current_seg_params['seg_level']] 
-                if w * h > 1e8:
-                    print('level_dim {} x {} is likely too large for successful segmentation, aborting'.format(w, h))
-                    df.loc[idx, 'status'] = 'failed_seg'
-                    continue
-
                 df.loc[idx, 'vis_level'] = current_vis_params['vis_level']
                 df.loc[idx, 'seg_level'] = current_seg_params['seg_level']
 
 
                 seg_time_elapsed = -1
                 if seg:
-                        WSI_object, seg_time_elapsed = segment(WSI_object, current_seg_params, current_filter_params) 
-
-                if save_mask:
+                        WSI_object, seg_time_elapsed = segment(WSI_object, current_seg_params, current_filter_params, seg_cache=seg_cache,
+                                                       slide_path=full_path)
+
+                w, h = WSI_object.level_dim[current_vis_params['vis_level']]
+                if save_mask and w * h > 1e8:
+                        # large levels are segmented in tiles, but the mask preview still needs the whole vis_level
+                        print('vis_level dim {} x {} is too large for the mask preview, skipping it'.format(w, h))
+                elif save_mask:
                         mask = WSI_object.visWSI(**current_vis_params)
                         mask_path = os.path.join(mask_save_dir, slide_id+'.jpg')
                         mask.save(mask_path)
 
                 patch_time_elapsed = -1 # Default time
                 if patch:
-                    current_patch_params.update({'patch_level': patch_level, 'patch_size': patch_size, 'step_size': step_size,'save_path': patch_save_dir})
+                    current_patch_params.update({'patch_level': patch_level, 'patch_size': patch_size, 'step_size': step_size,'save_path': patch_save_dir, 'pool': pool,
+                                          'compression': compression})
                     file_path_big, file_path_small, patch_time_elapsed = patching(WSI_object = WSI_object,  **current_patch_params,)
                 
                 stitch_time_elapsed = -1
@@ -222,6 +235,9 @@ def seg_and_patch(source, save_dir, patch_save_dir, mask_save_dir, stitch_save_d
                 patch_times += patch_time_elapsed
                 stitch_times += stitch_time_elapsed
 
+        if pool is not None:
+                pool.close()
+
         seg_times /= total
         patch_times /= total
         stitch_times /= total
@@ -267,6 +283,16 @@ parser.add_argument('--patch_level', type=int, default=0,
                                         help='downsample level at which to patch')
 parser.add_argument('--process_list',  type = str, default=None,
                                         help='name of list of images to process with parameters (.csv)')
+parser.add_argument('--num_workers', type=int, default=4,
+                                        help='number of patching worker processes, 0 to patch in the main process')
+parser.add_argument('--h5_compression', type=str, choices=['none', 'lzf', 'gzip'], default='none',
+                                        help='compression of the coords .h5 files')
+parser.add_argument('--seg_cache_dir', type=str, default=None,
+                                        help='directory caching segmentation results across runs, keyed by slide and segmentation parameters')
+parser.add_argument('--seg_cache_size_gb', type=float, default=1.0,
+                                        help='size budget of the segmentation cache, least recently used entries are evicted beyond it')
+parser.add_argument('--slide_catalog', type=str, default=None,
+                                        help='slide metadata catalog written by build_catalog.py, catalogued slides are opened lazily')
 parser.add_argument('--pad_slide', default=False, action='store_true', help='pad slides a minimum of 4096x4096 for use in the ATEC23 test data')
 
 
@@ -339,4 +365,7 @@ if __name__ == '__main__':
                                                                                         seg = args.seg,  use_default_params=False, save_mask = True, 
                                                                                         stitch= args.stitch,
                                                                                         patch_level=args.patch_level, patch = args.patch,
-                                                                                        process_list = process_list, auto_skip=args.no_auto_skip)
+                                                                                        process_list = process_list, auto_skip=args.no_auto_skip,
+                                                                                        num_workers=args.num_workers, compression=args.h5_compression,
+                                                                                        seg_cache_dir=args.seg_cache_dir, seg_cache_size=int(args.seg_cache_size_gb * 2**30),
+                                                                                        slide_catalog=args.slide_catalog)
@@ -24,6 +24,9 @@ import openslide
 import timm
 from datasets.dataset_h5 import Whole_Slide_Bag_FP
 from utils.utils import collate_features
+from wsi_core.slide_reader import Slide_Reader
+from wsi_core.padded_slide import Padded_Slide, read_padding
+from collections import OrderedDict
 
 ## added for graph networks
 from torch_geometric.data import Batch, Data
@@ -50,6 +53,57 @@ def save_splits(split_datasets, column_keys, filename, boolean_style=False):
         df.to_csv(filename)
         print()
 
+def build_slide_index(slide_dirs, slide_ext):
+        """
+        Map slide_id -> slide path over any number of root directories, earlier roots take precedence
+        """
+        slide_index = {}
+        for slide_dir in slide_dirs:
+                if slide_dir is None or not os.path.isdir(slide_dir):
+                        continue
+                for file_name in os.listdir(slide_dir):
+                        if file_name.endswith(slide_ext):
+                                slide_index.setdefault(file_name[:-len(slide_ext)], os.path.join(slide_dir, file_name))
+        return slide_index
+
+## open slides and patch coordinates are kept per process, i.e. per DataLoader worker
+_slide_handles = OrderedDict()
+_coords_cache = {}
+
+def slide_worker_init_fn(worker_id=None):
+        # forked workers must not share the parent's OpenSlide handles
+        _slide_handles.clear()
+        _coords_cache.clear()
+
+def get_slide_handle(file_path, max_open=16, h5_file_path=None, cache_bytes=64*2**20):
+        """
+        Slide_Reader of a slide, at most max_open kept open per process. cache_bytes is the decoded tile
+        budget of all open slides together, split evenly between them
+        """
+        if file_path in _slide_handles:
+                _slide_handles.move_to_end(file_path)
+                return _slide_handles[file_path]
+        slide = openslide.open_slide(file_path)
+        # coords of slides padded during patching refer to the padded canvas
+        padding = read_padding(h5_file_path) if h5_file_path is not None else None
+        if padding is not None:
+                slide = Padded_Slide(slide, **padding)
+        wsi = Slide_Reader(slide, cache_bytes=cache_bytes // max_open)
+        _slide_handles[file_path] = wsi
+        while len(_slide_handles) > max_open:
+                _, evicted = _slide_handles.popitem(last=False)
+                evicted.close()
+        return wsi
+
+def get_patch_coords(h5_file_path):
+        """
+        (coords, patch_level, patch_size) of a patch .h5 file, read once per process
+        """
+        if h5_file_path not in _coords_cache:
+                with h5py.File(h5_file_path, 'r') as f:
+                        _coords_cache[h5_file_path] = (f['coords'][:], f['coords'].attrs['patch_level'], f['coords'].attrs['patch_size'])
+        return _coords_cache[h5_file_path]
+
 class Generic_WSI_Classification_Dataset(Dataset):
         def __init__(self,
                 csv_path = 'dataset_csv/ccrcc_clean.csv',
@@ -235,7 +289,7 @@ class Generic_WSI_Classification_Dataset(Dataset):
                 if len(split) > 0:
                         mask = self.slide_data['slide_id'].isin(split.tolist())
                         df_slice = self.slide_data[mask].reset_index(drop=True)
-                        split = Generic_Split(df_slice, data_dir=self.data_dir, small_data_dir=self.small_data_dir, coords_path=self.coords_path, small_coords_path=self.small_coords_path, num_classes=self.num_classes,perturb_variance=self.perturb_variance,number_of_augs=self.number_of_augs,slide_ext=self.slide_ext,data_h5_dir=self.data_h5_dir, data_slide_dir=self.data_slide_dir,pretrained=self.pretrained, custom_downsample=self.custom_downsample, target_patch_size=self.target_patch_size,model_architecture = self.model_architecture, model_type=self.model_type, batch_size = self.batch_size,max_patches_per_slide=self.max_patches_per_slide,graph_edge_distance=self.graph_edge_distance,offset=self.offset,plot_graph=self.plot_graph)
+                        split = Generic_Split(df_slice, data_dir=self.data_dir, small_data_dir=self.small_data_dir, coords_path=self.coords_path, small_coords_path=self.small_coords_path, num_classes=self.num_classes,perturb_variance=self.perturb_variance,number_of_augs=self.number_of_augs,slide_ext=self.slide_ext,data_h5_dir=self.data_h5_dir, data_slide_dir=self.data_slide_dir, slide_dirs=self.slide_dirs, slide_index=self.slide_index,pretrained=self.pretrained, custom_downsample=self.custom_downsample, target_patch_size=self.target_patch_size,model_architecture = self.model_architecture, model_type=self.model_type, batch_size = self.batch_size,max_patches_per_slide=self.max_patches_per_slide,graph_edge_distance=self.graph_edge_distance,offset=self.offset,plot_graph=self.plot_graph)
                 else:
                         split = None
                 
@@ -251,7 +305,7 @@ class Generic_WSI_Classification_Dataset(Dataset):
                 if len(split) > 0:
                         mask = self.slide_data['slide_id'].isin(merged_split)
                         df_slice = self.slide_data[mask].reset_index(drop=True)
-                        split = Generic_Split(df_slice, data_dir=self.data_dir, small_data_dir=self.small_data_dir, coords_path=self.coords_path, small_coords_path=self.small_coords_path, num_classes=self.num_classes,perturb_variance=self.perturb_variance,number_of_augs=self.number_of_augs,slide_ext=self.slide_ext,data_h5_dir=self.data_h5_dir, data_slide_dir=self.data_slide_dir,pretrained=self.pretrained, custom_downsample=self.custom_downsample, target_patch_size=self.target_patch_size,model_architecture = self.model_architecture, model_type=self.model_type, batch_size = self.batch_size,max_patches_per_slide=self.max_patches_per_slide,graph_edge_distance=self.graph_edge_distance,offset=self.offset,plot_graph=self.plot_graph)
+                        split = Generic_Split(df_slice, data_dir=self.data_dir, small_data_dir=self.small_data_dir, coords_path=self.coords_path, small_coords_path=self.small_coords_path, num_classes=self.num_classes,perturb_variance=self.perturb_variance,number_of_augs=self.number_of_augs,slide_ext=self.slide_ext,data_h5_dir=self.data_h5_dir, data_slide_dir=self.data_slide_dir, slide_dirs=self.slide_dirs, slide_index=self.slide_index,pretrained=self.pretrained, custom_downsample=self.custom_downsample, target_patch_size=self.target_patch_size,model_architecture = self.model_architecture, model_type=self.model_type, batch_size = self.batch_size,max_patches_per_slide=self.max_patches_per_slide,graph_edge_distance=self.graph_edge_distance,offset=self.offset,plot_graph=self.plot_graph)
                 else:
                         split = None
                 
@@ -264,21 +318,21 @@ class Generic_WSI_Classification_Dataset(Dataset):
                 if from_id:
                         if len(self.train_ids) > 0:
                                 train_data = self.slide_data.loc[self.train_ids].reset_index(drop=True)
-                                train_split = Generic_Split(train_data, data_dir=self.data_dir, small_data_dir=self.small_data_dir, coords_path=self.coords_path, small_coords_path=self.small_coords_path, num_classes=self.num_classes,perturb_variance=self.perturb_variance,number_of_augs=self.number_of_augs,slide_ext=self.slide_ext,data_h5_dir=self.data_h5_dir, data_slide_dir=self.data_slide_dir,pretrained=self.pretrained, custom_downsample=self.custom_downsample, target_patch_size=self.target_patch_size,model_architecture = self.model_architecture, model_type=self.model_type, batch_size = self.batch_size,max_patches_per_slide=self.max_patches_per_slide,graph_edge_distance=self.graph_edge_distance,offset=self.offset,plot_graph=self.plot_graph)
+                                train_split = Generic_Split(train_data, data_dir=self.data_dir, small_data_dir=self.small_data_dir, coords_path=self.coords_path, small_coords_path=self.small_coords_path, num_classes=self.num_classes,perturb_variance=self.perturb_variance,number_of_augs=self.number_of_augs,slide_ext=self.slide_ext,data_h5_dir=self.data_h5_dir, data_slide_dir=self.data_slide_dir, slide_dirs=self.slide_dirs, slide_index=self.slide_index,pretrained=self.pretrained, custom_downsample=self.custom_downsample, target_patch_size=self.target_patch_size,model_architecture = self.model_architecture, model_type=self.model_type, batch_size = self.batch_size,max_patches_per_slide=self.max_patches_per_slide,graph_edge_distance=self.graph_edge_distance,offset=self.offset,plot_graph=self.plot_graph)
 
                         else:
                                 train_split = None
                         
                         if len(self.val_ids) > 0:
                                 val_data = self.slide_data.loc[self.val_ids].reset_index(drop=True)
-                                val_split = Generic_Split(val_data, data_dir=self.data_dir, small_data_dir=self.small_data_dir, coords_path=self.coords_path, small_coords_path=self.small_coords_path, num_classes=self.num_classes,slide_ext=self.slide_ext,data_h5_dir=self.data_h5_dir, data_slide_dir=self.data_slide_dir,pretrained=self.pretrained, custom_downsample=self.custom_downsample, target_patch_size=self.target_patch_size,model_architecture = self.model_architecture, model_type=self.model_type, batch_size = self.batch_size,max_patches_per_slide=np.inf,graph_edge_distance=self.graph_edge_distance,offset=self.offset,plot_graph=self.plot_graph)
+                                val_split = Generic_Split(val_data, data_dir=self.data_dir, small_data_dir=self.small_data_dir, coords_path=self.coords_path, small_coords_path=self.small_coords_path, num_classes=self.num_classes,slide_ext=self.slide_ext,data_h5_dir=self.data_h5_dir, data_slide_dir=self.data_slide_dir, slide_dirs=self.slide_dirs, slide_index=self.slide_index,pretrained=self.pretrained, custom_downsample=self.custom_downsample, target_patch_size=self.target_patch_size,model_architecture = self.model_architecture, model_type=self.model_type, batch_size = self.batch_size,max_patches_per_slide=np.inf,graph_edge_distance=self.graph_edge_distance,offset=self.offset,plot_graph=self.plot_graph)
 
                         else:
                                 val_split = None
                         
                         if len(self.test_ids) > 0:
                                 test_data = self.slide_data.loc[self.test_ids].reset_index(drop=True)
-                                test_split = Generic_Split(test_data, data_dir=self.data_dir, small_data_dir=self.small_data_dir, coords_path=self.coords_path, small_coords_path=self.small_coords_path, num_classes=self.num_classes,slide_ext=self.slide_ext,data_h5_dir=self.data_h5_dir, data_slide_dir=self.data_slide_dir,pretrained=self.pretrained, custom_downsample=self.custom_downsample, target_patch_size=self.target_patch_size,model_architecture = self.model_architecture, model_type=self.model_type, batch_size = self.batch_size,max_patches_per_slide=np.inf,graph_edge_distance=self.graph_edge_distance,offset=self.offset,plot_graph=self.plot_graph)
+                                test_split = Generic_Split(test_data, data_dir=self.data_dir, small_data_dir=self.small_data_dir, coords_path=self.coords_path, small_coords_path=self.small_coords_path, num_classes=self.num_classes,slide_ext=self.slide_ext,data_h5_dir=self.data_h5_dir, data_slide_dir=self.data_slide_dir, slide_dirs=self.slide_dirs, slide_index=self.slide_index,pretrained=self.pretrained, custom_downsample=self.custom_downsample, target_patch_size=self.target_patch_size,model_architecture = self.model_architecture, model_type=self.model_type, batch_size = self.batch_size,max_patches_per_slide=np.inf,graph_edge_distance=self.graph_edge_distance,offset=self.offset,plot_graph=self.plot_graph)
                         
                         else:
                                 test_split = None
@@ -394,7 +448,12 @@ class Generic_MIL_Dataset(Generic_WSI_Classification_Dataset):
                 graph_edge_distance=None,
                 offset=None,
                 plot_graph=None,
+                slide_dirs=None,
                 **kwargs):
+                """
+                        slide_dirs (list): roots searched for slides in extract_features mode, by default
+                                data_slide_dir and its ../idrive and ../Set30to37 siblings
+                """
         
                 super(Generic_MIL_Dataset, self).__init__(**kwargs)
                 self.data_dir = data_dir
@@ -424,6 +483,14 @@ class Generic_MIL_Dataset(Generic_WSI_Classification_Dataset):
                 self.graph_edge_distance = graph_edge_distance
                 self.offset = offset
                 self.plot_graph = plot_graph
+                if slide_dirs is None and data_slide_dir is not None:
+                        slide_dirs = [data_slide_dir, os.path.join(data_slide_dir, "../idrive"), os.path.join(data_slide_dir, "../Set30to37")]
+                self.slide_dirs = slide_dirs
+                self.slide_index = build_slide_index(slide_dirs, slide_ext) if slide_dirs is not None and slide_ext is not None else {}
+
+        @staticmethod
+        def worker_init_fn(worker_id):
+                slide_worker_init_fn(worker_id)
 
         def load_from_h5(self, toggle):
                 self.use_h5 = toggle
@@ -480,21 +547,15 @@ class Generic_MIL_Dataset(Generic_WSI_Classification_Dataset):
 
                 if self.extract_features:
                     h5_file_path = os.path.join(self.data_h5_dir, 'patches', str(slide_id)+".h5")
-                    ## this is a hacky fix because I have data stored in three different folders
-                    try:
-                        file_path = os.path.join(self.data_slide_dir, str(slide_id)+self.slide_ext)
-                        wsi = openslide.open_slide(file_path)
-                    except:
-                        try:
-                            file_path = os.path.join(self.data_slide_dir,"../idrive", str(slide_id)+self.slide_ext)
-                            wsi = openslide.open_slide(file_path)
-                        except:
-                            file_path = os.path.join(self.data_slide_dir,"../Set30to37", str(slide_id)+self.slide_ext)
-                            wsi = openslide.open_slide(file_path)
+                    ## slides are spread over several folders, located once through the slide index
+                    if str(slide_id) not in self.slide_index:
+                        raise FileNotFoundError("slide {} not found in {}".format(slide_id, self.slide_dirs))
+                    wsi = get_slide_handle(self.slide_index[str(slide_id)], h5_file_path=h5_file_path)
 
-                    dataset = Whole_Slide_Bag_FP(file_path=h5_file_path, wsi=wsi, custom_transforms=self.transforms, pretrained=self.pretrained,custom_downsample=self.custom_downsample, target_patch_size=self.target_patch_size, max_patches_per_slide = self.max_patches_per_slide,model_architecture = self.model_architecture, batch_size = self.batch_size, extract_features = self.extract_features)
+                    dataset = Whole_Slide_Bag_FP(file_path=h5_file_path, wsi=wsi, custom_transforms=self.transforms, pretrained=self.pretrained,custom_downsample=self.custom_downsample, target_patch_size=self.target_patch_size, max_patches_per_slide = self.max_patches_per_slide,model_architecture = self.model_architecture, batch_size = self.batch_size, extract_features = self.extract_features,
+                                                 coords_info = get_patch_coords(h5_file_path), memory_budget = 0)
                     dataset.update_sample(np.random.choice(len(dataset),self.max_patches_per_slide))
-                    patches = [data for data in dataset]
+                    patches = torch.cat([dataset[i][0] for i in range(len(dataset))], dim=0)
                     label = torch.tensor(label)
                     return patches, label
 
@@ -719,7 +780,7 @@ class Generic_MIL_Dataset(Generic_WSI_Classification_Dataset):
 
 
 class Generic_Split(Generic_MIL_Dataset):
-        def __init__(self, slide_data, data_dir=None, small_data_dir=None, coords_path=None, small_coords_path=None, num_classes=2, perturb_variance=0.1, number_of_augs = 1, max_patches_per_slide=None,data_h5_dir=None,data_slide_dir=None,slide_ext=None, pretrained=None, custom_downsample=None, target_patch_size=None, model_architecture=None, model_type = None, batch_size = None, extract_features = False, graph_edge_distance = None, offset = None, plot_graph = None):
+        def __init__(self, slide_data, data_dir=None, small_data_dir=None, coords_path=None, small_coords_path=None, num_classes=2, perturb_variance=0.1, number_of_augs = 1, max_patches_per_slide=None,data_h5_dir=None,data_slide_dir=None,slide_ext=None, pretrained=None, custom_downsample=None, target_patch_size=None, model_architecture=None, model_type = None, batch_size = None, extract_features = False, graph_edge_distance = None, offset = None, plot_graph = None, slide_dirs = None, slide_index = None):
                 self.augment_features = False
                 self.debug_loader = False
                 self.use_h5 = False
@@ -748,6 +809,8 @@ class Generic_Split(Generic_MIL_Dataset):
                 self.graph_edge_distance = graph_edge_distance
                 self.offset = offset
                 self.plot_graph = plot_graph
+                self.slide_dirs = slide_dirs
+                self.slide_index = slide_index if slide_index is not None else {}
                 for i in range(self.num_classes):
                         self.slide_cls_ids[i] = np.where(self.slide_data['label'] == i)[0]
 
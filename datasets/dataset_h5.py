@@ -15,8 +15,14 @@ import torch.nn.functional as F
 from PIL import Image
 import h5py
 
+from wsi_core.slide_reader import Slide_Reader, patch_reader, plan_read_level, objective_power
+from wsi_core.padded_slide import Padded_Slide, read_padding
+from wsi_core.multi_scale import plan_scale_regions, read_region_tiled, Region_Pyramid
+
 import random
 from random import randrange
+from collections import OrderedDict
+import openslide
 
 def eval_transforms(pretrained=False):
         if pretrained:
@@ -105,7 +111,11 @@ class Whole_Slide_Bag_FP(Dataset):
                 max_patches_per_slide=None,
                 model_architecture=None,
                 batch_size=None,
-                extract_features=False
+                extract_features=False,
+                read_group_size=8,
+                coords_info=None,
+                memory_budget=512*2**20,
+                level_planning=True
                 ):
                 """
                 Args:
@@ -114,9 +124,18 @@ class Whole_Slide_Bag_FP(Dataset):
                         custom_transforms (callable, optional): Optional transform to be applied on a sample
                         custom_downsample (int): Custom defined downscale factor (overruled by target_patch_size)
                         target_patch_size (int): Custom defined image size before embedding
+                        read_group_size (int): max number of neighbouring patches fetched with one read_region, 1 reads patch by patch
+                        coords_info (tuple): (coords, patch_level, patch_size) already read from file_path, skips opening the .h5
+                        memory_budget (int): bytes allowed for reading the patches' whole bounding box at the patch level once
+                                (low magnifications), patches are then served as slices of it. 0 always reads per patch (group)
+                        level_planning (bool): with custom_downsample/target_patch_size, read from the coarsest pyramid level that
+                                still covers the output size and resize only the remainder, instead of resizing from patch_level
                 """
                 self.pretrained = pretrained
-                self.wsi = wsi
+                self.read_group_size = read_group_size
+                self.memory_budget = memory_budget
+                # overlapping patches (and neighbours sharing native tiles) are decoded once
+                self.wsi = wsi if isinstance(wsi, Slide_Reader) else Slide_Reader(wsi)
                 self.max_patches_per_slide = max_patches_per_slide
                 if not custom_transforms:
                         self.roi_transforms = eval_transforms(pretrained=pretrained)
@@ -126,44 +145,65 @@ class Whole_Slide_Bag_FP(Dataset):
                 self.file_path = file_path
                 self.extract_features = extract_features
                 #print("file path:",self.file_path)
-                with h5py.File(self.file_path, "r") as f:
-                        self.coords=f['coords'][:len(f['coords'])]
-                        if selected_idxs is None:
-                            self.selected_coords=self.coords
-                            #print(self.selected_coords)
-                            #print(self.selected_coords[0])
-                        else:
-                            self.selected_coords = self.coords[sorted(list(set(selected_idxs)))]
-                        #print("max patches per slide",self.max_patches_per_slide)
-                        #print(self.selected_coords)
-                        #print(self.selected_coords.dtype)
-                        #if self.max_patches_per_slide:
-                            #if self.max_patches_per_slide<len(self.selected_coords):
-                                #self.selected_coords = random.sample(self.selected_coords,self.max_patches_per_slide)
-                                #sample_keys = random.sample(list(self.selected_coords.keys()), self.max_patches_per_slide)
-                                #self.selected_coords = {key: self.selected_coords[key] for key in sample_keys}
-                                
-                                ## below was working but turned off
-                                #sample_idxs = random.sample(range(len(self.selected_coords)),self.max_patches_per_slide)
-                        #        sample_idxs = np.random.choice(len(self.selected_coords),self.max_patches_per_slide)
-                        #        self.selected_coords = torch.tensor(self.selected_coords[sorted(list(set(sample_idxs)))])
+                if coords_info is None:
+                        with h5py.File(self.file_path, "r") as f:
+                                coords_info = (f['coords'][:], f['coords'].attrs['patch_level'], f['coords'].attrs['patch_size'])
+                self.coords = coords_info[0]
+                if selected_idxs is None:
+                    self.selected_coords=self.coords
+                    #print(self.selected_coords)
+                    #print(self.selected_coords[0])
+                else:
+                    self.selected_coords = self.coords[sorted(list(set(selected_idxs)))]
+                #print("max patches per slide",self.max_patches_per_slide)
+                #print(self.selected_coords)
+                #print(self.selected_coords.dtype)
+                #if self.max_patches_per_slide:
+                    #if self.max_patches_per_slide<len(self.selected_coords):
+                        #self.selected_coords = random.sample(self.selected_coords,self.max_patches_per_slide)
+                        #sample_keys = random.sample(list(self.selected_coords.keys()), self.max_patches_per_slide)
+                        #self.selected_coords = {key: self.selected_coords[key] for key in sample_keys}
                         
-                        #print("len selected_coords",len(self.selected_coords))
-                        #print("selected coords:",self.selected_coords)
-                        #print(self.selected_coords)
-                        self.patch_level = f['coords'].attrs['patch_level']
-                        self.patch_size = f['coords'].attrs['patch_size']
-                        self.length = len(self.selected_coords)
-                        if target_patch_size > 0:
-                                self.target_patch_size = (target_patch_size, ) * 2
-                        elif custom_downsample > 1:
-                                self.target_patch_size = (self.patch_size // custom_downsample, ) * 2
-                        else:
-                                self.target_patch_size = None
+                        ## below was working but turned off
+                        #sample_idxs = random.sample(range(len(self.selected_coords)),self.max_patches_per_slide)
+                #        sample_idxs = np.random.choice(len(self.selected_coords),self.max_patches_per_slide)
+                #        self.selected_coords = torch.tensor(self.selected_coords[sorted(list(set(sample_idxs)))])
+                
+                #print("len selected_coords",len(self.selected_coords))
+                #print("selected coords:",self.selected_coords)
+                #print(self.selected_coords)
+                self.patch_level = coords_info[1]
+                self.patch_size = coords_info[2]
+                self.length = len(self.selected_coords)
+                if target_patch_size > 0:
+                        self.target_patch_size = (target_patch_size, ) * 2
+                elif custom_downsample > 1:
+                        self.target_patch_size = (self.patch_size // custom_downsample, ) * 2
+                else:
+                        self.target_patch_size = None
+
+                self.read_level, self.read_size = self.patch_level, (self.patch_size, self.patch_size)
+                if self.target_patch_size is not None and level_planning:
+                        self.read_level, self.read_size, out_downsample = plan_read_level(self.wsi, self.patch_level, self.read_size, self.target_patch_size)
+                else:
+                        out_downsample = self.wsi.level_downsamples[self.patch_level] * self.patch_size / (self.target_patch_size or self.read_size)[0]
+                power = objective_power(self.wsi)
+                self.magnification = power / out_downsample if power is not None else None
+                # built on first read (and again after update_sample), except that a level read into memory with
+                # memory_budget is read here, before DataLoader workers fork, so that they share it
+                self._reader = None
+                if memory_budget > 0:
+                        self.reader
         
         def __len__(self):
                 return self.length
 
+        @property
+        def reader(self):
+                if self._reader is None:
+                        self._reader = patch_reader(self.wsi, self.selected_coords, self.read_level, self.read_size, self.read_group_size, self.memory_budget)
+                return self._reader
+
         def summary(self):
                 hdf5_file = h5py.File(self.file_path, "r")
                 dset = hdf5_file['coords']
@@ -172,6 +212,7 @@ class Whole_Slide_Bag_FP(Dataset):
 
                 print('\nfeature extraction settings')
                 print('target patch size: ', self.target_patch_size)
+                print('read level: {}, read size: {}, magnification: {}'.format(self.read_level, self.read_size, self.magnification))
                 print('pretrained: ', self.pretrained)
                 print('transformations: ', self.roi_transforms)
         
@@ -179,13 +220,26 @@ class Whole_Slide_Bag_FP(Dataset):
                 #print("updating sample to length ",len(selected_idxs))
                 #with h5py.File(self.file_path, "r") as f:
                 #print("self.coords",self.coords)
-                self.selected_coords=self.coords[sorted(list(set(selected_idxs)))]
+                selected_coords=self.coords[sorted(list(set(selected_idxs)))]
                 #print("selected coords in update sample",self.selected_coords)
                 #print("selected_coords.shape in update_sample",self.selected_coords.shape)
                 #print("selected coords",self.selected_coords)
+                if np.array_equal(selected_coords, self.selected_coords):
+                        # same sample, keep the reader (and a level already read into memory)
+                        return
+                self.selected_coords = selected_coords
                 self.length = len(self.selected_coords)
+                self._reader = None
                 #print("self.length",self.length)
         
+        def read_info(self):
+                """
+                level the patches are read at and their effective magnification (-1 if the slide does not record it), as h5 attrs
+                """
+                return {'patch_level': self.patch_level, 'patch_size': self.patch_size, 'read_level': self.read_level,
+                        'read_downsample': self.wsi.level_downsamples[self.read_level],
+                        'magnification': -1 if self.magnification is None else self.magnification}
+
         def coords(self,num):
                 with h5py.File(self.file_path,'r') as hdf5_file:
                     coords = hdf5_file['coords'][:num]
@@ -197,8 +251,8 @@ class Whole_Slide_Bag_FP(Dataset):
                 #print("selected_coords before read_region",self.selected_coords)
                 
                 #print("transforms:",self.roi_transforms)
-                img = self.wsi.read_region(coord, self.patch_level, (self.patch_size, self.patch_size)).convert('RGB')
-                if self.target_patch_size is not None:
+                img = Image.fromarray(self.reader.read(idx))
+                if self.target_patch_size is not None and self.read_size != self.target_patch_size:
                         img = img.resize(self.target_patch_size)
                 transform = transforms.Compose([transforms.ToTensor()])
                 #print("before transforms",transform(img))
@@ -216,3 +270,195 @@ class Dataset_All_Bags(Dataset):
 
         def __getitem__(self, idx):
                 return self.df['slide_id'][idx]
+
+class Slide_Batches(Dataset):
+        def __init__(self,
+                slides,
+                batch_size,
+                pretrained=False,
+                custom_transforms=None,
+                custom_downsample=1,
+                target_patch_size=-1,
+                cache_bytes=256*2**20,
+                memory_budget=0,
+                level_planning=True,
+                max_open=2
+                ):
+                """
+                Batches of the patches of many slides, slide after slide, for a single DataLoader (batch_size=None) whose
+                persistent workers serve every slide: while the model works on the last batches of a slide, the workers
+                already open the next one and decode its first batches.
+                Args:
+                        slides (list): (slide file path, patch .h5 file path) of every slide, in processing order
+                        batch_size (int): patches per batch, batches do not cross slides
+                        cache_bytes (int): decoded tile cache of every slide opened in a worker
+                        memory_budget (int): as Whole_Slide_Bag_FP, per worker, so the default 0 keeps workers from each
+                                reading whole levels
+                        max_open (int): slides kept open per worker
+                Slides whose .h5 has no patches get no batches.
+                """
+                self.slides = slides
+                self.bag_kwargs = {'pretrained': pretrained, 'custom_transforms': custom_transforms,
+                                   'custom_downsample': custom_downsample, 'target_patch_size': target_patch_size,
+                                   'memory_budget': memory_budget, 'level_planning': level_planning}
+                self.cache_bytes = cache_bytes
+                self.max_open = max_open
+                self.coords_info, self.batches, self.slide_batches = [], [], []
+                for slide_idx, (_, h5_file_path) in enumerate(slides):
+                        with h5py.File(h5_file_path, 'r') as f:
+                                self.coords_info.append((f['coords'][:], f['coords'].attrs['patch_level'], f['coords'].attrs['patch_size']))
+                        n_patches = len(self.coords_info[-1][0])
+                        self.batches.extend((slide_idx, start, min(start + batch_size, n_patches)) for start in range(0, n_patches, batch_size))
+                        self.slide_batches.append(int(math.ceil(n_patches / batch_size)))
+                # opened per worker
+                self._bags = OrderedDict()
+
+        def __len__(self):
+                return len(self.batches)
+
+        def bag(self, slide_idx):
+                if slide_idx in self._bags:
+                        return self._bags[slide_idx]
+                slide_file_path, h5_file_path = self.slides[slide_idx]
+                slide = openslide.open_slide(slide_file_path)
+                # coords of slides padded during patching refer to the padded canvas
+                padding = read_padding(h5_file_path)
+                if padding is not None:
+                        slide = Padded_Slide(slide, **padding)
+                wsi = Slide_Reader(slide, cache_bytes=self.cache_bytes)
+                self._bags[slide_idx] = Whole_Slide_Bag_FP(file_path=h5_file_path, wsi=wsi, coords_info=self.coords_info[slide_idx], **self.bag_kwargs)
+                while len(self._bags) > self.max_open:
+                        _, evicted = self._bags.popitem(last=False)
+                        evicted.wsi.close()
+                return self._bags[slide_idx]
+
+        def __getitem__(self, idx):
+                """
+                batch (B, C, H, W), coords (B, 2), slide index, read_info of the slide; batch is None if the slide cannot be read
+                """
+                slide_idx, start, stop = self.batches[idx]
+                try:
+                        bag = self.bag(slide_idx)
+                        batch = torch.cat([bag[i][0] for i in range(start, stop)], dim=0)
+                except Exception as e:
+                        print('failed reading {}: {}'.format(self.slides[slide_idx][0], e))
+                        return None, self.coords_info[slide_idx][0][start:stop], slide_idx, None
+                return batch, bag.selected_coords[start:stop], slide_idx, bag.read_info()
+
+class Multi_Scale_Bag(Dataset):
+        def __init__(self,
+                file_paths,
+                wsi,
+                pretrained=False,
+                custom_transforms=None,
+                target_patch_size=-1,
+                region_pixels=4096,
+                max_patches=None
+                ):
+                """
+                Patches of one slide at several magnifications (coords .h5 files of create_patches_fp.py --magnifications), served
+                region by region: every region is read once at the resolution of the highest magnification, in tiles of region_pixels,
+                and the patches of all magnifications inside it are cut out of it, lower magnifications from copies halved in memory.
+                Patches larger than a region (low magnifications next to much higher ones) are read on their own instead, at the
+                coarsest level that still has target_patch_size pixels across them, so no read grows with the magnification range.
+                Args:
+                        file_paths (list): coords .h5 file of every magnification
+                        wsi: slide the coords belong to
+                        target_patch_size (int): output size of every patch, the patch size of the highest magnification if -1
+                        region_pixels (int): side of a region in pixels at the read resolution
+                        max_patches (int): max number of patches of a magnification in one item, regions holding more are served
+                                as several items (regions are sized to hold about max_patches patches of the highest magnification)
+                """
+                self.wsi = wsi if isinstance(wsi, Slide_Reader) else Slide_Reader(wsi)
+                if not custom_transforms:
+                        self.roi_transforms = eval_transforms(pretrained=pretrained)
+                else:
+                        self.roi_transforms = custom_transforms
+
+                self.file_paths = file_paths
+                self.coords, self.footprints, patch_sizes = [], [], []
+                for file_path in file_paths:
+                        with h5py.File(file_path, 'r') as f:
+                                self.coords.append(f['coords'][:])
+                                patch_level, patch_size = f['coords'].attrs['patch_level'], f['coords'].attrs['patch_size']
+                        patch_sizes.append(int(patch_size))
+                        # patch size in level 0 pixels
+                        self.footprints.append(int(round(patch_size * self.wsi.level_downsamples[patch_level])))
+
+                finest = int(np.argmin(self.footprints))
+                self.target_patch_size = target_patch_size if target_patch_size > 0 else patch_sizes[finest]
+                out_size = (self.target_patch_size, ) * 2
+                # coarsest level that still resolves the highest magnification at the output size
+                self.read_level, _, _ = plan_read_level(self.wsi, 0, (self.footprints[finest], ) * 2, out_size)
+                self.read_downsample = self.wsi.level_downsamples[self.read_level]
+                self.region_pixels = region_pixels
+                region_size = int(region_pixels * self.read_downsample)
+                if max_patches is not None:
+                        region_size = min(region_size, max(1, int(math.sqrt(max_patches))) * self.footprints[finest])
+                region_size = max(region_size, self.footprints[finest])
+                # (read level, read size) of the magnifications whose patches do not fit in a region, None for the others
+                self.own_reads = [plan_read_level(self.wsi, 0, (footprint, ) * 2, out_size)[:2] if footprint > region_size else None
+                                  for footprint in self.footprints]
+                self.regions = plan_scale_regions(self.coords, self.footprints, region_size)
+
+                # items: (region index, members) with at most max_patches patches of every magnification
+                self.items = []
+                for region_idx, (_, _, _, _, members) in enumerate(self.regions):
+                        n_items = 1 if max_patches is None else max(int(math.ceil(len(idxs) / max_patches)) for _, idxs in members)
+                        for item in range(n_items):
+                                if max_patches is None:
+                                        self.items.append((region_idx, members))
+                                        continue
+                                item_members = [(mag_idx, idxs[item * max_patches:(item + 1) * max_patches]) for mag_idx, idxs in members]
+                                self.items.append((region_idx, [(mag_idx, idxs) for mag_idx, idxs in item_members if len(idxs) > 0]))
+
+        def __len__(self):
+                return len(self.items)
+
+        @staticmethod
+        def collate(batch):
+                # one item per batch, its patches are batched per magnification by the caller
+                return batch[0]
+
+        def _patch_tensor(self, patch):
+                img = Image.fromarray(patch)
+                if img.size != (self.target_patch_size, self.target_patch_size):
+                        img = img.resize((self.target_patch_size, self.target_patch_size))
+                return self.roi_transforms(img).unsqueeze(0)
+
+        def __getitem__(self, idx):
+                """
+                patches (list): (n_m, C, H, W) tensor or None for every magnification, coords (list): their (n_m, 2) coords
+                """
+                _, members = self.items[idx]
+                patches = [None] * len(self.coords)
+                coords = [np.zeros((0, 2), dtype=np.int64) for _ in self.coords]
+
+                # the patches that fit in a region come out of one (tiled) read of their bounding box
+                region_members = [(mag_idx, idxs) for mag_idx, idxs in members if self.own_reads[mag_idx] is None]
+                if len(region_members) > 0:
+                        corners = np.concatenate([self.coords[mag_idx][idxs] for mag_idx, idxs in region_members])
+                        ends = np.concatenate([self.coords[mag_idx][idxs] + self.footprints[mag_idx] for mag_idx, idxs in region_members])
+                        (x0, y0), (x1, y1) = corners.min(axis=0), ends.max(axis=0)
+                        w = int(math.ceil((x1 - x0) / self.read_downsample)) + 1
+                        h = int(math.ceil((y1 - y0) / self.read_downsample)) + 1
+                        pyramid = Region_Pyramid(read_region_tiled(self.wsi, (int(x0), int(y0)), self.read_level, (w, h), tile_size=self.region_pixels),
+                                                 self.read_downsample)
+
+                for mag_idx, idxs in members:
+                        mag_patches = []
+                        if self.own_reads[mag_idx] is not None:
+                                read_level, read_size = self.own_reads[mag_idx]
+                                for x, y in self.coords[mag_idx][idxs]:
+                                        patch = np.array(self.wsi.read_region((int(x), int(y)), read_level, read_size).convert('RGB'))
+                                        mag_patches.append(self._patch_tensor(patch))
+                        else:
+                                region, downsample = pyramid.level_for(self.footprints[mag_idx] / self.target_patch_size)
+                                size = int(round(self.footprints[mag_idx] / downsample))
+                                for x, y in self.coords[mag_idx][idxs]:
+                                        ox = min(int(round((x - x0) / downsample)), region.shape[1] - size)
+                                        oy = min(int(round((y - y0) / downsample)), region.shape[0] - size)
+                                        mag_patches.append(self._patch_tensor(region[oy:oy + size, ox:ox + size]))
+                        patches[mag_idx] = torch.cat(mag_patches, dim=0)
+                        coords[mag_idx] = self.coords[mag_idx][idxs]
+                return patches, coords
@@ -7,6 +7,7 @@ import PIL.Image as Image
 import h5py
 from torch.utils.data import Dataset
 import torch
+from wsi_core.slide_reader import Grouped_Patch_Reader, plan_read_level
 from wsi_core.util_classes import Contour_Checking_fn, isInContourV1, isInContourV2, isInContourV3_Easy, isInContourV3_Hard
 
 def default_transforms(mean = (0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
@@ -45,11 +46,12 @@ class Wsi_Region(Dataset):
         t: custom torchvision transformation to apply 
         custom_downsample (int): additional downscale factor to apply 
         use_center_shift: for 'four_pt_hard' contour check, how far out to shift the 4 points
+        read_group_size (int): max number of neighbouring (overlapping) patches fetched with one read_region
     '''
     def __init__(self, wsi_object, top_left=None, bot_right=None, level=0, 
                  patch_size = (256, 256), step_size=(256, 256), 
                  contour_fn='four_pt_hard',
-                 t=None, custom_downsample=1, use_center_shift=False):
+                 t=None, custom_downsample=1, use_center_shift=False, read_group_size=8):
         
         self.custom_downsample = custom_downsample
 
@@ -101,6 +103,11 @@ class Wsi_Region(Dataset):
         coords=np.vstack(filtered_coords)
 
         self.coords = coords
+        # downscaled patches are read from the coarsest level that still covers the target size
+        self.read_level, self.read_size = self.level, self.patch_size
+        if self.custom_downsample > 1:
+            self.read_level, self.read_size, _ = plan_read_level(self.wsi, self.level, self.patch_size, self.target_patch_size)
+        self.reader = Grouped_Patch_Reader(self.wsi, self.coords, self.read_level, self.read_size, read_group_size)
         print('filtered a total of {} coordinates'.format(len(self.coords)))
         
         # apply transformation
@@ -114,8 +121,8 @@ class Wsi_Region(Dataset):
     
     def __getitem__(self, idx):
         coord = self.coords[idx]
-        patch = self.wsi.read_region(tuple(coord), self.level, self.patch_size).convert('RGB')
-        if self.custom_downsample > 1:
+        patch = Image.fromarray(self.reader.read(idx))
+        if self.custom_downsample > 1 and tuple(self.read_size) != tuple(self.target_patch_size):
             patch = patch.resize(self.target_patch_size)
         patch = self.transforms(patch).unsqueeze(0)
         return patch, coord 
@@ -6,12 +6,19 @@ import h5py
 import openslide
 import timm
 import argparse
+import numpy as np
 
-from datasets.dataset_h5 import Dataset_All_Bags, Whole_Slide_Bag_FP
+from datasets.dataset_h5 import Dataset_All_Bags, Whole_Slide_Bag_FP, Multi_Scale_Bag, Slide_Batches
+from datasets.dataset_h5 import eval_transforms as bag_eval_transforms
 from torch.utils.data import DataLoader
 from models.resnet_custom import resnet18_baseline,resnet50_baseline
+from models.precision import PRECISIONS, prepare_model, inference_context
 from utils.utils import collate_features
-from utils.file_utils import save_hdf5
+from utils.file_utils import Background_Writer, Feature_Array, save_features_h5, features_complete
+from wsi_core.slide_reader import Slide_Reader, format_read_stats
+from wsi_core.slide_staging import Slide_Stager
+from wsi_core.padded_slide import Padded_Slide, read_padding
+from wsi_core.multi_scale import magnification_name
 from HIPT_4K.hipt_4k import HIPT_4K
 from HIPT_4K.hipt_model_utils import eval_transforms
 
@@ -23,21 +30,10 @@ import torchstain
 device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 print("torch device:", device, "\n")
 
-def compute_w_loader(file_path, output_path, wsi, model,
-        batch_size = 8, verbose = 0, print_every=20, pretrained=True, 
-        custom_downsample=2, target_patch_size=-1):
+def get_patch_transforms():
         """
-        args:
-                file_path: directory of bag (.h5 file)
-                output_path: directory to save computed features (.h5 file)
-                model: pytorch model
-                batch_size: batch_size for computing features in batches
-                verbose: level of feedback
-                pretrained: use weights pretrained on imagenet
-                custom_downsample: custom defined downscale factor of image patches
-                target_patch_size: custom defined, rescaled image size before embedding
+        patch transforms selected by --use_transforms, None for the datasets' default
         """
-        
         if args.use_transforms=='macenko':
             class MacenkoNormalisation:
                 def __init__(self):
@@ -56,8 +52,6 @@ def compute_w_loader(file_path, output_path, wsi, model,
                 [transforms.ToTensor(),
                 transforms.Lambda(lambda x: x*255),
                 MacenkoNormalisation()])
-            dataset = Whole_Slide_Bag_FP(file_path=file_path, wsi=wsi, custom_transforms=t, pretrained=pretrained,
-                custom_downsample=custom_downsample, target_patch_size=target_patch_size)
 
 
         elif args.use_transforms=='all':
@@ -68,8 +62,6 @@ def compute_w_loader(file_path, output_path, wsi, model,
                 transforms.RandomAffine(degrees=90,translate=(0.1,0.1), scale=(0.9,1.1),shear=0.1),
                 transforms.ColorJitter(brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1),
                 transforms.Normalize(mean = (0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225))])
-            dataset = Whole_Slide_Bag_FP(file_path=file_path, wsi=wsi, custom_transforms=t, pretrained=pretrained,
-                custom_downsample=custom_downsample, target_patch_size=target_patch_size)
         
         elif args.use_transforms=='spatial':
             t = transforms.Compose(
@@ -78,21 +70,15 @@ def compute_w_loader(file_path, output_path, wsi, model,
                 transforms.RandomVerticalFlip(p=0.5),
                 transforms.RandomAffine(degrees=90,translate=(0.1,0.1), scale=(0.9,1.1),shear=0.1),
                 transforms.Normalize(mean = (0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225))])
-            dataset = Whole_Slide_Bag_FP(file_path=file_path, wsi=wsi, custom_transforms=t, pretrained=pretrained,
-                custom_downsample=custom_downsample, target_patch_size=target_patch_size)
         
         elif args.use_transforms=='HIPT':
             t = eval_transforms()
-            dataset = Whole_Slide_Bag_FP(file_path=file_path, wsi=wsi, custom_transforms=t, pretrained=pretrained,
-                custom_downsample=custom_downsample, target_patch_size=target_patch_size)
         
         elif args.use_transforms=='HIPT_blur':
             t =  transforms.Compose(
                     [transforms.GaussianBlur(kernel_size=(1, 3), sigma=(7, 9)),
                     eval_transforms()
                     ])
-            dataset = Whole_Slide_Bag_FP(file_path=file_path, wsi=wsi, custom_transforms=t, pretrained=pretrained,
-                custom_downsample=custom_downsample, target_patch_size=target_patch_size)
 
         elif args.use_transforms=='HIPT_wang':
         ## augmentations from the baseline ATEC23 paper
@@ -102,8 +88,6 @@ def compute_w_loader(file_path, output_path, wsi, model,
                     transforms.RandomAffine(degrees=90),
                     transforms.ColorJitter(brightness=0.125, contrast=0.2, saturation=0.2),
                     eval_transforms()])
-            dataset = Whole_Slide_Bag_FP(file_path=file_path, wsi=wsi, custom_transforms=t, pretrained=pretrained,
-                custom_downsample=custom_downsample, target_patch_size=target_patch_size)
 
         elif args.use_transforms=='HIPT_augment_colour':
             ## same as HIPT_augment but no affine
@@ -112,8 +96,6 @@ def compute_w_loader(file_path, output_path, wsi, model,
                     transforms.RandomVerticalFlip(p=0.5),
                     transforms.ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0.2),
                     eval_transforms()])
-            dataset = Whole_Slide_Bag_FP(file_path=file_path, wsi=wsi, custom_transforms=t, pretrained=pretrained,
-                custom_downsample=custom_downsample, target_patch_size=target_patch_size)
         
         elif args.use_transforms=='HIPT_augment':
             t = transforms.Compose(
@@ -122,8 +104,6 @@ def compute_w_loader(file_path, output_path, wsi, model,
                     transforms.RandomAffine(degrees=5,translate=(0.025,0.025), scale=(0.975,1.025),shear=0.025),
                     transforms.ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0.2),
                     eval_transforms()])
-            dataset = Whole_Slide_Bag_FP(file_path=file_path, wsi=wsi, custom_transforms=t, pretrained=pretrained,
-                custom_downsample=custom_downsample, target_patch_size=target_patch_size)
         
         elif args.use_transforms=='HIPT_augment01':
             t = transforms.Compose(
@@ -132,12 +112,90 @@ def compute_w_loader(file_path, output_path, wsi, model,
                     transforms.RandomAffine(degrees=5,translate=(0.025,0.025), scale=(0.975,1.025),shear=0.025),
                     transforms.ColorJitter(brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1),
                     eval_transforms()])
-            dataset = Whole_Slide_Bag_FP(file_path=file_path, wsi=wsi, custom_transforms=t, pretrained=pretrained,
-                custom_downsample=custom_downsample, target_patch_size=target_patch_size)
 
         else:
-            dataset = Whole_Slide_Bag_FP(file_path=file_path, wsi=wsi, pretrained=pretrained, 
-                custom_downsample=custom_downsample, target_patch_size=target_patch_size)
+            # Whole_Slide_Bag_FP falls back to eval_transforms(pretrained)
+            t = None
+        return t
+
+def patch_normalization(pretrained=True):
+        """
+        (mean, std) the patches reach the model normalized with: the Normalize step of get_patch_transforms, or of the
+        datasets' default eval_transforms(pretrained); no Normalize step leaves ToTensor's [0, 1] range
+        """
+        t = get_patch_transforms()
+        steps = [bag_eval_transforms(pretrained=pretrained) if t is None else t]
+        while len(steps) > 0:
+                step = steps.pop(0)
+                if isinstance(step, transforms.Normalize):
+                        return tuple(step.mean), tuple(step.std)
+                steps.extend(getattr(step, 'transforms', []))
+        return (0., 0., 0.), (1., 1., 1.)
+
+## HIPT_4K 256px tiles seen and skipped as background (--skip_background_tiles) since the last report_tile_skipping
+tile_skip_counts = np.zeros(2, dtype=np.int64)
+
+def run_model(model, batch):
+        """
+        features of a batch, counting the tiles skipped with --skip_background_tiles. The counts are returned by the
+        forward pass, so that those of every nn.DataParallel replica are gathered
+        """
+        if not args.skip_background_tiles:
+                return model(batch)
+        features, counts = model(batch, return_skip_counts=True)
+        tile_skip_counts[:] += counts.sum(dim=0).cpu().numpy()
+        return features
+
+def save_features(features, coords, coords_attrs, output_path, pt_path):
+        """
+        write the features of a slide to output_path (.h5, with coords) and pt_path straight from memory, each renamed into
+        place once complete; the .pt goes last, so its presence means both are done
+        """
+        save_features_h5(output_path, features, coords, coords_attrs, compression=args.h5_compression)
+        tmp_path = pt_path + '.tmp'
+        torch.save(torch.from_numpy(features), tmp_path)
+        os.replace(tmp_path, pt_path)
+        print('{} features size: {}'.format(os.path.basename(pt_path), features.shape))
+
+def outputs_complete(h5_file_path, output_path, pt_path):
+        """
+        whether a slide's features were fully written: .pt present and .h5 holding a feature for every patch of h5_file_path
+        """
+        if not os.path.isfile(pt_path) or not os.path.isfile(h5_file_path):
+                return False
+        with h5py.File(h5_file_path, 'r') as f:
+                n_patches = len(f['coords'])
+        return features_complete(output_path, n_patches)
+
+def report_tile_skipping():
+        """
+        print and reset the share of HIPT_4K 256px tiles skipped as background (--skip_background_tiles)
+        """
+        if args.skip_background_tiles:
+                seen, skipped = tile_skip_counts
+                print('background tiles skipped: {:.1%} of {}'.format(skipped / max(seen, 1), seen))
+                tile_skip_counts[:] = 0
+
+def compute_w_loader(file_path, output_path, pt_path, wsi, model,
+        batch_size = 8, verbose = 0, print_every=20, pretrained=True, 
+        custom_downsample=2, target_patch_size=-1):
+        """
+        args:
+                file_path: directory of bag (.h5 file)
+                output_path: directory to save computed features (.h5 file)
+                pt_path: directory to save computed features (.pt file)
+                model: pytorch model
+                batch_size: batch_size for computing features in batches
+                verbose: level of feedback
+                pretrained: use weights pretrained on imagenet
+                custom_downsample: custom defined downscale factor of image patches
+                target_patch_size: custom defined, rescaled image size before embedding
+        """
+        
+        t = get_patch_transforms()
+        dataset = Whole_Slide_Bag_FP(file_path=file_path, wsi=wsi, custom_transforms=t, pretrained=pretrained,
+            custom_downsample=custom_downsample, target_patch_size=target_patch_size, memory_budget=int(args.level_memory_mb * 2**20),
+            level_planning=not args.no_level_planning)
         dataset.update_sample(range(len(dataset)))
         x, y = dataset[0]
         
@@ -158,23 +216,128 @@ def compute_w_loader(file_path, output_path, wsi, model,
         if verbose > 0:
                 print('processing {}: total of {} batches'.format(file_path,len(loader)))
 
-        mode = 'w'
+        # features are gathered in memory and both outputs written once at the end
+        all_features = Feature_Array(len(dataset))
         for count, (batch, coords) in enumerate(loader):
-                with torch.no_grad():   
+                with torch.no_grad(), inference_context(args.precision, device):
                         if count % print_every == 0:
                                 print('batch {}/{}, {} files processed'.format(count, len(loader), count * batch_size))
                         batch = batch.to(device, non_blocking=True)
                         if args.model_type=='levit_128s':
                             batch=tfms(batch)
-                        features = model(batch)
-                        features = features.cpu().numpy()
-
-                        asset_dict = {'features': features, 'coords': coords}
-                        save_hdf5(output_path, asset_dict, attr_dict= None, mode=mode)
-                        mode = 'a'
+                        features = run_model(model, batch)
+                        # bf16 outputs are stored as float32
+                        features = features.float().cpu().numpy()
+                        all_features.append(features)
+        save_features(all_features.result(), dataset.selected_coords, dataset.read_info(), output_path, pt_path)
         
         return output_path
 
+def compute_multi_scale(file_paths, output_paths, pt_paths, wsi, model, batch_size = 8, print_every=20, pretrained=True, target_patch_size=-1):
+        """
+        features of several magnifications of one slide from a single pass over it (see Multi_Scale_Bag)
+        args:
+                file_paths: coords .h5 file of every magnification
+                output_paths: features .h5 file of every magnification
+                pt_paths: features .pt file of every magnification
+        """
+        t = get_patch_transforms()
+        dataset = Multi_Scale_Bag(file_paths, wsi, pretrained=pretrained, custom_transforms=t, target_patch_size=target_patch_size,
+                max_patches=batch_size)
+        # an item holds up to batch_size patches of every magnification, keep one per worker in flight
+        kwargs = {'num_workers': 4, 'pin_memory': True, 'prefetch_factor': 1} if device.type == "cuda" else {}
+        loader = DataLoader(dataset=dataset, batch_size=1, **kwargs, collate_fn=Multi_Scale_Bag.collate)
+        tfms = torch.nn.Sequential(transforms.CenterCrop(224))
+        print('processing {} magnifications: {} items'.format(len(file_paths), len(loader)))
+
+        # patches come region by region, their coords are kept in the same order as the features
+        all_features = [Feature_Array(len(coords)) for coords in dataset.coords]
+        all_coords = [Feature_Array(len(coords)) for coords in dataset.coords]
+        buffers = [([], []) for _ in file_paths]
+        def forward(mag_idx):
+                batch = torch.cat(buffers[mag_idx][0], dim=0)
+                coords = np.concatenate(buffers[mag_idx][1], axis=0)
+                buffers[mag_idx] = ([], [])
+                with torch.no_grad(), inference_context(args.precision, device):
+                        batch = batch.to(device, non_blocking=True)
+                        if args.model_type=='levit_128s':
+                            batch=tfms(batch)
+                        features = run_model(model, batch).float().cpu().numpy()
+                all_features[mag_idx].append(features)
+                all_coords[mag_idx].append(coords)
+
+        for count, (patches, coords) in enumerate(loader):
+                if count % print_every == 0:
+                        print('item {}/{}'.format(count, len(loader)))
+                for mag_idx in range(len(file_paths)):
+                        if patches[mag_idx] is None:
+                                continue
+                        buffers[mag_idx][0].append(patches[mag_idx])
+                        buffers[mag_idx][1].append(coords[mag_idx])
+                        if sum(len(p) for p in buffers[mag_idx][0]) >= batch_size:
+                                forward(mag_idx)
+        for mag_idx in range(len(file_paths)):
+                if len(buffers[mag_idx][0]) > 0:
+                        forward(mag_idx)
+        for mag_idx in range(len(file_paths)):
+                coords = all_coords[mag_idx].result() if all_coords[mag_idx].n_rows > 0 else dataset.coords[mag_idx]
+                save_features(all_features[mag_idx].result(), coords, {}, output_paths[mag_idx], pt_paths[mag_idx])
+        return output_paths
+
+def compute_pipelined(slides, output_paths, pt_paths, model, batch_size = 8, print_every=20, pretrained=True,
+        custom_downsample=2, target_patch_size=-1, num_workers=4, prefetch_factor=4):
+        """
+        features of many slides through one DataLoader whose persistent workers decode the next slide's batches while the
+        model runs on the current one (see Slide_Batches); h5 and .pt outputs are written from memory on a background thread
+        args:
+                slides: (slide file path, patch .h5 file path) of every slide
+                output_paths: features .h5 file of every slide
+                pt_paths: features .pt file of every slide
+        returns:
+                indices of the slides whose features were written
+        """
+        t = get_patch_transforms()
+        dataset = Slide_Batches(slides, batch_size, pretrained=pretrained, custom_transforms=t, custom_downsample=custom_downsample,
+                target_patch_size=target_patch_size, cache_bytes=int(args.tile_cache_mb * 2**20), level_planning=not args.no_level_planning)
+        kwargs = {'num_workers': num_workers, 'pin_memory': device.type == "cuda"}
+        if num_workers > 0:
+                kwargs.update({'persistent_workers': True, 'prefetch_factor': prefetch_factor})
+        loader = DataLoader(dataset=dataset, batch_size=None, **kwargs)
+        tfms = torch.nn.Sequential(transforms.CenterCrop(224))
+        print('processing {} slides: total of {} batches'.format(len(slides), len(loader)))
+
+        writer = Background_Writer()
+        slide_features = {}
+        received = [0] * len(slides)
+        failed = set()
+        done = []
+
+        time_start = time.time()
+        for count, (batch, coords, slide_idx, read_info) in enumerate(loader):
+                if count % print_every == 0:
+                        print('batch {}/{}, {:.1f} s'.format(count, len(loader), time.time() - time_start))
+                received[slide_idx] += 1
+                last = received[slide_idx] == dataset.slide_batches[slide_idx]
+                if batch is None:
+                        failed.add(slide_idx)
+                        slide_features.pop(slide_idx, None)
+                if slide_idx in failed:
+                        continue
+                with torch.no_grad(), inference_context(args.precision, device):
+                        batch = batch.to(device, non_blocking=True)
+                        if args.model_type=='levit_128s':
+                            batch=tfms(batch)
+                        features = run_model(model, batch).float().cpu().numpy()
+                if slide_idx not in slide_features:
+                        slide_features[slide_idx] = Feature_Array(len(dataset.coords_info[slide_idx][0]))
+                slide_features[slide_idx].append(features)
+                if last:
+                        writer.submit(save_features, slide_features.pop(slide_idx).result(), dataset.coords_info[slide_idx][0], read_info,
+                                output_paths[slide_idx], pt_paths[slide_idx])
+                        done.append(slide_idx)
+        writer.close()
+        return done
+
 
 parser = argparse.ArgumentParser(description='Feature Extraction')
 parser.add_argument('--data_h5_dir', type=str, default=None)
@@ -190,6 +353,21 @@ parser.add_argument('--pretraining_dataset',type=str,choices=['ImageNet','Histo'
 parser.add_argument('--model_type',type=str,choices=['resnet18','resnet50','levit_128s','HIPT_4K'],default='resnet50')
 parser.add_argument('--use_transforms',type=str,choices=['all','HIPT','HIPT_blur','HIPT_augment','HIPT_augment_colour','HIPT_wang','HIPT_augment01','spatial','macenko','none'],default='none')
 parser.add_argument('--hardware',type=str,default="PC")
+parser.add_argument('--h5_compression',type=str,choices=['none','lzf','gzip'],default='none')
+parser.add_argument('--tile_cache_mb',type=int,default=256,help='decoded tile cache per slide, 0 to read every patch straight from the slide')
+parser.add_argument('--level_memory_mb',type=int,default=512,help='read the patch level of a slide into memory once when the patches\' bounding box fits in this budget, 0 to disable')
+parser.add_argument('--no_level_planning',default=False,action='store_true',help='with custom_downsample/target_patch_size, resize from patch_level instead of reading a coarser level')
+parser.add_argument('--stage_dir',type=str,default=None,help='local scratch directory slides are copied to ahead of feature extraction')
+parser.add_argument('--stage_gb',type=float,default=50)
+parser.add_argument('--prefetch',type=int,default=2,help='number of upcoming slides copied to stage_dir in the background')
+parser.add_argument('--magnifications',type=float,nargs='+',default=None,help='extract features of patches made with create_patches_fp.py --magnifications in one pass per slide, each into feat_dir/<magnification>/')
+parser.add_argument('--tile_batch_size',type=int,default=256,help='HIPT_4K: 256px tiles per ViT-256 forward, over all regions of a batch')
+parser.add_argument('--skip_background_tiles',default=False,action='store_true',help='HIPT_4K: skip ViT-256 on 256px tiles without tissue (saturation test) and use the embedding of a blank tile instead, see test_HIPT.py --skip_background for the deviation from full features')
+parser.add_argument('--tissue_threshold',type=float,default=0.01,help='HIPT_4K: tiles with a smaller tissue fraction are skipped with --skip_background_tiles')
+parser.add_argument('--precision',type=str,choices=PRECISIONS,default='fp32',help='fp32, bf16 autocast or int8 dynamic quantization of Linear layers (CPU), see test_HIPT.py --benchmark to compare them')
+parser.add_argument('--pipeline',default=False,action='store_true',help='run all slides through one persistent DataLoader, decoding the next slide while the model runs on the current one')
+parser.add_argument('--num_workers',type=int,default=4,help='DataLoader workers of --pipeline')
+parser.add_argument('--prefetch_factor',type=int,default=4,help='batches decoded ahead per worker with --pipeline')
 parser.add_argument('--graph_patches',type=str,choices=['none','small','big'],default='none')
 args = parser.parse_args()
 
@@ -200,13 +378,34 @@ if __name__ == '__main__':
         csv_path = args.csv_path
         if csv_path is None:
                 raise NotImplementedError
+        if args.skip_background_tiles and args.model_type != 'HIPT_4K':
+                raise NotImplementedError('--skip_background_tiles is only supported by HIPT_4K')
 
         bags_dataset = Dataset_All_Bags(csv_path)
         
         os.makedirs(args.feat_dir, exist_ok=True)
         os.makedirs(os.path.join(args.feat_dir, 'pt_files'), exist_ok=True)
         os.makedirs(os.path.join(args.feat_dir, 'h5_files'), exist_ok=True)
-        dest_files = os.listdir(os.path.join(args.feat_dir, 'pt_files'))
+        # several magnifications are read from patches/<magnification>/ and written to feat_dir/<magnification>/
+        mag_names = [magnification_name(mag) for mag in args.magnifications] if args.magnifications else []
+        for mag_name in mag_names:
+                os.makedirs(os.path.join(args.feat_dir, mag_name, 'pt_files'), exist_ok=True)
+                os.makedirs(os.path.join(args.feat_dir, mag_name, 'h5_files'), exist_ok=True)
+        patch_dir = os.path.join(args.data_h5_dir, 'patches') if args.graph_patches == 'none' else os.path.join(args.data_h5_dir, 'patches', args.graph_patches)
+
+        def slide_done(slide_id):
+                """
+                whether the outputs of slide_id are complete (of every magnification with --magnifications), checked on disk
+                when the slide comes up rather than against a listing taken at startup
+                """
+                bag_name = slide_id+'.h5'
+                if len(mag_names) > 0:
+                        return all(outputs_complete(os.path.join(args.data_h5_dir, 'patches', mag_name, bag_name),
+                                os.path.join(args.feat_dir, mag_name, 'h5_files', bag_name),
+                                os.path.join(args.feat_dir, mag_name, 'pt_files', slide_id+'.pt')) for mag_name in mag_names)
+                pt_name = slide_id+'aug1.pt' if args.use_transforms == 'all' else slide_id+'.pt'
+                return outputs_complete(os.path.join(patch_dir, bag_name), os.path.join(args.feat_dir, 'h5_files', bag_name),
+                        os.path.join(args.feat_dir, 'pt_files', pt_name))
         
         print('loading {} model'.format(args.model_type))
         if args.model_type=='resnet18':
@@ -216,11 +415,17 @@ if __name__ == '__main__':
         elif args.model_type=='levit_128s':
             model=timm.create_model('levit_256',pretrained=True, num_classes=0)    
         elif args.model_type=='HIPT_4K':
+            # background tiles are found and replaced under the patch normalization of --use_transforms
+            norm_mean, norm_std = patch_normalization()
             if args.hardware=='DGX':
-                 model = HIPT_4K(model256_path="/mnt/results/Checkpoints/vit256_small_dino.pth",model4k_path="/mnt/results/Checkpoints/vit4k_xs_dino.pth",device256=torch.device('cuda:0'),device4k=torch.device('cuda:0'))
+                 model = HIPT_4K(model256_path="/mnt/results/Checkpoints/vit256_small_dino.pth",model4k_path="/mnt/results/Checkpoints/vit4k_xs_dino.pth",device256=device,device4k=device,tile_batch_size=args.tile_batch_size,
+                    skip_background=args.skip_background_tiles,tissue_threshold=args.tissue_threshold,mean=norm_mean,std=norm_std)
             else:
-                model = HIPT_4K(model256_path="HIPT_4K/ckpts/vit256_small_dino.pth",model4k_path="HIPT_4K/ckpts/vit4k_xs_dino.pth",device256=torch.device('cuda:0'),device4k=torch.device('cuda:0'))
+                model = HIPT_4K(model256_path="HIPT_4K/ckpts/vit256_small_dino.pth",model4k_path="HIPT_4K/ckpts/vit4k_xs_dino.pth",device256=device,device4k=device,tile_batch_size=args.tile_batch_size,
+                    skip_background=args.skip_background_tiles,tissue_threshold=args.tissue_threshold,mean=norm_mean,std=norm_std)
         model = model.to(device)
+        model = prepare_model(model, args.precision, device)
+        print('inference precision: {}'.format(args.precision))
         
         if torch.cuda.device_count() > 1:
                 model = nn.DataParallel(model)
@@ -230,6 +435,38 @@ if __name__ == '__main__':
 
         unavailable_patch_files=0
         total_time_elapsed = 0.0
+        if args.pipeline:
+                if args.stage_dir is not None or len(mag_names) > 0:
+                        raise NotImplementedError('--pipeline does not support --stage_dir or --magnifications')
+                slides, output_paths, pt_paths = [], [], []
+                for bag_candidate_idx in range(total):
+                        slide_id = str(bags_dataset[bag_candidate_idx]).split(args.slide_ext)[0]
+                        if not args.no_auto_skip and slide_done(slide_id):
+                                print('skipped {}'.format(slide_id))
+                                continue
+                        h5_file_path = os.path.join(patch_dir, slide_id+'.h5')
+                        if not os.path.isfile(h5_file_path):
+                                print('patch file unavailable: {}'.format(h5_file_path))
+                                unavailable_patch_files += 1
+                                continue
+                        slides.append((os.path.join(args.data_slide_dir, slide_id+args.slide_ext), h5_file_path))
+                        output_paths.append(os.path.join(args.feat_dir, 'h5_files', slide_id+'.h5'))
+                        pt_paths.append(os.path.join(args.feat_dir, 'pt_files', slide_id+'.pt'))
+                time_start = time.time()
+                done = compute_pipelined(slides, output_paths, pt_paths, model = model, batch_size = args.batch_size, print_every = 100,
+                custom_downsample=args.custom_downsample, target_patch_size=args.target_patch_size,
+                num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
+                report_tile_skipping()
+                print("finished {}/{} slides, {} unavailable slide patch files".format(len(done), len(slides), unavailable_patch_files))
+                print("total time: {}".format(time.time() - time_start))
+                exit()
+
+        stager = None
+        if args.stage_dir is not None:
+                stager = Slide_Stager(args.stage_dir, int(args.stage_gb * 2**30), prefetch=args.prefetch)
+                slide_ids = [str(bags_dataset[i]).split(args.slide_ext)[0] for i in range(total)]
+                stager.schedule([os.path.join(args.data_slide_dir, slide_id+args.slide_ext) for slide_id in slide_ids
+                                 if args.no_auto_skip or not slide_done(slide_id)])
         for bag_candidate_idx in range(total):
             print('\nprogress: {}/{}'.format(bag_candidate_idx, total))
             print('skipped unavailable slides: {}'.format(unavailable_patch_files))
@@ -240,41 +477,55 @@ if __name__ == '__main__':
                     h5_file_path = os.path.join(args.data_h5_dir,'patches/big',bag_name)
                 elif args.graph_patches == 'small':
                     h5_file_path = os.path.join(args.data_h5_dir,'patches/small',bag_name)
+                elif len(mag_names) > 0:
+                    h5_file_path = os.path.join(args.data_h5_dir, 'patches', mag_names[0], bag_name)
                 else:
                     h5_file_path = os.path.join(args.data_h5_dir, 'patches', bag_name)
                 slide_file_path = os.path.join(args.data_slide_dir, slide_id+args.slide_ext)
                 print(slide_id)
 
-                if args.use_transforms == 'all':
-                    if not args.no_auto_skip and slide_id+'aug1.pt' in dest_files:
-                        print('skipped {}'.format(slide_id))
-                        continue
-                else:
-                    if not args.no_auto_skip and slide_id+'.pt' in dest_files:
-                        print('skipped {}'.format(slide_id))
-                        continue 
+                if not args.no_auto_skip and slide_done(slide_id):
+                    print('skipped {}'.format(slide_id))
+                    continue
 
                 output_path = os.path.join(args.feat_dir, 'h5_files', bag_name)
                 time_start = time.time()
-                wsi = openslide.open_slide(slide_file_path)
-                output_file_path = compute_w_loader(h5_file_path, output_path, wsi, 
+                if stager is not None:
+                    slide_file_path = stager.local_path(slide_file_path)
+                slide = openslide.open_slide(slide_file_path)
+                # coords of slides padded during patching (--pad_slide) refer to the padded canvas
+                padding = read_padding(h5_file_path)
+                if padding is not None:
+                    slide = Padded_Slide(slide, **padding)
+                wsi = Slide_Reader(slide, cache_bytes=int(args.tile_cache_mb * 2**20))
+                if len(mag_names) > 0:
+                    h5_paths = [os.path.join(args.data_h5_dir, 'patches', mag_name, bag_name) for mag_name in mag_names]
+                    output_paths = [os.path.join(args.feat_dir, mag_name, 'h5_files', bag_name) for mag_name in mag_names]
+                    pt_paths = [os.path.join(args.feat_dir, mag_name, 'pt_files', slide_id+'.pt') for mag_name in mag_names]
+                    compute_multi_scale(h5_paths, output_paths, pt_paths, wsi, model = model, batch_size = args.batch_size, print_every = 100,
+                    target_patch_size=args.target_patch_size)
+                    time_elapsed = time.time() - time_start
+                    total_time_elapsed += time_elapsed
+                    print('\ncomputing features for {} magnifications took {} s'.format(len(mag_names), time_elapsed))
+                    print('slide reads: ' + format_read_stats(wsi.stats()))
+                    report_tile_skipping()
+                    continue
+                bag_base, _ = os.path.splitext(bag_name)
+                pt_path = os.path.join(args.feat_dir, 'pt_files', bag_base+'.pt')
+                output_file_path = compute_w_loader(h5_file_path, output_path, pt_path, wsi, 
                 model = model, batch_size = args.batch_size, verbose = 1, print_every = 100, 
                 custom_downsample=args.custom_downsample, target_patch_size=args.target_patch_size)
                 time_elapsed = time.time() - time_start
                 total_time_elapsed += time_elapsed
                 print('\ncomputing features for {} took {} s'.format(output_file_path, time_elapsed))
-                file = h5py.File(output_file_path, "r")
-
-                features = file['features'][:]
-                print('features size: ', features.shape)
-                print('coordinates size: ', file['coords'].shape)
-                features = torch.from_numpy(features)
-                bag_base, _ = os.path.splitext(bag_name)
-                torch.save(features, os.path.join(args.feat_dir, 'pt_files', bag_base+'.pt'))
+                print('slide reads: ' + format_read_stats(wsi.stats()))
+                report_tile_skipping()
             except KeyboardInterrupt:
                 assert 1==2, "keyboard interrupt"
             except:
                 print("patch file unavailable")
                 continue
+        if stager is not None:
+                stager.close()
         print("finished running with {} unavailable slide patch files".format(unavailable_patch_files))
         print("total time: {}".format(total_time_elapsed))
@@ -230,6 +230,7 @@ parser.add_argument('--batch_size', type=int, default=256)
 parser.add_argument('--pretraining_dataset',type=str,choices=['ImageNet','Histo'],default='ImageNet')
 parser.add_argument('--data_h5_dir', type=str, default=None)
 parser.add_argument('--data_slide_dir', type=str, default=None)
+parser.add_argument('--slide_dirs', type=str, nargs='+', default=None, help='all directories holding slides for --extract_features, defaults to data_slide_dir and its ../idrive and ../Set30to37 siblings')
 parser.add_argument('--slide_ext', type=str, default= '.svs')
 parser.add_argument('--custom_downsample', type=int, default=1)
 parser.add_argument('--target_patch_size', type=int, default=-1)
@@ -362,6 +363,7 @@ dataset = Generic_MIL_Dataset(csv_path = args.csv_path,
                             patient_strat=False,
                             data_h5_dir=args.data_h5_dir,
                             data_slide_dir=args.data_slide_dir,
+                            slide_dirs=args.slide_dirs,
                             slide_ext=args.slide_ext,
                             pretrained=True, 
                             custom_downsample=args.custom_downsample, 
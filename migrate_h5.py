@@ -0,0 +1,53 @@
+## rewrite existing patch (coords/imgs) and feature .h5 files into the chunked/compressed layout written by utils.file_utils.Hdf5_Writer
+import os
+import argparse
+import h5py
+
+from utils.file_utils import Hdf5_Writer
+
+def migrate_file(src_path, dest_path, compression=None, block_size=65536):
+    """
+    Copy every dataset (and its attrs) of src_path into dest_path block by block.
+    The new file is written next to dest_path and renamed over it once complete, so src_path may equal dest_path.
+    """
+    tmp_path = dest_path + '.tmp'
+    with h5py.File(src_path, 'r') as src:
+        writer = Hdf5_Writer(tmp_path, mode='w', compression=compression)
+        for key in src.keys():
+            dset = src[key]
+            attr_dict = {key: dict(dset.attrs)}
+            for start in range(0, max(len(dset), 1), block_size):
+                writer.append({key: dset[start:start + block_size]}, attr_dict)
+            # one key at a time so chunk shapes are chosen from a full buffer of that dataset
+            writer.flush()
+        for attr_key, attr_val in src.attrs.items():
+            writer.file.attrs[attr_key] = attr_val
+        writer.close()
+    os.replace(tmp_path, dest_path)
+    return dest_path
+
+parser = argparse.ArgumentParser(description='Rewrite .h5 patch and feature files into the new layout')
+parser.add_argument('--src', type=str, required=True,
+                    help='.h5 file or directory of .h5 files to migrate')
+parser.add_argument('--dest', type=str, default=None,
+                    help='output directory, files are rewritten in place if not given')
+parser.add_argument('--compression', type=str, choices=['none', 'lzf', 'gzip'], default='lzf')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if os.path.isdir(args.src):
+        src_dir = args.src
+        files = sorted([f for f in os.listdir(src_dir) if f.endswith('.h5')])
+    else:
+        src_dir, file_name = os.path.split(args.src)
+        files = [file_name]
+
+    dest_dir = src_dir if args.dest is None else args.dest
+    os.makedirs(dest_dir, exist_ok=True)
+
+    for idx, file_name in enumerate(files):
+        src_path = os.path.join(src_dir, file_name)
+        dest_path = os.path.join(dest_dir, file_name)
+        before = os.path.getsize(src_path)
+        migrate_file(src_path, dest_path, compression=args.compression)
+        print('{}/{} {}: {:.1f} KB -> {:.1f} KB'.format(idx + 1, len(files), file_name, before / 1024, os.path.getsize(dest_path) / 1024))
@@ -0,0 +1,32 @@
+import contextlib
+
+import torch
+import torch.nn as nn
+
+PRECISIONS = ['fp32', 'bf16', 'int8']
+
+def prepare_model(model, precision='fp32', device=torch.device('cpu')):
+    """
+    Model to run feature extraction with at the given inference precision:
+        fp32: unchanged
+        bf16: unchanged, run its forward under inference_context (bf16 autocast)
+        int8: nn.Linear layers dynamically quantized to int8 (CPU only). Convolutions have no dynamic quantization
+              in PyTorch, so models without Linear layers (the ResNet baselines) are refused rather than left in fp32
+    """
+    if precision not in PRECISIONS:
+        raise ValueError('unknown precision {}, choose from {}'.format(precision, PRECISIONS))
+    if precision != 'int8':
+        return model
+    if device.type != 'cpu':
+        raise ValueError('int8 dynamic quantization runs on CPU only')
+    if not any(isinstance(module, nn.Linear) for module in model.modules()):
+        raise ValueError('int8 quantizes nn.Linear layers and {} has none, use fp32 or bf16'.format(type(model).__name__))
+    return torch.ao.quantization.quantize_dynamic(model.eval(), {nn.Linear}, dtype=torch.qint8)
+
+def inference_context(precision='fp32', device=torch.device('cpu')):
+    """
+    Context to run the forward of a model returned by prepare_model in
+    """
+    if precision == 'bf16':
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
@@ -4,10 +4,18 @@
 from HIPT_4K.hipt_4k import HIPT_4K
 from HIPT_4K.hipt_model_utils import get_vit256, get_vit4k, eval_transforms
 from HIPT_4K.hipt_heatmap_utils import *
+from models.precision import PRECISIONS, prepare_model, inference_context
 import argparse
+import time
 
 parser = argparse.ArgumentParser(description='Configurations for HIPT feature extraction')
 parser.add_argument('--hardware',type=str, choices=['DGX','PC'], default='DGX',help='sets amount of CPU and GPU to use per experiment')
+parser.add_argument('--precisions',type=str, nargs='+', choices=PRECISIONS, default=['fp32'],help='inference precisions to check against the expected features (extract_features_fp.py --precision)')
+parser.add_argument('--benchmark',type=int, default=0,help='number of timed forward passes per precision for a throughput report, 0 to skip')
+parser.add_argument('--batch_size',type=int, default=1,help='regions per timed forward pass')
+parser.add_argument('--skip_background',default=False,action='store_true',help='compare features with background tile skipping (extract_features_fp.py --skip_background_tiles) to full features')
+parser.add_argument('--validation_dir',type=str, default=None,help='directory of 4096px region images to validate background skipping on, the demo region if not set')
+parser.add_argument('--tissue_threshold',type=float, default=0.01)
 args = parser.parse_args()
 
 if args.hardware == "PC":
@@ -17,17 +25,13 @@ else:
     pretrained_weights256 ="/mnt/results/Checkpoints/vit256_small_dino.pth"
     pretrained_weights4k = "/mnt/results/Checkpoints/vit4k_xs_dino.pth"
 
-device256 = torch.device('cuda')
-device4k = torch.device('cuda')
-
-model = HIPT_4K(pretrained_weights256, pretrained_weights4k, device256, device4k)
 device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 print("device: ",device)
+model = HIPT_4K(pretrained_weights256, pretrained_weights4k, device, device)
 model.eval()
 
 region = Image.open('HIPT_4K/image_demo/image_4k.png')
 x = eval_transforms()(region).unsqueeze(dim=0)
-out = model.forward(x)
 
 expected_out = torch.tensor([[0.8896,-2.1130,0.4011,1.9388,2.2679,-0.2919,-2.8318,3.3083,
     -2.5549,-1.0718,2.4532,0.3009,-2.7087,1.0475,0.4862,-0.9086,
@@ -52,15 +56,87 @@ expected_out = torch.tensor([[0.8896,-2.1130,0.4011,1.9388,2.2679,-0.2919,-2.831
     -1.1236,-0.7329,-0.9192,-3.4123,-1.0592,-1.0717,-2.1983,-3.0891,
     -0.2500,-3.1052,-0.3217,-0.0544,6.5555,3.3587,-2.7746,-2.2714,
     2.2318,-2.9227,2.5831,-4.2082,2.9219,-0.4439,-2.7881,0.6900,
-    -0.7225,-3.2197,0.5538,-0.5984,0.9696,-2.2826,-0.3154,2.4052]],
-    device='cuda:0')
+    -0.7225,-3.2197,0.5538,-0.5984,0.9696,-2.2826,-0.3154,2.4052]])
 
-if torch.equal(torch.round(out,decimals=2), torch.round(expected_out,decimals=2)):
-    print("Test passed - expected features extracted")
-else: 
+## accuracy (and throughput with --benchmark) of every inference precision
+report = []
+for precision in args.precisions:
+    print("\nprecision: ", precision)
+    try:
+        precision_model = prepare_model(model, precision, device)
+    except ValueError as e:
+        print("skipped: {}".format(e))
+        continue
+    with torch.no_grad(), inference_context(precision, device):
+        out = precision_model.forward(x).float().cpu()
+    max_diff = (out - expected_out).abs().max().item()
     diff = torch.eq(torch.round(out,decimals=2), torch.round(expected_out,decimals=2))
     similarity = (100*torch.sum(diff)/torch.numel(diff)).item()
-    if similarity>75:
+    if torch.equal(torch.round(out,decimals=2), torch.round(expected_out,decimals=2)):
+        print("Test passed - expected features extracted")
+    elif similarity>75:
         print("Test probably fine - expected feature similarity {}%, whereas it is typicallly 0% when model weights arent properly loaded".format(round(similarity,2)))
     else:
         print("Test failed - expected feature similarity {}%".format(round(similarity,2)))
+    print("max absolute difference to expected features: {:.4f}".format(max_diff))
+
+    throughput = float('nan')
+    if args.benchmark > 0:
+        batch = x.repeat(args.batch_size, 1, 1, 1)
+        with torch.no_grad(), inference_context(precision, device):
+            precision_model.forward(batch)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+            for _ in range(args.benchmark):
+                precision_model.forward(batch)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+        throughput = args.benchmark * args.batch_size / (time.time() - start)
+        print("throughput: {:.3f} regions/s".format(throughput))
+    report.append((precision, similarity, max_diff, throughput))
+
+print("\nprecision | feature similarity (%) | max abs diff | regions/s")
+for precision, similarity, max_diff, throughput in report:
+    print("{:9} | {:22.2f} | {:12.4f} | {:.3f}".format(precision, similarity, max_diff, throughput))
+
+## batched forward: several regions, and edge regions of different sizes, should match the single region path
+with torch.no_grad():
+    out_single = model.forward_single(x)
+    out_batch = model.forward(torch.cat([x, x], dim=0))
+    edge = x[:, :, :2048, :3072]
+    out_edge = model.forward_single(edge)
+    out_mixed = model.forward([x, edge])
+max_diff = max((out_batch - out_single).abs().max().item(), (out_mixed[0:1] - out_single).abs().max().item(),
+               (out_mixed[1:2] - out_edge).abs().max().item())
+if max_diff < 1e-3:
+    print("Batched forward test passed - max difference to single region forward {:.2e}".format(max_diff))
+else:
+    print("Batched forward test failed - max difference to single region forward {:.2e}".format(max_diff))
+
+## background tile skipping: share of tiles skipped and deviation from the full features
+if args.skip_background:
+    if args.validation_dir is None:
+        region_paths = ['HIPT_4K/image_demo/image_4k.png']
+    else:
+        region_paths = sorted(os.path.join(args.validation_dir, name) for name in os.listdir(args.validation_dir))
+    model.tissue_threshold = args.tissue_threshold
+    skipped, cosine, max_diffs = [], [], []
+    for region_path in region_paths:
+        x_val = eval_transforms()(Image.open(region_path).convert('RGB')).unsqueeze(dim=0)
+        with torch.no_grad():
+            model.skip_background = False
+            out_full = model.forward(x_val).float().cpu()
+            model.skip_background = True
+            out_skip, skip_counts = model.forward(x_val, return_skip_counts=True)
+            out_skip = out_skip.float().cpu()
+        seen, n_skipped = skip_counts[0].tolist()
+        skipped.append(n_skipped / seen)
+        cosine.append(torch.nn.functional.cosine_similarity(out_full, out_skip).item())
+        max_diffs.append((out_full - out_skip).abs().max().item())
+        print("{}: {:.1%} tiles skipped, cosine similarity {:.4f}, max abs diff {:.4f}".format(
+            os.path.basename(region_path), skipped[-1], cosine[-1], max_diffs[-1]))
+    model.skip_background = False
+    print("background skipping over {} regions: {:.1%} tiles skipped, mean cosine similarity {:.4f}, min {:.4f}, max abs diff {:.4f}".format(
+        len(region_paths), np.mean(skipped), np.mean(cosine), np.min(cosine), np.max(max_diffs)))
+
@@ -1,5 +1,9 @@
+import os
 import pickle
+import queue
+import threading
 import h5py
+import numpy as np
 
 def save_pkl(filename, save_object):
 	writer = open(filename,'wb')
@@ -13,23 +17,179 @@ def load_pkl(filename):
 	return file
 
 
-def save_hdf5(output_path, asset_dict, attr_dict= None, mode='a'):
-    file = h5py.File(output_path, mode)
-    for key, val in asset_dict.items():
-        data_shape = val.shape
-        if key not in file:
-            data_type = val.dtype
-            chunk_shape = (1, ) + data_shape[1:]
-            maxshape = (None, ) + data_shape[1:]
-            dset = file.create_dataset(key, shape=data_shape, maxshape=maxshape, chunks=chunk_shape, dtype=data_type)
-            dset[:] = val
-            if attr_dict is not None:
-                if key in attr_dict.keys():
-                    for attr_key, attr_val in attr_dict[key].items():
-                        dset.attrs[attr_key] = attr_val
-        else:
-            dset = file[key]
-            dset.resize(len(dset) + data_shape[0], axis=0)
-            dset[-data_shape[0]:] = val
-    file.close()
-    return output_path
\ No newline at end of file
+def hdf5_chunk_shape(data_shape, dtype, n_rows=None, chunk_bytes=2**20):
+    """
+    Chunk shape for a dataset extended along axis 0: as many rows as fit in chunk_bytes,
+    but no more than n_rows (the rows known at creation) so small files do not allocate whole empty chunks
+    """
+    row_bytes = max(1, int(np.prod(data_shape[1:], dtype=np.int64)) * np.dtype(dtype).itemsize)
+    rows = max(1, chunk_bytes // row_bytes)
+    if n_rows is not None:
+        rows = min(rows, max(1, n_rows))
+    return (int(rows), ) + tuple(data_shape[1:])
+
+
+class Hdf5_Writer(object):
+    """
+    Keeps an h5 file open and buffers appended arrays in memory, writing them in blocks of up to buffer_bytes.
+    Datasets are created resizable along axis 0 with size-aware chunks and optional compression ('lzf' or 'gzip').
+    """
+    def __init__(self, output_path, mode='a', compression=None, buffer_bytes=64 * 2**20, chunk_bytes=2**20):
+        self.output_path = output_path
+        self.file = h5py.File(output_path, mode)
+        self.compression = None if compression in [None, 'none'] else compression
+        self.buffer_bytes = buffer_bytes
+        self.chunk_bytes = chunk_bytes
+        self.buffers = {}
+        self.attrs = {}
+        self.buffered = 0
+
+    def append(self, asset_dict, attr_dict=None):
+        for key, val in asset_dict.items():
+            val = np.asarray(val)
+            self.buffers.setdefault(key, []).append(val)
+            self.buffered += val.nbytes
+            if attr_dict is not None and key in attr_dict.keys():
+                self.attrs.setdefault(key, {}).update(attr_dict[key])
+
+        if self.buffered >= self.buffer_bytes:
+            self.flush()
+
+    def flush(self):
+        for key, vals in self.buffers.items():
+            val = vals[0] if len(vals) == 1 else np.concatenate(vals, axis=0)
+            data_shape = val.shape
+            if key not in self.file and 0 in data_shape[1:]:
+                # empty rows (e.g. features of a slide without patches) cannot be chunked
+                self.file.create_dataset(key, data=val)
+            elif key not in self.file:
+                chunk_shape = hdf5_chunk_shape(data_shape, val.dtype, n_rows=data_shape[0], chunk_bytes=self.chunk_bytes)
+                maxshape = (None, ) + data_shape[1:]
+                dset = self.file.create_dataset(key, shape=data_shape, maxshape=maxshape, chunks=chunk_shape, dtype=val.dtype,
+                                                compression=self.compression)
+                dset[:] = val
+            else:
+                dset = self.file[key]
+                dset.resize(len(dset) + data_shape[0], axis=0)
+                dset[-data_shape[0]:] = val
+
+        for key, attrs in self.attrs.items():
+            for attr_key, attr_val in attrs.items():
+                self.file[key].attrs[attr_key] = attr_val
+
+        self.buffers = {}
+        self.attrs = {}
+        self.buffered = 0
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+        return self.output_path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Background_Writer(object):
+    """
+    Runs output writing (h5 appends, torch.save, ...) on a background thread, in submission order, so the caller can
+    go on with the next batch. At most max_pending jobs wait, submit blocks beyond that.
+    The first error raised by a job is raised again by the next submit or by close.
+    """
+    def __init__(self, max_pending=16):
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            fn, args, kwargs = job
+            if self.error is not None:
+                continue
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, fn, *args, **kwargs):
+        self._check()
+        self.jobs.put((fn, args, kwargs))
+
+    def close(self):
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+        self._check()
+
+
+def save_hdf5(output_path, asset_dict, attr_dict= None, mode='a', compression=None):
+    writer = Hdf5_Writer(output_path, mode=mode, compression=compression)
+    writer.append(asset_dict, attr_dict)
+    return writer.close()
+
+
+class Feature_Array(object):
+    """
+    Features of a slide collected in one preallocated array of n_rows rows (the slide's patch count),
+    allocated on the first batch, once the feature size and dtype are known
+    """
+    def __init__(self, n_rows):
+        self.n_rows = n_rows
+        self.array = None
+        self.filled = 0
+
+    def append(self, features):
+        features = np.asarray(features)
+        if self.array is None:
+            self.array = np.empty((self.n_rows, ) + features.shape[1:], dtype=features.dtype)
+        self.array[self.filled:self.filled + len(features)] = features
+        self.filled += len(features)
+
+    def complete(self):
+        return self.filled == self.n_rows
+
+    def result(self):
+        if self.array is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        return self.array[:self.filled]
+
+
+def save_features_h5(output_path, features, coords, coords_attrs=None, compression=None):
+    """
+    Write the features and coords of a slide in one go, to a temporary file renamed to output_path once complete,
+    so an interrupted run never leaves a truncated output under the final name
+    """
+    tmp_path = output_path + '.tmp'
+    writer = Hdf5_Writer(tmp_path, mode='w', compression=compression, buffer_bytes=np.inf)
+    writer.append({'features': features, 'coords': coords}, {'coords': coords_attrs or {}})
+    writer.close()
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def features_complete(output_path, n_patches):
+    """
+    Whether output_path holds features and coords for all n_patches patches of a slide
+    """
+    if not os.path.isfile(output_path):
+        return False
+    try:
+        with h5py.File(output_path, 'r') as f:
+            return 'features' in f and 'coords' in f and len(f['features']) == n_patches and len(f['coords']) == n_patches
+    except OSError:
+        return False
@@ -56,7 +56,10 @@ def collate_MIL_coords(batch):
 def collate_features_wholeslide(batch):
         #print([item for item in batch[0][1]])
         #print("len(batch[0][0])",len(batch[0][0]))
-        img = torch.cat([item[0] for item in batch[0][0]], dim = 0)
+        if torch.is_tensor(batch[0][0]):
+                img = batch[0][0]
+        else:
+                img = torch.cat([item[0] for item in batch[0][0]], dim = 0)
         #print("img len",len(img))
         #coords = np.vstack([item[1] for item in batch[0][0]])
         label = torch.LongTensor([batch[0][1]])
@@ -84,6 +87,9 @@ def get_split_loader(split_dataset, training = False, weighted = False, workers
                 return either the validation loader or training loader 
         """
         kwargs = {'num_workers': workers} if device.type == "cuda" else {}
+        # datasets holding per worker state (e.g. open slides for online feature extraction)
+        if 'num_workers' in kwargs and hasattr(split_dataset, 'worker_init_fn'):
+                kwargs['worker_init_fn'] = split_dataset.worker_init_fn
         
         if collate is None:
             if len(split_dataset[0])==3:
@@ -35,13 +35,16 @@ def drawHeatmap(scores, coords, slide_path=None, wsi_object=None, vis_level = -1
     heatmap = wsi_object.visHeatmap(scores=scores, coords=coords, vis_level=vis_level, **kwargs)
     return heatmap
 
-def initialize_wsi(wsi_path, seg_mask_path=None, seg_params=None, filter_params=None):
-    wsi_object = WholeSlideImage(wsi_path)
+def initialize_wsi(wsi_path, seg_mask_path=None, seg_params=None, filter_params=None, seg_cache=None, catalog=None, catalog_key=None):
+    wsi_object = WholeSlideImage(wsi_path, catalog=catalog, catalog_key=catalog_key)
     if seg_params['seg_level'] < 0:
         best_level = wsi_object.wsi.get_best_level_for_downsample(32)
         seg_params['seg_level'] = best_level
 
-    wsi_object.segmentTissue(**seg_params, filter_params=filter_params)
+    if seg_cache is not None:
+        seg_cache.segment(wsi_object, wsi_path, seg_params, filter_params)
+    else:
+        wsi_object.segmentTissue(**seg_params, filter_params=filter_params)
     wsi_object.saveSegmentation(seg_mask_path)
     return wsi_object
 
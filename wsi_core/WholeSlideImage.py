@@ -12,37 +12,39 @@ from PIL import Image
 import pdb
 import h5py
 import math
-from wsi_core.wsi_utils import savePatchIter_bag_hdf5, initialize_hdf5_bag, coord_generator, save_hdf5, sample_indices, screen_coords, isBlackPatch, isWhitePatch, to_percentiles
+from wsi_core.wsi_utils import savePatchIter_bag_hdf5, initialize_hdf5_bag, Patch_Bag_Writer, coord_generator, save_hdf5, sample_indices, screen_coords, isBlackPatch, isWhitePatch, to_percentiles, median_saturation, background_prefilter, coord_strips
 import itertools
-from wsi_core.util_classes import isInContourV1, isInContourV2, isInContourV3_Easy, isInContourV3_Hard, Contour_Checking_fn
-from utils.file_utils import load_pkl, save_pkl
+from wsi_core.slide_reader import Slide_Reader, plan_read_level
+from wsi_core.pyramid import Pyramid_Slide
+from wsi_core.padded_slide import Padded_Slide
+from wsi_core.util_classes import isInContourV1, isInContourV2, isInContourV3_Easy, isInContourV3_Hard, Contour_Checking_fn, Contour_Mask
+from utils.file_utils import load_pkl, save_pkl, Hdf5_Writer
 
 Image.MAX_IMAGE_PIXELS = 933120000
 
 class WholeSlideImage(object):
-    def __init__(self, path, pad=0):
+    def __init__(self, path, pad=0, pyramid_path=None, catalog=None, catalog_key=None):
 
         """
         Args:
             path (str): fullpath to WSI file
+            pad (int): minimum width and height, smaller slides are padded with background (see wsi_core.padded_slide)
+            pyramid_path (str): sidecar pyramid of the slide (see wsi_core.pyramid), adds its small levels
+            catalog (Slide_Catalog): slide metadata, a catalogued slide is only opened on its first pixel read
+            catalog_key (str): path the slide is catalogued under, if path is a (staged) copy of it
         """
 
         self.name = os.path.splitext(os.path.basename(path))[0]
-        self.wsi = openslide.open_slide(path)
+        slide = catalog.open(path, catalog_key) if catalog is not None else openslide.open_slide(path)
+        if pyramid_path is not None:
+            slide = Pyramid_Slide(slide, openslide.open_slide(pyramid_path))
+        # slides smaller than pad are centred on a white canvas of at least pad x pad, virtually (nothing is written)
+        self.padding = None
         if pad>0:
-            if min(self.wsi.dimensions)<pad:
-                current_width, current_height = self.wsi.dimensions
-                pad_left = max(0, (pad - current_width) // 2)
-                pad_right = max(0, pad - current_width - pad_left)
-                pad_top = max(0, (pad - current_height) // 2)
-                pad_bottom = max(0, pad - current_height - pad_top)
-                new_width = current_width + pad_left + pad_right
-                new_height = current_height + pad_top + pad_bottom
-
-                padded_slide = Image.new("RGB", (new_width, new_height),color=(255, 255, 255))
-                padded_slide.paste(self.wsi.read_region((0, 0), 0, (current_width, current_height)), (pad_left, pad_top))
-                padded_slide.save("../mount_outputs/padded_slides/{}.tiff".format(self.name))
-                self.wsi = openslide.open_slide("../mount_outputs/padded_slides/{}.tiff".format(self.name))
+            slide = Padded_Slide.to_min_size(slide, pad)
+            if isinstance(slide, Padded_Slide):
+                self.padding = slide.padding_attrs()
+        self.wsi = Slide_Reader(slide)
         self.level_downsamples = self._assertLevelDownsamples()
         self.level_dim = self.wsi.level_dimensions
     
@@ -109,9 +111,10 @@ class WholeSlideImage(object):
         self.holes_tissue = [[] for contour in contours]
     
     def segmentTissue(self, seg_level=0, sthresh=20, sthresh_up = 255, mthresh=7, close = 0, use_otsu=False, 
-                            filter_params={'a_t':100}, ref_patch_size=512, exclude_ids=[], keep_ids=[]):
+                            filter_params={'a_t':100}, ref_patch_size=512, exclude_ids=[], keep_ids=[], tile_size=None, max_read_pixels=1e8):
         """
             Segment the tissue via HSV -> Median thresholding -> Binary threshold
+            tile_size: read seg_level in blocks of this size, used automatically (4096) when the level exceeds max_read_pixels
         """
         
         def _filter_contours(contours, hierarchy, filter_params):
@@ -162,9 +165,11 @@ class WholeSlideImage(object):
 
             return foreground_contours, hole_contours
         
-        img = np.array(self.wsi.read_region((0,0), seg_level, self.level_dim[seg_level]))
-        img_hsv = cv2.cvtColor(img, cv2.COLOR_RGB2HSV)  # Convert to HSV space
-        img_med = cv2.medianBlur(img_hsv[:,:,1], mthresh)  # Apply median blurring
+        w, h = self.level_dim[seg_level]
+        if tile_size is None and w * h > max_read_pixels:
+            tile_size = 4096
+            print('level_dim {} x {} is too large for a single read, segmenting in {} x {} tiles'.format(w, h, tile_size, tile_size))
+        img_med = median_saturation(self.wsi, seg_level, mthresh, tile_size=tile_size)
         
        
         # Thresholding
@@ -260,45 +265,51 @@ class WholeSlideImage(object):
         return img
 
 
-    def createPatches_bag_hdf5(self, save_path, patch_level=0, patch_size=256, step_size=256, save_coord=True, **kwargs):
+    def createPatches_bag_hdf5(self, save_path, patch_level=0, patch_size=256, step_size=256, save_coord=True,
+        buffer_bytes=256 * 2**20, threaded_writer=False, compression=None, **kwargs):
         contours = self.contours_tissue
         contour_holes = self.holes_tissue
 
         print("Creating patches for: ", self.name, "...",)
         elapsed = time.time()
-        for idx, cont in enumerate(contours):
-            patch_gen = self._getPatchGenerator(cont, idx, patch_level, save_path, patch_size, step_size, **kwargs)
-            
-            if self.hdf5_file is None:
-                try:
-                    first_patch = next(patch_gen)
-
-                # empty contour, continue
-                except StopIteration:
-                    continue
-
-                file_path = initialize_hdf5_bag(first_patch, save_coord=save_coord)
-                self.hdf5_file = file_path
-
-            for patch in patch_gen:
-                savePatchIter_bag_hdf5(patch)
+        # the bag file is opened with the first patch and kept open, patches are written in bulk
+        writer = None
+        try:
+            for idx, cont in enumerate(contours):
+                patch_gen = self._getPatchGenerator(cont, idx, patch_level, save_path, patch_size, step_size, **kwargs)
+                for patch in patch_gen:
+                    if writer is None:
+                        writer = Patch_Bag_Writer(patch, save_coord=save_coord, buffer_bytes=buffer_bytes, 
+                                                  compression=compression, threaded=threaded_writer)
+                    writer.write(patch)
+        finally:
+            if writer is not None:
+                self.hdf5_file = writer.close()
 
         return self.hdf5_file
 
 
     def _getPatchGenerator(self, cont, cont_idx, patch_level, save_path, patch_size=256, step_size=256, custom_downsample=1,
-        white_black=True, white_thresh=15, black_thresh=50, contour_fn='four_pt', use_padding=True):
+        white_black=True, white_thresh=15, black_thresh=50, contour_fn='four_pt', use_padding=True, prefilter='none'):
+        """
+            prefilter: reject background from low resolution statistics before any full resolution read (see
+                background_prefilter). 'none' reads every candidate, 'safe' uses conservative bounds meant to skip only reads
+                of patches the white/black check rejects anyway (measured, not guaranteed for every scanner), 'fast'
+                compares thumbnail means to the thresholds
+        """
         start_x, start_y, w, h = cv2.boundingRect(cont) if cont is not None else (0, 0, self.level_dim[patch_level][0], self.level_dim[patch_level][1])
         print("Bounding Box:", start_x, start_y, w, h)
         print("Contour Area:", cv2.contourArea(cont))
         
+        read_level, read_size = patch_level, (patch_size, patch_size)
         if custom_downsample > 1:
-            assert custom_downsample == 2 
             target_patch_size = patch_size
-            patch_size = target_patch_size * 2
-            step_size = step_size * 2
-            print("Custom Downsample: {}, Patching at {} x {}, But Final Patch Size is {} x {}".format(custom_downsample, patch_size, patch_size, 
-                target_patch_size, target_patch_size))
+            patch_size = target_patch_size * custom_downsample
+            step_size = step_size * custom_downsample
+            # read from the coarsest level that still covers the final size, only the remainder is resized
+            read_level, read_size, _ = plan_read_level(self.wsi, patch_level, (patch_size, patch_size), (target_patch_size, target_patch_size))
+            print("Custom Downsample: {}, Patching at {} x {}, Reading {} x {} at level {}, Final Patch Size is {} x {}".format(custom_downsample,
+                patch_size, patch_size, read_size[0], read_size[1], read_level, target_patch_size, target_patch_size))
 
         patch_downsample = (int(self.level_downsamples[patch_level][0]), int(self.level_downsamples[patch_level][1]))
         ref_patch_size = (patch_size*patch_downsample[0], patch_size*patch_downsample[1])
@@ -329,27 +340,38 @@ class WholeSlideImage(object):
             stop_y = min(start_y+h, img_h-ref_patch_size[1])
             stop_x = min(start_x+w, img_w-ref_patch_size[0])
 
-        count = 0
+        contour_mask = Contour_Mask(cont, self.holes_tissue[cont_idx])
+        x_range = np.arange(start_x, stop_x, step_size_x)
+
+        #points not inside contour and its associated holes are dropped, row by row in the usual order
+        coords = []
         for y in range(start_y, stop_y, step_size_y):
-            for x in range(start_x, stop_x, step_size_x):
+            row = np.stack([x_range, np.full_like(x_range, y)], axis=1)
+            coords.append(row[contour_mask.filter_coords(row, cont_check_fn, ref_patch_size[0])])
+        coords = np.concatenate(coords) if len(coords) > 0 else np.zeros((0, 2), dtype=int)
 
-                if not self.isInContours(cont_check_fn, (x,y), self.holes_tissue[cont_idx], ref_patch_size[0]): #point not inside contour and its associated holes
-                    continue    
-                
-                count+=1
-                patch_PIL = self.wsi.read_region((x,y), patch_level, (patch_size, patch_size)).convert('RGB')
-                if custom_downsample > 1:
-                    patch_PIL = patch_PIL.resize((target_patch_size, target_patch_size))
-                
-                if white_black:
-                    if isBlackPatch(np.array(patch_PIL), rgbThresh=black_thresh) or isWhitePatch(np.array(patch_PIL), satThresh=white_thresh): 
-                        continue
+        if custom_downsample > 1 and read_size != (target_patch_size, target_patch_size) and prefilter == 'safe':
+            # the white/black check sees a resized patch, whose means the bounds of 'safe' do not cover
+            prefilter = 'none'
+        if white_black:
+            coords = coords[~background_prefilter(self.wsi, coords, ref_patch_size, patch_level, white_thresh, black_thresh, prefilter)]
+
+        count = 0
+        for x, y in coords.tolist():
+            count+=1
+            patch_PIL = self.wsi.read_region((x,y), read_level, read_size).convert('RGB')
+            if custom_downsample > 1 and read_size != (target_patch_size, target_patch_size):
+                patch_PIL = patch_PIL.resize((target_patch_size, target_patch_size))
+            
+            if white_black:
+                if isBlackPatch(np.array(patch_PIL), rgbThresh=black_thresh) or isWhitePatch(np.array(patch_PIL), satThresh=white_thresh): 
+                    continue
 
-                patch_info = {'x':x // (patch_downsample[0] * custom_downsample), 'y':y // (patch_downsample[1] * custom_downsample), 'cont_idx':cont_idx, 'patch_level':patch_level, 
-                'downsample': self.level_downsamples[patch_level], 'downsampled_level_dim': tuple(np.array(self.level_dim[patch_level])//custom_downsample), 'level_dim': self.level_dim[patch_level],
-                'patch_PIL':patch_PIL, 'name':self.name, 'save_path':save_path}
+            patch_info = {'x':x // (patch_downsample[0] * custom_downsample), 'y':y // (patch_downsample[1] * custom_downsample), 'cont_idx':cont_idx, 'patch_level':patch_level, 
+            'downsample': self.level_downsamples[patch_level], 'downsampled_level_dim': tuple(np.array(self.level_dim[patch_level])//custom_downsample), 'level_dim': self.level_dim[patch_level],
+            'patch_PIL':patch_PIL, 'name':self.name, 'save_path':save_path}
 
-                yield patch_info
+            yield patch_info
 
         
         print("patches extracted: {}".format(count))
@@ -389,31 +411,41 @@ class WholeSlideImage(object):
         
         return level_downsamples
 
-    def process_contours(self, save_path, patch_level=0, patch_size=256, step_size=256, **kwargs):
+    def process_contours(self, save_path, patch_level=0, patch_size=256, step_size=256, compression=None, **kwargs):
         save_path_hdf5 = os.path.join(save_path, str(self.name) + '.h5')
         print("Creating patches for: ", self.name, "...",)
         elapsed = time.time()
         n_contours = len(self.contours_tissue)
         print("Total number of contours to process: ", n_contours)
         fp_chunk_size = math.ceil(n_contours * 0.05)
-        init = True
+        # coords of all contours are buffered and written to the file in one go
+        writer = None
         for idx, cont in enumerate(self.contours_tissue):
             if (idx + 1) % fp_chunk_size == fp_chunk_size:
                 print('Processing contour {}/{}'.format(idx, n_contours))
             
             asset_dict, attr_dict = self.process_contour(cont, self.holes_tissue[idx], patch_level, save_path, patch_size, step_size, **kwargs)
             if len(asset_dict) > 0:
-                if init:
-                    save_hdf5(save_path_hdf5, asset_dict, attr_dict, mode='w')
-                    init = False
+                if writer is None:
+                    writer = Hdf5_Writer(save_path_hdf5, mode='w', compression=compression)
+                    writer.append(asset_dict, attr_dict)
                 else:
-                    save_hdf5(save_path_hdf5, asset_dict, mode='a')
+                    writer.append(asset_dict)
+
+        if writer is not None:
+            writer.close()
 
         return self.hdf5_file
 
 
     def process_contour(self, cont, contour_holes, patch_level, save_path, patch_size = 256, step_size = 256,
-        contour_fn='four_pt', use_padding=True, top_left=None, bot_right=None):
+        contour_fn='four_pt', use_padding=True, top_left=None, bot_right=None, mask_downsample=None, pool=None,
+        strip_size=2**20, prefilter='none', white_thresh=15, black_thresh=50):
+        """
+            prefilter: drop candidates rejected as background by background_prefilter, 'none' keeps every coordinate
+                inside the contour. This path has no full resolution white/black check, so any other mode is an additional
+                background filter that changes the output: it drops coordinates that 'none' writes
+        """
         start_x, start_y, w, h = cv2.boundingRect(cont) if cont is not None else (0, 0, self.level_dim[patch_level][0], self.level_dim[patch_level][1])
 
         patch_downsample = (int(self.level_downsamples[patch_level][0]), int(self.level_downsamples[patch_level][1]))
@@ -466,18 +498,18 @@ class WholeSlideImage(object):
 
         x_range = np.arange(start_x, stop_x, step=step_size_x)
         y_range = np.arange(start_y, stop_y, step=step_size_y)
-        x_coords, y_coords = np.meshgrid(x_range, y_range, indexing='ij')
-        coord_candidates = np.array([x_coords.flatten(), y_coords.flatten()]).transpose()
-
-        num_workers = mp.cpu_count()
-        if num_workers > 4:
-            num_workers = 4
-        pool = mp.Pool(num_workers)
-
-        iterable = [(coord, contour_holes, ref_patch_size[0], cont_check_fn) for coord in coord_candidates]
-        results = pool.starmap(WholeSlideImage.process_coord_candidate, iterable)
-        pool.close()
-        results = np.array([result for result in results if result is not None])
+
+        # rasterize the contour and its holes once, then stream the candidate grid through the mask in strips
+        contour_mask = Contour_Mask(cont, contour_holes, downsample=mask_downsample) if pool is None else None
+        results = []
+        for coord_candidates in coord_strips(x_range, y_range, strip_size=strip_size):
+            if pool is not None:
+                keep = pool.filter_coords(cont, contour_holes, coord_candidates, cont_check_fn, ref_patch_size[0], mask_downsample)
+            else:
+                keep = contour_mask.filter_coords(coord_candidates, cont_check_fn, ref_patch_size[0])
+            results.append(coord_candidates[keep])
+        results = np.concatenate(results) if len(results) > 0 else np.zeros((0, 2), dtype=x_range.dtype)
+        results = results[~background_prefilter(self.wsi, results, ref_patch_size, patch_level, white_thresh, black_thresh, prefilter)]
         
         print('Extracted {} coordinates'.format(len(results)))
 
@@ -491,6 +523,8 @@ class WholeSlideImage(object):
                     'level_dim':              self.level_dim[patch_level],
                     'name':                   self.name,
                     'save_path':              save_path}
+            if self.padding is not None:
+                attr.update(self.padding)
 
             attr_dict = { 'coords' : attr}
             return asset_dict, attr_dict
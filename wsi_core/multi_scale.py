@@ -0,0 +1,115 @@
+import cv2
+import numpy as np
+
+from wsi_core.slide_reader import objective_power
+
+def magnification_name(magnification):
+    """
+    Folder name of a magnification, as used for the cohort runs: 10 -> '10x', 1.25 -> '1point25x'
+    """
+    magnification = float(magnification)
+    if magnification.is_integer():
+        return '{}x'.format(int(magnification))
+    return '{}x'.format(repr(magnification).replace('.', 'point'))
+
+def base_magnification(wsi, default=None):
+    """
+    Scanning magnification of the slide, default if the slide does not record it
+    """
+    power = objective_power(wsi)
+    if power is None:
+        if default is None:
+            raise ValueError('slide does not record its objective power, set the base magnification')
+        return float(default)
+    return power
+
+def magnification_patch_params(wsi, base_mag, magnification, patch_size):
+    """
+    Patch level and patch size (in pixels at that level) for patches of patch_size pixels at magnification:
+    the coarsest level on which the patch footprint is a whole number of pixels
+    returns:
+        patch_level, level_patch_size, footprint (patch size in level 0 pixels)
+    """
+    downsample = base_mag / magnification
+    footprint = int(round(patch_size * downsample))
+    patch_level = 0
+    for level in range(1, wsi.level_count):
+        level_downsample = wsi.level_downsamples[level]
+        if level_downsample > downsample * 1.001:
+            break
+        if float(level_downsample).is_integer() and footprint % int(level_downsample) == 0:
+            patch_level = level
+    return patch_level, footprint // int(wsi.level_downsamples[patch_level]), footprint
+
+def plan_scale_regions(coords, footprints, region_size):
+    """
+    Group patches of several magnifications into square regions of region_size level 0 pixels, by top left corner,
+    so every region can be read once and all its patches cut out of it.
+    args:
+        coords: list of (n_m, 2) level 0 coords, one per magnification
+        footprints: patch size of every magnification in level 0 pixels
+    returns:
+        list of (x0, y0, x1, y1, members), members being [(magnification index, patch indices)], in row-major order
+    """
+    keys, mags, idxs = [], [], []
+    for mag_idx, mag_coords in enumerate(coords):
+        mag_coords = np.asarray(mag_coords).reshape(-1, 2).astype(np.int64)
+        keys.append(mag_coords // region_size)
+        mags.append(np.full(len(mag_coords), mag_idx))
+        idxs.append(np.arange(len(mag_coords)))
+    if sum(len(k) for k in keys) == 0:
+        return []
+    keys, mags, idxs = np.concatenate(keys), np.concatenate(mags), np.concatenate(idxs)
+    all_coords = np.concatenate([np.asarray(c).reshape(-1, 2) for c in coords]).astype(np.int64)
+    sizes = np.asarray(footprints, dtype=np.int64)[mags]
+
+    # row-major over regions, magnification and patch order within a region
+    order = np.lexsort((idxs, mags, keys[:, 0], keys[:, 1]))
+    keys, mags, idxs, all_coords, sizes = keys[order], mags[order], idxs[order], all_coords[order], sizes[order]
+    bounds = np.flatnonzero(np.any(np.diff(keys, axis=0) != 0, axis=1)) + 1
+    regions = []
+    for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(keys)]):
+        x0, y0 = all_coords[start:stop].min(axis=0)
+        x1, y1 = (all_coords[start:stop] + sizes[start:stop, None]).max(axis=0)
+        members = [(int(mag_idx), idxs[start:stop][mags[start:stop] == mag_idx]) for mag_idx in np.unique(mags[start:stop])]
+        regions.append((int(x0), int(y0), int(x1), int(y1), members))
+    return regions
+
+def read_region_tiled(wsi, location, level, size, tile_size=4096):
+    """
+    RGB array equal to np.array(wsi.read_region(location, level, size).convert('RGB')), read tile_size pixels at a time
+    so a single read (RGBA, then converted) never holds more than one tile
+    """
+    w, h = int(size[0]), int(size[1])
+    downsample = wsi.level_downsamples[level]
+    region = np.empty((h, w, 3), dtype=np.uint8)
+    for y in range(0, h, tile_size):
+        for x in range(0, w, tile_size):
+            tw, th = min(tile_size, w - x), min(tile_size, h - y)
+            tile_location = (int(location[0] + round(x * downsample)), int(location[1] + round(y * downsample)))
+            region[y:y + th, x:x + tw] = np.array(wsi.read_region(tile_location, level, (tw, th)).convert('RGB'))
+    return region
+
+class Region_Pyramid(object):
+    '''
+    A region read into memory and copies of it halved step by step, built on demand, so patches of low magnifications
+    are cut from a copy close to their output size instead of resized from full resolution crops.
+    args:
+        region (h, w, 3): the region
+        downsample (float): level 0 pixels per region pixel
+    '''
+    def __init__(self, region, downsample):
+        self.levels = [region]
+        self.downsamples = [downsample]
+
+    def level_for(self, max_downsample):
+        """
+        (array, downsample) of the smallest copy whose downsample does not exceed max_downsample
+        """
+        while self.downsamples[-1] * 2 <= max_downsample and min(self.levels[-1].shape[:2]) >= 2:
+            prev = self.levels[-1]
+            h, w = prev.shape[0] // 2, prev.shape[1] // 2
+            # even crop, so pixel i of the copy averages exactly pixels 2i and 2i + 1
+            self.levels.append(cv2.resize(prev[:2 * h, :2 * w], (w, h), interpolation=cv2.INTER_AREA))
+            self.downsamples.append(self.downsamples[-1] * 2)
+        return self.levels[-1], self.downsamples[-1]
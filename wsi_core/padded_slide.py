@@ -0,0 +1,100 @@
+import h5py
+import numpy as np
+from PIL import Image
+
+class Padded_Slide(object):
+    '''
+    OpenSlide-like view of a slide placed on a larger background canvas, without writing anything to disk.
+    Level 0 coordinates are those of the canvas: the slide starts at (pad_left, pad_top), regions (partly) outside
+    it are filled with the background colour. Levels and downsamples are those of the slide.
+    args:
+        slide: openslide.OpenSlide (or Pyramid_Slide)
+        pad_left, pad_top (int): position of the slide on the canvas, in level 0 pixels
+        width, height (int): canvas size in level 0 pixels
+        fill: background colour
+    '''
+    def __init__(self, slide, pad_left, pad_top, width, height, fill=(255, 255, 255)):
+        self.slide = slide
+        self.pad_left, self.pad_top = int(pad_left), int(pad_top)
+        self.fill = tuple(fill) + (255, )
+
+        self.dimensions = (int(width), int(height))
+        self.level_count = slide.level_count
+        self.level_downsamples = tuple(slide.level_downsamples)
+        self.level_dimensions = tuple((int(width / downsample), int(height / downsample)) for downsample in self.level_downsamples)
+
+        properties = {key: val for key, val in slide.properties.items() if not key.startswith('openslide.bounds-')}
+        for level, (w, h) in enumerate(self.level_dimensions):
+            properties['openslide.level[{}].width'.format(level)] = str(w)
+            properties['openslide.level[{}].height'.format(level)] = str(h)
+        self.properties = properties
+
+    @property
+    def associated_images(self):
+        return self.slide.associated_images
+
+    @classmethod
+    def to_min_size(cls, slide, min_size, **kwargs):
+        """
+        slide centred on a canvas at least min_size wide and high, the slide itself if it is large enough
+        """
+        current_width, current_height = slide.dimensions
+        if min(current_width, current_height) >= min_size:
+            return slide
+        pad_left = max(0, (min_size - current_width) // 2)
+        pad_right = max(0, min_size - current_width - pad_left)
+        pad_top = max(0, (min_size - current_height) // 2)
+        pad_bottom = max(0, min_size - current_height - pad_top)
+        return cls(slide, pad_left, pad_top, current_width + pad_left + pad_right, current_height + pad_top + pad_bottom, **kwargs)
+
+    def padding_attrs(self):
+        """
+        h5 attrs to reopen the same canvas with padding_from_attrs
+        """
+        return {'pad_offset': (self.pad_left, self.pad_top), 'padded_dimensions': self.dimensions}
+
+    def get_best_level_for_downsample(self, downsample):
+        return self.slide.get_best_level_for_downsample(downsample)
+
+    def read_region(self, location, level, size):
+        x, y = int(location[0]) - self.pad_left, int(location[1]) - self.pad_top
+        w, h = int(size[0]), int(size[1])
+        downsample = self.level_downsamples[level]
+        slide_w, slide_h = self.slide.dimensions
+        if x >= 0 and y >= 0 and x + w * downsample <= slide_w and y + h * downsample <= slide_h:
+            return self.slide.read_region((x, y), level, (w, h))
+        # OpenSlide returns transparent pixels outside the slide, those on the canvas become background
+        # (outside the canvas they stay transparent, as for any slide)
+        region = np.array(self.slide.read_region((x, y), level, (w, h)))
+        canvas_w, canvas_h = self.dimensions
+        in_canvas_x = (int(location[0]) + np.arange(w) * downsample >= 0) & (int(location[0]) + np.arange(w) * downsample < canvas_w)
+        in_canvas_y = (int(location[1]) + np.arange(h) * downsample >= 0) & (int(location[1]) + np.arange(h) * downsample < canvas_h)
+        background = (region[..., 3] == 0) & in_canvas_y[:, None] & in_canvas_x[None, :]
+        region[background] = self.fill
+        region[..., 3][in_canvas_y[:, None] & in_canvas_x[None, :]] = 255
+        return Image.fromarray(region, 'RGBA')
+
+    def get_thumbnail(self, size):
+        # as OpenSlide.get_thumbnail
+        downsample = max(dim / thumb for dim, thumb in zip(self.dimensions, size))
+        level = self.get_best_level_for_downsample(downsample)
+        thumb = self.read_region((0, 0), level, self.level_dimensions[level]).convert('RGB')
+        thumb.thumbnail(size, Image.LANCZOS)
+        return thumb
+
+    def close(self):
+        self.slide.close()
+
+def padding_from_attrs(attrs):
+    """
+    Padded_Slide arguments recorded in the attrs of a coords dataset, None if the slide was not padded
+    """
+    if 'pad_offset' not in attrs:
+        return None
+    pad_left, pad_top = attrs['pad_offset']
+    width, height = attrs['padded_dimensions']
+    return {'pad_left': int(pad_left), 'pad_top': int(pad_top), 'width': int(width), 'height': int(height)}
+
+def read_padding(h5_file_path):
+    with h5py.File(h5_file_path, 'r') as f:
+        return padding_from_attrs(f['coords'].attrs)
@@ -0,0 +1,138 @@
+import multiprocessing as mp
+import queue
+import numpy as np
+from wsi_core.util_classes import Contour_Mask
+
+def _patching_worker(task_queue, result_queue):
+    # contour payloads are received once per contour, the mask is only rasterized if this worker gets a chunk of it
+    contours = {}
+    masks = {}
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        if task[0] == 'contour':
+            _, key, payload = task
+            contours.clear()
+            masks.clear()
+            contours[key] = payload
+            continue
+
+        _, key, call_id, chunk_id, coords = task
+        try:
+            cont, holes, cont_check_fn, patch_size, mask_downsample = contours[key]
+            if key not in masks:
+                masks[key] = Contour_Mask(cont, holes, downsample=mask_downsample)
+            result_queue.put((call_id, chunk_id, masks[key].filter_coords(coords, cont_check_fn, patch_size)))
+        except Exception as e:
+            result_queue.put((call_id, chunk_id, e))
+
+
+class Patching_Pool(object):
+    '''
+    Long-lived pool of patching workers shared across contours and slides.
+    Each contour (with its holes and checking fn) is sent to every worker once, candidate coordinates
+    are then dispatched as numpy chunks and the keep masks are reassembled in order. Consecutive calls with the same
+    contour, holes and checking fn objects (e.g. row strips of one contour) reuse the broadcast and the workers' masks.
+    args:
+        num_workers (int): number of worker processes, mp.cpu_count() if None, 0 evaluates in the calling process
+        chunk_size (int): number of candidate coordinates per task
+        poll_timeout (float): seconds between worker liveness checks while waiting for results
+    '''
+    def __init__(self, num_workers=None, chunk_size=65536, poll_timeout=5):
+        if num_workers is None:
+            num_workers = mp.cpu_count()
+        self.num_workers = max(0, int(num_workers))
+        self.chunk_size = chunk_size
+        self.poll_timeout = poll_timeout
+        self._key = 0
+        self._call_id = 0
+        self._payload = None
+
+        self.result_queue = mp.Queue()
+        self.task_queues = []
+        self.workers = []
+        for _ in range(self.num_workers):
+            task_queue = mp.Queue()
+            worker = mp.Process(target=_patching_worker, args=(task_queue, self.result_queue), daemon=True)
+            worker.start()
+            self.task_queues.append(task_queue)
+            self.workers.append(worker)
+
+    def filter_coords(self, cont, holes, coords, cont_check_fn, patch_size, mask_downsample=None):
+        """
+        Boolean keep mask over coords, same result as Contour_Mask(cont, holes).filter_coords(coords, cont_check_fn, patch_size)
+        """
+        coords = np.asarray(coords).reshape(-1, 2)
+        # not worth the round trip for small contours
+        if self.num_workers == 0 or len(coords) <= self.chunk_size:
+            return Contour_Mask(cont, holes, downsample=mask_downsample).filter_coords(coords, cont_check_fn, patch_size)
+
+        payload = (cont, holes, cont_check_fn, patch_size, mask_downsample)
+        if self._payload is None or any(a is not b for a, b in zip(payload, self._payload)):
+            self._key += 1
+            self._payload = payload
+            for task_queue in self.task_queues:
+                task_queue.put(('contour', self._key, payload))
+
+        self._call_id += 1
+        call_id = self._call_id
+        chunks = [coords[start:start + self.chunk_size] for start in range(0, len(coords), self.chunk_size)]
+        for chunk_id, chunk in enumerate(chunks):
+            self.task_queues[chunk_id % self.num_workers].put(('chunk', self._key, call_id, chunk_id, chunk))
+
+        results = [None] * len(chunks)
+        received = 0
+        while received < len(chunks):
+            try:
+                result_id, chunk_id, keep = self.result_queue.get(timeout=self.poll_timeout)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            # left over from a call that was aborted by a worker error
+            if result_id != call_id:
+                continue
+            received += 1
+            if isinstance(keep, Exception):
+                raise keep
+            results[chunk_id] = keep
+        return np.concatenate(results)
+
+    def _check_workers(self):
+        """
+        Raise if a worker died (OOM killer, segfault), its chunks would never come back. The pool is shut down,
+        later calls evaluate in the calling process
+        """
+        dead = [worker for worker in self.workers if not worker.is_alive()]
+        if len(dead) == 0:
+            return
+        exitcodes = [worker.exitcode for worker in dead]
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+        # chunks queued for the dead workers are never read, do not wait for them at exit
+        for task_queue in self.task_queues:
+            task_queue.cancel_join_thread()
+        self.task_queues = []
+        self.workers = []
+        self.num_workers = 0
+        self._payload = None
+        raise RuntimeError('{} patching worker(s) died (exit codes {})'.format(len(dead), exitcodes))
+
+    def close(self):
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.task_queues = []
+        self.workers = []
+        self.num_workers = 0
+        self._payload = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
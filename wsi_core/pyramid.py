@@ -0,0 +1,202 @@
+import io
+import os
+import shutil
+import inspect
+import tempfile
+import multiprocessing as mp
+
+import cv2
+import numpy as np
+import openslide
+
+def needs_pyramid(wsi, max_read_pixels=1e8, min_downsample=16):
+    """
+    True if the slide has no level small enough to be read whole for segmentation and visualization:
+    its smallest level exceeds max_read_pixels or is downsampled less than min_downsample
+    """
+    w, h = wsi.level_dimensions[-1]
+    return w * h > max_read_pixels or wsi.level_downsamples[-1] < min_downsample
+
+def pyramid_path(slide_path, pyramid_dir):
+    return os.path.join(pyramid_dir, os.path.splitext(os.path.basename(slide_path))[0] + '.pyramid.tif')
+
+def find_pyramid(slide_path, pyramid_dir):
+    """
+    Sidecar pyramid of slide_path in pyramid_dir, None if there is none or it is older than the slide
+    """
+    if pyramid_dir is None:
+        return None
+    path = pyramid_path(slide_path, pyramid_dir)
+    if os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(slide_path):
+        return path
+    return None
+
+def _tiff_write_args(tif, compression, quality):
+    # tifffile before 2022.7.28 (e.g. 2020.2.16 of docs/clam.yaml) has no compressionargs and takes a
+    # (codec, level) tuple as compress, versions before 2020.9.30 name the method save instead of write
+    write = getattr(tif, 'write', None) or tif.save
+    if 'compressionargs' in inspect.signature(write).parameters:
+        return write, {'compression': compression, 'compressionargs': {'level': quality} if compression == 'jpeg' else None}
+    if compression is None:
+        return write, {}
+    return write, {'compress': (compression.upper(), quality) if compression == 'jpeg' else compression.upper()}
+
+def build_pyramid(slide_path, dest_path, factor=4, min_size=512, block_size=4096, compression='jpeg', quality=90):
+    """
+    Write the levels missing below the smallest level of slide_path as a tiled multi-resolution TIFF, each level
+    factor times smaller than the previous one down to min_size pixels. Levels are built block by block through
+    memory maps, so the slide never has to fit in memory. Needs tifffile (and imagecodecs for jpeg).
+    """
+    import tifffile
+
+    # a missing codec (e.g. imagecodecs for jpeg) only shows when writing, find out before building the levels
+    with tifffile.TiffWriter(io.BytesIO(), bigtiff=True) as tif:
+        write, compression_kwargs = _tiff_write_args(tif, compression, quality)
+        write(np.zeros((16, 16, 3), dtype=np.uint8), tile=(16, 16), photometric='rgb', **compression_kwargs)
+
+    wsi = openslide.open_slide(slide_path)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(dest_path)))
+    tmp_path = dest_path + '.tmp'
+    try:
+        src_level = wsi.level_count - 1
+        src_downsample = wsi.level_downsamples[src_level]
+        src_w, src_h = wsi.level_dimensions[src_level]
+
+        levels = []
+        # first level from the slide itself, the following ones from the previous level
+        w, h = src_w // factor, src_h // factor
+        while min(w, h) >= min_size or len(levels) == 0:
+            level = np.lib.format.open_memmap(os.path.join(tmp_dir, '{}.npy'.format(len(levels))), mode='w+', dtype=np.uint8, shape=(h, w, 3))
+            for y in range(0, h, block_size // factor):
+                for x in range(0, w, block_size // factor):
+                    out_w, out_h = min(block_size // factor, w - x), min(block_size // factor, h - y)
+                    if len(levels) == 0:
+                        location = (int(x * factor * src_downsample), int(y * factor * src_downsample))
+                        block = np.array(wsi.read_region(location, src_level, (out_w * factor, out_h * factor)).convert('RGB'))
+                    else:
+                        block = levels[-1][y * factor:(y + out_h) * factor, x * factor:(x + out_w) * factor]
+                    level[y:y + out_h, x:x + out_w] = cv2.resize(block, (out_w, out_h), interpolation=cv2.INTER_AREA)
+            levels.append(level)
+            w, h = w // factor, h // factor
+
+        with tifffile.TiffWriter(tmp_path, bigtiff=True) as tif:
+            write, compression_kwargs = _tiff_write_args(tif, compression, quality)
+            for idx, level in enumerate(levels):
+                write(level, tile=(256, 256), photometric='rgb', subfiletype=0 if idx == 0 else 1, **compression_kwargs)
+        os.replace(tmp_path, dest_path)
+    finally:
+        # the level memmaps are full size, failed builds must not leave them (or a partial tiff) in pyramid_dir
+        wsi.close()
+        levels = level = None
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return dest_path
+
+def _build_pyramid_task(args):
+    slide_path, dest_path = args
+    try:
+        return slide_path, build_pyramid(slide_path, dest_path), None
+    except Exception as e:
+        return slide_path, None, '{}: {}'.format(type(e).__name__, e)
+
+def preflight_pyramids(slide_paths, pyramid_dir, num_workers=4, **kwargs):
+    """
+    Check every slide for usable downsampled levels and build the missing sidecar pyramids in worker processes.
+    Returns {slide_path: sidecar path} for every slide that has one
+    """
+    os.makedirs(pyramid_dir, exist_ok=True)
+    todo = []
+    registered = {}
+    for slide_path in slide_paths:
+        existing = find_pyramid(slide_path, pyramid_dir)
+        if existing is not None:
+            registered[slide_path] = existing
+            continue
+        try:
+            wsi = openslide.open_slide(slide_path)
+        except openslide.OpenSlideError:
+            continue
+        if needs_pyramid(wsi, **kwargs):
+            todo.append((slide_path, pyramid_path(slide_path, pyramid_dir)))
+        wsi.close()
+
+    print('{}/{} slides need a sidecar pyramid'.format(len(todo), len(slide_paths)))
+    if len(todo) > 0:
+        if num_workers > 1 and len(todo) > 1:
+            with mp.Pool(min(num_workers, len(todo))) as pool:
+                results = pool.map(_build_pyramid_task, todo)
+        else:
+            results = [_build_pyramid_task(task) for task in todo]
+        failed = []
+        for slide_path, path, error in results:
+            if path is not None:
+                registered[slide_path] = path
+            else:
+                failed.append((slide_path, error))
+        print('built {}/{} sidecar pyramids'.format(len(todo) - len(failed), len(todo)))
+        if len(failed) > 0:
+            print('building failed for {} slides, they are processed without a pyramid:'.format(len(failed)))
+            for slide_path, error in failed:
+                print('\t{}: {}'.format(slide_path, error))
+    return registered
+
+class Pyramid_Slide(object):
+    '''
+    OpenSlide-like view of a slide extended with the levels of its sidecar pyramid (see build_pyramid).
+    Levels of the slide itself are read from it, the added (smaller) levels from the sidecar.
+    args:
+        slide (openslide.OpenSlide): the original slide
+        sidecar (openslide.OpenSlide): its sidecar pyramid
+    '''
+    def __init__(self, slide, sidecar):
+        self.slide = slide
+        self.sidecar = sidecar
+        self.n_slide_levels = slide.level_count
+
+        w0, h0 = slide.dimensions
+        side_w0, side_h0 = sidecar.dimensions
+        # level 0 coordinates of the slide -> level 0 coordinates of the sidecar
+        self.sidecar_scale = (w0 / side_w0 + h0 / side_h0) / 2
+        self.level_dimensions = tuple(slide.level_dimensions) + tuple(sidecar.level_dimensions)
+        self.level_count = len(self.level_dimensions)
+        # estimated from the dimensions, as OpenSlide does
+        self.level_downsamples = tuple(slide.level_downsamples) + tuple((w0 / w + h0 / h) / 2 for w, h in sidecar.level_dimensions)
+        self.dimensions = slide.dimensions
+        self.associated_images = slide.associated_images
+
+        properties = {key: val for key, val in slide.properties.items() if not key.startswith('openslide.level[')}
+        for level in range(self.level_count):
+            src, src_level = self._source(level)
+            for key in ['width', 'height', 'downsample', 'tile-width', 'tile-height']:
+                val = src.properties.get('openslide.level[{}].{}'.format(src_level, key))
+                if val is not None:
+                    properties['openslide.level[{}].{}'.format(level, key)] = val
+            properties['openslide.level[{}].downsample'.format(level)] = str(self.level_downsamples[level])
+        properties['openslide.level-count'] = str(self.level_count)
+        self.properties = properties
+
+    def _source(self, level):
+        if level < self.n_slide_levels:
+            return self.slide, level
+        return self.sidecar, level - self.n_slide_levels
+
+    def get_best_level_for_downsample(self, downsample):
+        # same rule as OpenSlide: the largest level whose downsample does not exceed the requested one
+        for level in range(1, self.level_count):
+            if downsample < self.level_downsamples[level]:
+                return level - 1
+        return self.level_count - 1
+
+    def read_region(self, location, level, size):
+        if level < self.n_slide_levels:
+            return self.slide.read_region(location, level, size)
+        location = (int(round(location[0] / self.sidecar_scale)), int(round(location[1] / self.sidecar_scale)))
+        return self.sidecar.read_region(location, level - self.n_slide_levels, size)
+
+    def get_thumbnail(self, size):
+        return self.sidecar.get_thumbnail(size)
+
+    def close(self):
+        self.slide.close()
+        self.sidecar.close()
@@ -0,0 +1,133 @@
+import os
+import json
+import numbers
+import hashlib
+
+# bump when segmentTissue changes in a way that invalidates previously cached contours
+SEG_CACHE_VERSION = 1
+
+def _normalize(obj):
+    """
+    Parameters as keyed: numpy scalars and arrays (e.g. keep_ids / exclude_ids) by value, tuples as lists and
+    integral floats as ints, so params read from a csv (8.0) and from the command line or a config (8) give one key
+    """
+    if hasattr(obj, 'tolist'):
+        obj = obj.tolist()
+    if isinstance(obj, dict):
+        return {str(key): _normalize(val) for key, val in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_normalize(val) for val in obj]
+    if isinstance(obj, bool) or obj is None or isinstance(obj, str):
+        return obj
+    if isinstance(obj, numbers.Integral):
+        return int(obj)
+    if isinstance(obj, numbers.Real):
+        return int(obj) if float(obj).is_integer() else float(obj)
+    return str(obj)
+
+def slide_fingerprint(slide_path, header_bytes=2**20):
+    """
+    Identity of a slide file: size, mtime and a hash of its first header_bytes
+    """
+    stat = os.stat(slide_path)
+    sha = hashlib.sha1()
+    with open(slide_path, 'rb') as f:
+        sha.update(f.read(header_bytes))
+    return '{}-{}-{}'.format(stat.st_size, stat.st_mtime_ns, sha.hexdigest())
+
+class Segmentation_Cache(object):
+    '''
+    Content-addressed cache of segmentTissue results (tissue contours and holes).
+    Entries are keyed by the slide fingerprint and the full seg_params / filter_params, and are evicted
+    least recently used first once the cache directory grows beyond max_bytes.
+    args:
+        cache_dir (str): directory holding one .pkl per entry
+        max_bytes (int): size budget for cache_dir, None for no limit
+    '''
+    def __init__(self, cache_dir, max_bytes=2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, slide_path, seg_params, filter_params, **extra):
+        """
+        extra: anything else that changes the contours (segment adds the padding the slide was opened with)
+        """
+        desc = {'version': SEG_CACHE_VERSION, 'slide': slide_fingerprint(slide_path),
+                'seg_params': seg_params, 'filter_params': filter_params, 'extra': extra}
+        desc = json.dumps(_normalize(desc), sort_keys=True)
+        return hashlib.sha1(desc.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def load(self, WSI_object, key):
+        """
+        Restore the segmentation of WSI_object from the cache, returns False on a miss
+        """
+        path = self._path(key)
+        try:
+            WSI_object.initSegmentation(path)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            # truncated or corrupt entry (UnpicklingError, EOFError, ...): drop it and segment again
+            print('removing unreadable segmentation cache entry {}: {!r}'.format(path, e))
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return False
+        # mark as recently used for eviction
+        try:
+            os.utime(path, None)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def save(self, WSI_object, key):
+        path = self._path(key)
+        # write under a unique name first so concurrent workers never see a partial entry
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        WSI_object.saveSegmentation(tmp_path)
+        os.replace(tmp_path, path)
+        self.evict()
+        return path
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith('.pkl'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, file_name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file_name))
+
+        total = sum(entry[1] for entry in entries)
+        for _, size, file_name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, file_name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def segment(self, WSI_object, slide_path, seg_params, filter_params, **extra):
+        """
+        WSI_object.segmentTissue(**seg_params, filter_params=filter_params), served from the cache when possible.
+        Returns True on a cache hit. The padding of WSI_object is part of the key, so every tool opening the slide the
+        same way (create_patches_fp.py, create_heatmaps.py) shares the entry
+        """
+        extra.setdefault('padding', getattr(WSI_object, 'padding', None))
+        key = self.key(slide_path, seg_params, filter_params, **extra)
+        if self.load(WSI_object, key):
+            print('segmentation loaded from cache ({})'.format(key))
+            return True
+        WSI_object.segmentTissue(**seg_params, filter_params=filter_params)
+        self.save(WSI_object, key)
+        return False
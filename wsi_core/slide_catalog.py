@@ -0,0 +1,171 @@
+import os
+import json
+import multiprocessing as mp
+
+import numpy as np
+import openslide
+import pandas as pd
+
+CATALOG_COLUMNS = ['slide_path', 'file_size', 'mtime_ns', 'width', 'height', 'level_count', 'level_dimensions',
+                   'level_downsamples', 'mpp_x', 'mpp_y', 'objective_power', 'vendor', 'properties']
+
+def _float_property(properties, key):
+    try:
+        return float(properties[key])
+    except (KeyError, ValueError):
+        return np.nan
+
+def slide_metadata(slide_path):
+    """
+    Catalog row of one slide: geometry, resolution and the openslide.* properties, None if it cannot be opened
+    """
+    slide_path = os.path.abspath(slide_path)
+    stat = os.stat(slide_path)
+    try:
+        wsi = openslide.open_slide(slide_path)
+    except (openslide.OpenSlideError, openslide.OpenSlideUnsupportedFormatError, OSError) as e:
+        print('skipped {}: {}'.format(slide_path, e))
+        return None
+    # the openslide.* properties cover what the pipeline reads (levels, tiles, resolution), vendor ones can be huge
+    properties = {key: val for key, val in wsi.properties.items() if key.startswith('openslide.') or key == 'aperio.AppMag'}
+    row = {'slide_path': slide_path, 'file_size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+           'width': wsi.dimensions[0], 'height': wsi.dimensions[1], 'level_count': wsi.level_count,
+           'level_dimensions': json.dumps([list(dim) for dim in wsi.level_dimensions]),
+           'level_downsamples': json.dumps(list(wsi.level_downsamples)),
+           'mpp_x': _float_property(properties, openslide.PROPERTY_NAME_MPP_X),
+           'mpp_y': _float_property(properties, openslide.PROPERTY_NAME_MPP_Y),
+           'objective_power': _float_property(properties, openslide.PROPERTY_NAME_OBJECTIVE_POWER),
+           'vendor': properties.get(openslide.PROPERTY_NAME_VENDOR, ''),
+           'properties': json.dumps(properties)}
+    wsi.close()
+    return row
+
+def build_catalog(slide_dirs, catalog_path, slide_ext=None, num_workers=8):
+    """
+    Scan slide_dirs (not recursively) and write the metadata of every slide to the csv catalog_path.
+    Rows of an existing catalog are kept for files whose size and mtime did not change, only the others are opened,
+    in num_workers processes
+    args:
+        slide_ext (str or list): only files with these extensions, every file otherwise
+    """
+    if isinstance(slide_ext, str):
+        slide_ext = [slide_ext]
+    slide_paths = []
+    for slide_dir in slide_dirs:
+        for name in sorted(os.listdir(slide_dir)):
+            path = os.path.abspath(os.path.join(slide_dir, name))
+            if os.path.isfile(path) and (slide_ext is None or os.path.splitext(name)[1] in slide_ext):
+                slide_paths.append(path)
+
+    catalog = Slide_Catalog(catalog_path) if os.path.isfile(catalog_path) else Slide_Catalog()
+    rows, todo = [], []
+    for path in slide_paths:
+        row = catalog.get(path)
+        if row is not None:
+            rows.append(row)
+        else:
+            todo.append(path)
+    print('{}/{} slides to scan'.format(len(todo), len(slide_paths)))
+
+    if num_workers > 1 and len(todo) > 1:
+        with mp.Pool(min(num_workers, len(todo))) as pool:
+            scanned = pool.map(slide_metadata, todo, chunksize=max(1, len(todo) // (num_workers * 4)))
+    else:
+        scanned = [slide_metadata(path) for path in todo]
+    rows.extend(row for row in scanned if row is not None)
+
+    df = pd.DataFrame(rows, columns=CATALOG_COLUMNS)
+    tmp_path = catalog_path + '.tmp'
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, catalog_path)
+    return df
+
+class Slide_Catalog(object):
+    '''
+    Slide metadata written by build_catalog, looked up by slide path. Entries whose file changed (size or mtime)
+    since the scan are treated as missing, so callers fall back to opening the slide.
+    args:
+        catalog_path (str): csv written by build_catalog, None for an empty catalog
+    '''
+    def __init__(self, catalog_path=None):
+        self.catalog_path = catalog_path
+        self.rows = {}
+        self.names = {}
+        if catalog_path is not None:
+            df = pd.read_csv(catalog_path, keep_default_na=False, na_values=[''])
+            for row in df.to_dict('records'):
+                self.rows[row['slide_path']] = row
+                self.names.setdefault(os.path.basename(row['slide_path']), []).append(row)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, slide_path, key=None):
+        """
+        Catalog row of slide_path if it is still current, None otherwise.
+        key: path the slide was catalogued under if slide_path is a copy of it (staged slides keep size and mtime)
+        """
+        try:
+            stat = os.stat(slide_path)
+        except OSError:
+            return None
+        key = os.path.abspath(key if key is not None else slide_path)
+        candidates = [self.rows[key]] if key in self.rows else self.names.get(os.path.basename(key), [])
+        for row in candidates:
+            if int(row['file_size']) == stat.st_size and int(row['mtime_ns']) // 10**9 == int(stat.st_mtime):
+                return row
+        return None
+
+    def open(self, slide_path, key=None):
+        """
+        Lazy_Slide of slide_path when it is catalogued, the opened slide otherwise
+        """
+        row = self.get(slide_path, key)
+        if row is None:
+            return openslide.open_slide(slide_path)
+        return Lazy_Slide(slide_path, row)
+
+class Lazy_Slide(object):
+    '''
+    OpenSlide-like slide answering geometry queries (dimensions, levels, properties, get_best_level_for_downsample)
+    from its catalog row. The file is only opened on the first pixel read.
+    args:
+        slide_path (str): slide file
+        row (dict): its catalog row
+    '''
+    def __init__(self, slide_path, row):
+        self.slide_path = slide_path
+        self.dimensions = (int(row['width']), int(row['height']))
+        self.level_count = int(row['level_count'])
+        self.level_dimensions = tuple(tuple(dim) for dim in json.loads(row['level_dimensions']))
+        self.level_downsamples = tuple(json.loads(row['level_downsamples']))
+        self.properties = json.loads(row['properties'])
+        self._slide = None
+
+    @property
+    def slide(self):
+        if self._slide is None:
+            self._slide = openslide.open_slide(self.slide_path)
+        return self._slide
+
+    @property
+    def associated_images(self):
+        return self.slide.associated_images
+
+    def get_best_level_for_downsample(self, downsample):
+        # same rule as OpenSlide: the largest level whose downsample does not exceed the requested one
+        for level in range(1, self.level_count):
+            if downsample < self.level_downsamples[level]:
+                return level - 1
+        return self.level_count - 1
+
+    def read_region(self, location, level, size):
+        return self.slide.read_region(location, level, size)
+
+    def get_thumbnail(self, size):
+        return self.slide.get_thumbnail(size)
+
+    def close(self):
+        if self._slide is not None:
+            self._slide.close()
+            self._slide = None
@@ -0,0 +1,296 @@
+import tempfile
+import multiprocessing as mp
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+class Slide_Reader(object):
+    '''
+    Drop-in wrapper around an openslide.OpenSlide whose read_region assembles regions from decoded tiles aligned
+    to the file's native tile grid, kept in a byte-bounded LRU cache, so overlapping reads decode each tile once.
+    Reads that cannot be served exactly from whole tiles (non-integer downsamples, locations off the level grid,
+    untiled levels) or that are too large for the cache go straight to OpenSlide.
+    Everything else (level_dimensions, properties, get_best_level_for_downsample, ...) is forwarded to the slide.
+    Counters live in shared memory so reads made in forked DataLoader workers are included.
+    args:
+        slide (openslide.OpenSlide): opened slide
+        cache_bytes (int): budget for decoded tiles, 0 disables the cache
+    '''
+    def __init__(self, slide, cache_bytes=256*2**20):
+        self.slide = slide
+        self.cache_bytes = cache_bytes
+        self._tiles = OrderedDict()
+        self._cached_bytes = 0
+        # reads, tile hits, tiles decoded, bytes decoded
+        self._counters = mp.Array('q', 4)
+
+    def __getattr__(self, name):
+        if name == 'slide':
+            raise AttributeError(name)
+        return getattr(self.slide, name)
+
+    def _count(self, reads=0, hits=0, decoded=0, nbytes=0):
+        with self._counters.get_lock():
+            self._counters[0] += reads
+            self._counters[1] += hits
+            self._counters[2] += decoded
+            self._counters[3] += nbytes
+
+    def _tile_size(self, level):
+        props = self.slide.properties
+        tile_w = props.get('openslide.level[{}].tile-width'.format(level))
+        tile_h = props.get('openslide.level[{}].tile-height'.format(level))
+        if tile_w is None or tile_h is None:
+            return None
+        return int(tile_w), int(tile_h)
+
+    def _get_tile(self, level, tx, ty, tile_w, tile_h, downsample):
+        key = (level, tx, ty)
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self._tiles.move_to_end(key)
+            self._count(hits=1)
+            return tile
+
+        location = (int(tx * tile_w * downsample), int(ty * tile_h * downsample))
+        tile = np.array(self.slide.read_region(location, level, (tile_w, tile_h)))
+        self._count(decoded=1, nbytes=tile.nbytes)
+        self._tiles[key] = tile
+        self._cached_bytes += tile.nbytes
+        while self._cached_bytes > self.cache_bytes and len(self._tiles) > 1:
+            _, evicted = self._tiles.popitem(last=False)
+            self._cached_bytes -= evicted.nbytes
+        return tile
+
+    def read_region(self, location, level, size):
+        x, y = int(location[0]), int(location[1])
+        w, h = int(size[0]), int(size[1])
+        self._count(reads=1)
+
+        downsample = self.slide.level_downsamples[level]
+        tile_size = self._tile_size(level) if self.cache_bytes > 0 else None
+        exact = tile_size is not None and float(downsample).is_integer()
+        if exact:
+            downsample = int(downsample)
+            exact = x % downsample == 0 and y % downsample == 0
+
+        if exact:
+            tile_w, tile_h = tile_size
+            lx, ly = x // downsample, y // downsample
+            tx0, ty0 = lx // tile_w, ly // tile_h
+            tx1, ty1 = (lx + w - 1) // tile_w, (ly + h - 1) // tile_h
+            # leave room for the rest of the cache, larger reads would only evict it
+            exact = (tx1 - tx0 + 1) * (ty1 - ty0 + 1) * tile_w * tile_h * 4 <= self.cache_bytes // 2
+
+        if not exact:
+            region = self.slide.read_region((x, y), level, (w, h))
+            self._count(nbytes=w * h * 4)
+            return region
+
+        region = np.empty((h, w, 4), dtype=np.uint8)
+        for ty in range(ty0, ty1 + 1):
+            for tx in range(tx0, tx1 + 1):
+                tile = self._get_tile(level, tx, ty, tile_w, tile_h, downsample)
+                # overlap of this tile with the requested region, in level pixels
+                x0, y0 = max(lx, tx * tile_w), max(ly, ty * tile_h)
+                x1, y1 = min(lx + w, (tx + 1) * tile_w), min(ly + h, (ty + 1) * tile_h)
+                region[y0 - ly:y1 - ly, x0 - lx:x1 - lx] = tile[y0 - ty * tile_h:y1 - ty * tile_h, x0 - tx * tile_w:x1 - tx * tile_w]
+        return Image.fromarray(region, 'RGBA')
+
+    def stats(self):
+        reads, hits, decoded, nbytes = self._counters[:]
+        return {'reads': reads, 'tiles_decoded': decoded, 'tile_hits': hits,
+                'hit_rate': hits / max(hits + decoded, 1), 'bytes_decoded': nbytes}
+
+    def reset_stats(self):
+        with self._counters.get_lock():
+            self._counters[:] = [0, 0, 0, 0]
+
+    def clear_cache(self):
+        self._tiles.clear()
+        self._cached_bytes = 0
+
+    def close(self):
+        self.clear_cache()
+        self.slide.close()
+
+def format_read_stats(stats):
+    return 'reads: {}, tiles decoded: {}, tile cache hit rate: {:.2%}, decoded: {:.1f} MB'.format(
+        stats['reads'], stats['tiles_decoded'], stats['hit_rate'], stats['bytes_decoded'] / 2**20)
+
+def plan_region_reads(coords, patch_size, downsample, group_size=8):
+    """
+    Group consecutive coords (level 0) that run along one row (same y) or one column (same x), each step
+    no larger than a patch, into super-regions of at most group_size patches read with a single read_region.
+    Patches inside a region sit a whole number of level pixels from its origin, so slicing them out gives
+    the same pixels as reading them one by one.
+    args:
+        patch_size: (w, h) read at the level, in level pixels
+        downsample: downsample of the level
+    returns:
+        group_idx (n,): region of every coord
+        offsets (n, 2): (x, y) of every patch inside its region, in level pixels
+        regions (m, 4): x, y (level 0) and w, h (level pixels) of every region
+    """
+    coords = np.asarray(coords).reshape(-1, 2).astype(np.int64)
+    n = len(coords)
+    group_idx = np.zeros(n, dtype=np.int64)
+    offsets = np.zeros((n, 2), dtype=np.int64)
+    regions = []
+    if n == 0:
+        return group_idx, offsets, np.zeros((0, 4), dtype=np.int64)
+
+    if not float(downsample).is_integer():
+        group_size = 1
+    downsample = int(round(downsample))
+    ref_w, ref_h = patch_size[0] * downsample, patch_size[1] * downsample
+
+    pts = coords.tolist()
+    start, axis = 0, None
+    for i in range(1, n + 1):
+        extend = False
+        if i < n and i - start < group_size:
+            dx, dy = pts[i][0] - pts[i - 1][0], pts[i][1] - pts[i - 1][1]
+            if dy == 0 and 0 < dx <= ref_w and dx % downsample == 0 and axis in (None, 0):
+                extend, next_axis = True, 0
+            elif dx == 0 and 0 < dy <= ref_h and dy % downsample == 0 and axis in (None, 1):
+                extend, next_axis = True, 1
+        if extend:
+            axis = next_axis
+            continue
+
+        x0, y0 = pts[start]
+        x1, y1 = pts[i - 1]
+        group_idx[start:i] = len(regions)
+        offsets[start:i] = (coords[start:i] - coords[start]) // downsample
+        regions.append((x0, y0, (x1 - x0) // downsample + patch_size[0], (y1 - y0) // downsample + patch_size[1]))
+        start, axis = i, None
+    return group_idx, offsets, np.array(regions, dtype=np.int64)
+
+class Grouped_Patch_Reader(object):
+    '''
+    Serves patches from super-regions planned by plan_region_reads, keeping the last region read so consecutive
+    indices (as handed out by a sequential DataLoader) share one read_region. group_size trades memory for reads.
+    args:
+        wsi: OpenSlide or Slide_Reader
+        coords (n, 2): level 0 coordinates, in the order patches will be requested
+        level (int): level to read at
+        patch_size: (w, h) in level pixels
+        group_size (int): max number of patches per read, 1 reads every patch on its own
+    '''
+    def __init__(self, wsi, coords, level, patch_size, group_size=8):
+        self.wsi = wsi
+        self.level = level
+        self.patch_size = (int(patch_size[0]), int(patch_size[1]))
+        self.group_idx, self.offsets, self.regions = plan_region_reads(coords, self.patch_size,
+                                                                       wsi.level_downsamples[level], group_size)
+        self._region_id = None
+        self._region = None
+
+    def read(self, idx):
+        """
+        RGB numpy view of patch idx, equal to np.array(wsi.read_region(coords[idx], level, patch_size).convert('RGB'))
+        """
+        region_id = self.group_idx[idx]
+        if region_id != self._region_id:
+            x, y, w, h = self.regions[region_id]
+            self._region = np.array(self.wsi.read_region((int(x), int(y)), self.level, (int(w), int(h))).convert('RGB'))
+            self._region_id = region_id
+        ox, oy = self.offsets[idx]
+        return self._region[oy:oy + self.patch_size[1], ox:ox + self.patch_size[0]]
+
+class Level_Array_Reader(object):
+    '''
+    Reads the bounding box of all patches at the patch level once, block by block, into a memory-mapped array
+    (an unlinked temporary file, so forked DataLoader workers share it) and serves patches as slices of it.
+    Only valid when every coord sits a whole number of level pixels from the box origin, see can_use.
+    args:
+        wsi: OpenSlide or Slide_Reader
+        coords (n, 2): level 0 coordinates
+        level (int): level to read at
+        patch_size: (w, h) in level pixels
+        block_size (int): size of the blocks the box is read in
+    '''
+    def __init__(self, wsi, coords, level, patch_size, block_size=4096):
+        coords = np.asarray(coords).reshape(-1, 2).astype(np.int64)
+        self.patch_size = (int(patch_size[0]), int(patch_size[1]))
+        downsample = int(wsi.level_downsamples[level])
+        x0, y0 = coords.min(axis=0)
+        self.offsets = (coords - np.array([x0, y0])) // downsample
+        w, h = self.offsets.max(axis=0) + np.array(self.patch_size)
+
+        self._file = tempfile.TemporaryFile()
+        self.region = np.memmap(self._file, dtype=np.uint8, mode='w+', shape=(int(h), int(w), 3))
+        for y in range(0, h, block_size):
+            for x in range(0, w, block_size):
+                bw, bh = min(block_size, w - x), min(block_size, h - y)
+                location = (int(x0 + x * downsample), int(y0 + y * downsample))
+                self.region[y:y + bh, x:x + bw] = np.array(wsi.read_region(location, level, (int(bw), int(bh))).convert('RGB'))
+
+    @staticmethod
+    def estimate_bytes(coords, level_downsample, patch_size):
+        coords = np.asarray(coords).reshape(-1, 2)
+        if len(coords) == 0:
+            return 0
+        w, h = (coords.max(axis=0) - coords.min(axis=0)) / level_downsample + np.array(patch_size)
+        return int(w) * int(h) * 3
+
+    @staticmethod
+    def can_use(coords, level_downsample):
+        coords = np.asarray(coords).reshape(-1, 2)
+        if len(coords) == 0 or not float(level_downsample).is_integer():
+            return False
+        return bool(np.all((coords - coords.min(axis=0)) % int(level_downsample) == 0))
+
+    def read(self, idx):
+        ox, oy = self.offsets[idx]
+        return self.region[oy:oy + self.patch_size[1], ox:ox + self.patch_size[0]]
+
+def patch_reader(wsi, coords, level, patch_size, group_size=8, memory_budget=512*2**20, min_density=0.25):
+    """
+    Level_Array_Reader when the patches' bounding box at the level fits in memory_budget and the patches cover
+    at least min_density of it (sparse samples are cheaper to read patch by patch), Grouped_Patch_Reader otherwise
+    """
+    downsample = wsi.level_downsamples[level]
+    if memory_budget and Level_Array_Reader.can_use(coords, downsample):
+        box_bytes = Level_Array_Reader.estimate_bytes(coords, downsample, patch_size)
+        patch_bytes = len(coords) * patch_size[0] * patch_size[1] * 3
+        if box_bytes <= memory_budget and patch_bytes >= min_density * box_bytes:
+            return Level_Array_Reader(wsi, coords, level, patch_size)
+    return Grouped_Patch_Reader(wsi, coords, level, patch_size, group_size)
+
+def objective_power(wsi):
+    """
+    Scanning magnification from the slide properties, None if the slide does not record it
+    """
+    for key in ['openslide.objective-power', 'aperio.AppMag']:
+        power = wsi.properties.get(key)
+        if power is not None:
+            try:
+                return float(power)
+            except ValueError:
+                pass
+    return None
+
+def plan_read_level(wsi, level, size, out_size):
+    """
+    Level to read a patch of size (pixels at level) from when it is resized to out_size afterwards: the coarsest
+    level that still has at least out_size pixels across the patch, so only the remainder is left to resize.
+    returns:
+        read_level (int), read_size (w, h) in pixels at read_level, out_downsample: output pixel size in level 0 pixels
+    """
+    downsample = wsi.level_downsamples[level]
+    ref_w, ref_h = size[0] * downsample, size[1] * downsample
+    out_downsample = min(ref_w / out_size[0], ref_h / out_size[1])
+    read_level = level
+    for candidate in range(level + 1, wsi.level_count):
+        # level downsamples are estimated from the dimensions, allow for their rounding
+        if wsi.level_downsamples[candidate] > out_downsample * 1.001:
+            break
+        read_level = candidate
+    read_downsample = wsi.level_downsamples[read_level]
+    read_size = (max(int(round(ref_w / read_downsample)), out_size[0]), max(int(round(ref_h / read_downsample)), out_size[1]))
+    if read_level == level:
+        read_size = (int(size[0]), int(size[1]))
+    return read_level, read_size, out_downsample
@@ -0,0 +1,182 @@
+import os
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+class Slide_Stager(object):
+    '''
+    Copies slides from slow (network mounted) storage to a local scratch directory ahead of use.
+    After schedule(paths), every local_path(path) call returns the staged copy of path, waiting for its copy if
+    needed, and starts copying the next prefetch slides of the schedule in background threads.
+    Staged copies are evicted least recently used first to stay within max_bytes, copies left in stage_dir by
+    earlier runs count towards the budget (oldest access first) and are reused when they still match; slides that cannot be staged
+    (larger than the budget, or multi-file formats such as .mrxs with a data directory) are read in place.
+    args:
+        stage_dir (str): local scratch directory
+        max_bytes (int): disk budget for staged slides
+        prefetch (int): number of upcoming slides to copy in the background
+        num_threads (int): concurrent copies
+    '''
+    def __init__(self, stage_dir, max_bytes=50*2**30, prefetch=2, num_threads=2):
+        self.stage_dir = stage_dir
+        self.max_bytes = max_bytes
+        self.prefetch = prefetch
+        os.makedirs(stage_dir, exist_ok=True)
+
+        self._executor = ThreadPoolExecutor(max_workers=max(1, num_threads))
+        self._lock = threading.Lock()
+        self._staged = OrderedDict()  # src path -> (local path, size), least recently used first
+        self._pending = {}  # src path -> future
+        self._reserved = 0  # bytes of copies in flight
+        self._schedule = []
+        self._scan()
+
+    def _scan(self):
+        # files of earlier runs are tracked under their local path until a slide staged to it claims them
+        leftovers = []
+        for root, _, file_names in os.walk(self.stage_dir):
+            for file_name in file_names:
+                local_path = os.path.join(root, file_name)
+                try:
+                    if file_name.endswith('.part'):
+                        os.remove(local_path)
+                        continue
+                    stat = os.stat(local_path)
+                except FileNotFoundError:
+                    continue
+                leftovers.append((stat.st_atime, local_path, stat.st_size))
+        for _, local_path, size in sorted(leftovers):
+            self._staged[local_path] = (local_path, size)
+        with self._lock:
+            self._evict(0, set())
+
+    def _dest(self, src_path):
+        # keep the file name so slide names derived from it are unchanged, the parent folder avoids collisions
+        src_path = os.path.abspath(src_path)
+        folder = hashlib.sha1(os.path.dirname(src_path).encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.stage_dir, folder, os.path.basename(src_path))
+
+    def _stageable(self, src_path):
+        if not os.path.isfile(src_path):
+            return False
+        if os.path.isdir(os.path.splitext(src_path)[0]):
+            return False
+        return os.path.getsize(src_path) <= self.max_bytes
+
+    def _evict(self, needed, keep):
+        # called with the lock held
+        used = sum(size for _, size in self._staged.values()) + self._reserved
+        for src_path in list(self._staged.keys()):
+            if used + needed <= self.max_bytes:
+                break
+            if src_path in keep:
+                continue
+            local_path, size = self._staged.pop(src_path)
+            try:
+                os.remove(local_path)
+            except FileNotFoundError:
+                pass
+            used -= size
+        return used + needed <= self.max_bytes
+
+    def _copy(self, src_path):
+        src_stat = os.stat(src_path)
+        size = src_stat.st_size
+        dest_path = self._dest(src_path)
+        with self._lock:
+            # a leftover at dest_path is either reused or overwritten, it is accounted for by the reservation below
+            leftover = self._staged.pop(dest_path, None)
+            keep = set(self._pending.keys()) | set(self._schedule[:1])
+            if not self._evict(size, keep):
+                self._pending.pop(src_path, None)
+                if leftover is not None:
+                    os.remove(dest_path)
+                return src_path
+            self._reserved += size
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        # a copy left by an earlier run is reused if it still matches the source
+        try:
+            if not (os.path.isfile(dest_path) and os.path.getsize(dest_path) == size
+                    and int(os.path.getmtime(dest_path)) == int(src_stat.st_mtime)):
+                tmp_path = dest_path + '.part'
+                # copy2 keeps mtime, so fingerprints (e.g. the segmentation cache) match the source slide
+                shutil.copy2(src_path, tmp_path)
+                os.replace(tmp_path, dest_path)
+        except OSError:
+            with self._lock:
+                self._reserved -= size
+                self._pending.pop(src_path, None)
+            raise
+        with self._lock:
+            self._reserved -= size
+            self._staged[src_path] = (dest_path, size)
+            self._pending.pop(src_path, None)
+        return dest_path
+
+    def _submit(self, src_path):
+        # called with the lock held
+        if src_path in self._staged or src_path in self._pending or not self._stageable(src_path):
+            return
+        self._pending[src_path] = self._executor.submit(self._copy, src_path)
+
+    def schedule(self, src_paths):
+        """
+        Order in which slides will be requested, prefetching starts with the first ones
+        """
+        with self._lock:
+            self._schedule = list(src_paths)
+            for src_path in self._schedule[:self.prefetch]:
+                self._submit(src_path)
+
+    def local_path(self, src_path):
+        """
+        Path to open instead of src_path
+        """
+        with self._lock:
+            if src_path in self._schedule:
+                pos = self._schedule.index(src_path)
+                upcoming = self._schedule[pos + 1:pos + 1 + self.prefetch]
+                self._schedule = self._schedule[pos:]
+            else:
+                upcoming = []
+            if src_path in self._staged:
+                self._staged.move_to_end(src_path)
+                local_path = self._staged[src_path][0]
+                future = None
+            else:
+                self._submit(src_path)
+                future = self._pending.get(src_path)
+            for next_path in upcoming:
+                self._submit(next_path)
+
+        if future is not None:
+            try:
+                local_path = future.result()
+            except OSError as e:
+                print('staging {} failed ({}), reading it in place'.format(src_path, e))
+                local_path = src_path
+            with self._lock:
+                self._pending.pop(src_path, None)
+                if src_path in self._staged:
+                    self._staged.move_to_end(src_path)
+        elif src_path not in self._staged:
+            local_path = src_path
+        return local_path
+
+    def close(self, remove=False):
+        self._executor.shutdown(wait=True)
+        if remove:
+            for local_path, _ in self._staged.values():
+                try:
+                    os.remove(local_path)
+                except FileNotFoundError:
+                    pass
+            self._staged.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -50,6 +50,10 @@ class Contour_Checking_fn(object):
 	def __call__(self, pt): 
 		raise NotImplementedError
 
+	# points tested for every candidate as an (n, k, 2) array, and whether all k (True) or any (False) must be inside
+	def test_points(self, coords):
+		raise NotImplementedError
+
 class isInContourV1(Contour_Checking_fn):
 	def __init__(self, contour):
 		self.cont = contour
@@ -57,6 +61,9 @@ class isInContourV1(Contour_Checking_fn):
 	def __call__(self, pt): 
 		return 1 if cv2.pointPolygonTest(self.cont, tuple(np.array(pt).astype(float)), False) >= 0 else 0
 
+	def test_points(self, coords):
+		return coords[:, np.newaxis, :], False
+
 class isInContourV2(Contour_Checking_fn):
 	def __init__(self, contour, patch_size):
 		self.cont = contour
@@ -66,6 +73,18 @@ class isInContourV2(Contour_Checking_fn):
 		pt = np.array((pt[0]+self.patch_size//2, pt[1]+self.patch_size//2)).astype(float)
 		return 1 if cv2.pointPolygonTest(self.cont, tuple(np.array(pt).astype(float)), False) >= 0 else 0
 
+	def test_points(self, coords):
+		return (coords + self.patch_size//2)[:, np.newaxis, :], False
+
+# vectorized counterpart of the 4pt point layout used by isInContourV3_Easy / isInContourV3_Hard
+def _four_points(coords, patch_size, shift):
+	center = coords + patch_size//2
+	if shift > 0:
+		offsets = np.array([[-shift, -shift], [shift, shift], [shift, -shift], [-shift, shift]])
+	else:
+		offsets = np.zeros((1, 2), dtype=int)
+	return center[:, np.newaxis, :] + offsets[np.newaxis, :, :]
+
 # Easy version of 4pt contour checking function - 1 of 4 points need to be in the contour for test to pass
 class isInContourV3_Easy(Contour_Checking_fn):
 	def __init__(self, contour, patch_size, center_shift=0.5):
@@ -88,6 +107,9 @@ class isInContourV3_Easy(Contour_Checking_fn):
 				return 1
 		return 0
 
+	def test_points(self, coords):
+		return _four_points(coords, self.patch_size, self.shift), False
+
 # Hard version of 4pt contour checking function - all 4 points need to be in the contour for test to pass
 class isInContourV3_Hard(Contour_Checking_fn):
 	def __init__(self, contour, patch_size, center_shift=0.5):
@@ -110,6 +132,96 @@ class isInContourV3_Hard(Contour_Checking_fn):
 				return 0
 		return 1
 
+	def test_points(self, coords):
+		return _four_points(coords, self.patch_size, self.shift), True
+
+
+class Contour_Mask(object):
+	"""
+	Rasterized membership test for one tissue contour and its holes.
+
+	The contour (and the union of its holes) is drawn once into a mask at 1/downsample of level 0, together with
+	a band of cells crossed by the polygon edges. Candidates falling outside the band are answered by indexing the
+	mask; the few falling inside it are resolved with cv2.pointPolygonTest, so results match the per-point checks
+	of the Contour_Checking_fn classes exactly.
 
+	args:
+		contour: tissue contour (level 0 coordinates)
+		holes: list of hole contours belonging to this tissue contour
+		downsample (int): mask cell size in level 0 pixels, chosen from max_mask_size if None
+		max_mask_size (int): largest mask side used when picking downsample automatically
+	"""
+	def __init__(self, contour, holes=None, downsample=None, max_mask_size=4096):
+		self.contour = contour
+		self.holes = [] if holes is None else list(holes)
+
+		x, y, w, h = cv2.boundingRect(np.concatenate([contour] + self.holes).astype(np.int32))
+		if downsample is None:
+			downsample = max(1, int(np.ceil(max(w, h) / max_mask_size)))
+		self.downsample = int(downsample)
+
+		# pad so that cells next to the bounding box are still covered by the edge band
+		pad = 4
+		self.origin = np.array([x - pad * self.downsample, y - pad * self.downsample])
+		self.shape = (h // self.downsample + 2 * pad + 1, w // self.downsample + 2 * pad + 1)
+
+		self.inside, self.edge = self._rasterize([contour])
+		if len(self.holes) > 0:
+			self.hole_inside, self.hole_edge = self._rasterize(self.holes)
+
+	def _rasterize(self, polygons):
+		inside = np.zeros(self.shape, dtype=np.uint8)
+		edge = np.zeros(self.shape, dtype=np.uint8)
+		for polygon in polygons:
+			scaled = ((np.asarray(polygon).reshape(-1, 2) - self.origin) // self.downsample).astype(np.int32).reshape(-1, 1, 2)
+			cv2.drawContours(inside, [scaled], -1, 1, thickness=-1)
+			cv2.drawContours(edge, [scaled], -1, 1, thickness=1)
+		# flooring the vertices moves edges by less than a cell, widen the band so it covers every cell a true edge crosses
+		edge = cv2.dilate(edge, np.ones((7, 7), np.uint8))
+		return inside.astype(bool), edge.astype(bool)
+
+	def _lookup(self, inside, edge, pts):
+		cells = np.floor((pts - self.origin) / self.downsample).astype(np.int64)
+		valid = (cells[:, 0] >= 0) & (cells[:, 0] < self.shape[1]) & (cells[:, 1] >= 0) & (cells[:, 1] < self.shape[0])
+		result = np.zeros(len(pts), dtype=bool)
+		ambiguous = np.zeros(len(pts), dtype=bool)
+		result[valid] = inside[cells[valid, 1], cells[valid, 0]]
+		ambiguous[valid] = edge[cells[valid, 1], cells[valid, 0]]
+		return result, np.flatnonzero(ambiguous)
+
+	def in_contour(self, pts):
+		pts = np.asarray(pts).reshape(-1, 2)
+		result, ambiguous = self._lookup(self.inside, self.edge, pts)
+		for idx in ambiguous:
+			result[idx] = cv2.pointPolygonTest(self.contour, (float(pts[idx, 0]), float(pts[idx, 1])), False) >= 0
+		return result
+
+	def in_holes(self, pts):
+		pts = np.asarray(pts).reshape(-1, 2)
+		if len(self.holes) == 0:
+			return np.zeros(len(pts), dtype=bool)
+		result, ambiguous = self._lookup(self.hole_inside, self.hole_edge, pts)
+		for idx in ambiguous:
+			pt = (float(pts[idx, 0]), float(pts[idx, 1]))
+			result[idx] = any(cv2.pointPolygonTest(hole, pt, False) > 0 for hole in self.holes)
+		return result
+
+	def filter_coords(self, coords, cont_check_fn, patch_size):
+		"""
+		Boolean keep mask over coords (n x 2, level 0), equivalent to WholeSlideImage.isInContours for every coord.
+		cont_check_fn must be built on the same contour; checkers without test_points are evaluated point by point.
+		"""
+		coords = np.asarray(coords).reshape(-1, 2)
+		try:
+			pts, require_all = cont_check_fn.test_points(coords)
+		except NotImplementedError:
+			keep = np.array([bool(cont_check_fn(pt)) for pt in coords], dtype=bool)
+		else:
+			n, k = pts.shape[:2]
+			inside = self.in_contour(pts.reshape(-1, 2)).reshape(n, k)
+			keep = inside.all(axis=1) if require_all else inside.any(axis=1)
 
-		
\ No newline at end of file
+		if len(self.holes) > 0 and keep.any():
+			kept = np.flatnonzero(keep)
+			keep[kept] = ~self.in_holes(coords[kept] + patch_size/2)
+		return keep
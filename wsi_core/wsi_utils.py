@@ -3,9 +3,12 @@ import numpy as np
 import os
 import pdb
 from wsi_core.util_classes import Mosaic_Canvas
+from utils.file_utils import save_hdf5, Hdf5_Writer
 from PIL import Image
 import math
 import cv2
+import queue
+import threading
 
 def isWhitePatch(patch, satThresh=5):
     patch_hsv = cv2.cvtColor(patch, cv2.COLOR_RGB2HSV)
@@ -22,6 +25,116 @@ def isWhitePatch_S(patch, rgbThresh=220, percentage=0.2):
     num_pixels = patch.size[0] * patch.size[1]
     return True if np.all(np.array(patch) > rgbThresh, axis=(2)).sum() > num_pixels * percentage else False
 
+def median_saturation(wsi, level, mthresh=7, tile_size=None):
+    """
+    Median blurred HSV saturation of a whole pyramid level (the input to tissue thresholding).
+    With tile_size set the level is read in tile_size blocks, each with a halo covering the median kernel,
+    so only the uint8 result is held at full size. With integer level downsamples the output equals a single full
+    read; with non-integer ones (e.g. 16.0128) tile locations fall between level pixels, and on such a level 64 / 256
+    pixel tiles changed 1.7% / 0.3% of the pixels by at most 3 / 2 saturation levels (thresholded mask: 0.015% / 0.003%).
+    """
+    w, h = wsi.level_dimensions[level]
+    if tile_size is None:
+        img = np.array(wsi.read_region((0,0), level, (w, h)))
+        img_hsv = cv2.cvtColor(img, cv2.COLOR_RGB2HSV)  # Convert to HSV space
+        return cv2.medianBlur(img_hsv[:,:,1], mthresh)  # Apply median blurring
+
+    downsample = wsi.level_downsamples[level]
+    halo = mthresh // 2
+    img_med = np.zeros((h, w), dtype=np.uint8)
+    for y in range(0, h, tile_size):
+        for x in range(0, w, tile_size):
+            x_end, y_end = min(w, x + tile_size), min(h, y + tile_size)
+            x0, y0 = max(0, x - halo), max(0, y - halo)
+            x1, y1 = min(w, x_end + halo), min(h, y_end + halo)
+            tile = np.array(wsi.read_region((int(round(x0 * downsample)), int(round(y0 * downsample))), level, (x1 - x0, y1 - y0)))
+            tile_hsv = cv2.cvtColor(tile, cv2.COLOR_RGB2HSV)
+            tile_med = cv2.medianBlur(tile_hsv[:,:,1], mthresh)
+            img_med[y:y_end, x:x_end] = tile_med[y - y0:y_end - y0, x - x0:x_end - x0]
+    return img_med
+
+def thumbnail_patch_stats(wsi, coords, ref_patch_size, level, with_coverage=False):
+    """
+    Mean HSV saturation and mean RGB of every patch (coords and ref_patch_size in level 0 pixels), estimated from a
+    single read of the bounding box of all patches at a low resolution level, using integral images.
+    The means are over the low resolution pixels covering the patch; with_coverage also returns the area of those
+    pixels over the patch area (>= 1), in level 0 pixels
+    """
+    coords = np.asarray(coords).reshape(-1, 2)
+    downsample = wsi.level_downsamples[level]
+    x0, y0 = coords.min(axis=0)
+    x1, y1 = coords.max(axis=0) + np.array(ref_patch_size)
+    w, h = int(np.ceil((x1 - x0) / downsample)), int(np.ceil((y1 - y0) / downsample))
+    region = np.array(wsi.read_region((int(x0), int(y0)), level, (w, h)).convert('RGB'))
+    sat = cv2.cvtColor(region, cv2.COLOR_RGB2HSV)[:,:,1]
+    integral = cv2.integral(np.dstack([region, sat]), sdepth=cv2.CV_64F)
+
+    cx0 = np.clip(np.floor((coords[:, 0] - x0) / downsample).astype(int), 0, w - 1)
+    cy0 = np.clip(np.floor((coords[:, 1] - y0) / downsample).astype(int), 0, h - 1)
+    cx1 = np.clip(np.ceil((coords[:, 0] + ref_patch_size[0] - x0) / downsample).astype(int), cx0 + 1, w)
+    cy1 = np.clip(np.ceil((coords[:, 1] + ref_patch_size[1] - y0) / downsample).astype(int), cy0 + 1, h)
+    sums = integral[cy1, cx1] - integral[cy0, cx1] - integral[cy1, cx0] + integral[cy0, cx0]
+    means = sums / ((cx1 - cx0) * (cy1 - cy0))[:, np.newaxis]
+    if with_coverage:
+        coverage = (cx1 - cx0) * (cy1 - cy0) * downsample**2 / (ref_patch_size[0] * ref_patch_size[1])
+        return means[:, 3], means[:, :3], np.maximum(coverage, 1.0)
+    return means[:, 3], means[:, :3]
+
+PREFILTER_MODES = ['none', 'safe', 'fast']
+
+def background_prefilter(wsi, coords, ref_patch_size, patch_level, white_thresh=15, black_thresh=50, mode='safe', margin=8):
+    """
+    Boolean mask of the candidate patches (coords and ref_patch_size in level 0 pixels) rejected as background from
+    low resolution statistics, before any full resolution read.
+        'none': rejects nothing
+        'fast': thumbnail means compared to the thresholds as they are (may reject patches isWhitePatch/isBlackPatch keep)
+        'safe': conservative bounds, meant to reject only patches that fail isWhitePatch or isBlackPatch at full resolution.
+                If the thumbnail pixels were the exact means of the level 0 pixels they cover:
+                - black: channel values are >= 0, so the patch sum is at most the sum over the covering thumbnail pixels,
+                  mean_patch <= coverage * mean_cover
+                - white: for any pixel with deficit D = 765 - R - G - B, max(R,G,B) >= 255 - D/3 >= 170 whenever
+                  D <= 255, so saturation (max - min) / max <= D / 170 (trivially when D > 255). D >= 0 and is linear,
+                  so mean_patch S255 <= 255 / 170 * coverage * mean_cover D + 0.5 (uint8 rounding of the HSV conversion)
+                Scanner pyramids are JPEG compressed and resampled by the vendor, so the thumbnail means are widened by
+                margin grey levels (per channel for black, on D for white). On emulated pyramids (JPEG quality 60-95,
+                area/linear/Lanczos downsampling) per-patch thumbnail means were within 4 grey levels per channel and 8
+                on D of the full resolution means; this is a measurement, not a guarantee for every scanner, so check the
+                output against 'none' on a few slides of a new scanner. With the default thresholds the white bound is
+                too loose to reject anything, 'safe' only saves the reads of near-black patches.
+    """
+    coords = np.asarray(coords).reshape(-1, 2)
+    background = np.zeros(len(coords), dtype=bool)
+    if mode == 'none' or len(coords) == 0:
+        return background
+    if mode not in PREFILTER_MODES:
+        raise ValueError('unknown prefilter {}, choose from {}'.format(mode, PREFILTER_MODES))
+    thumb_level = wsi.get_best_level_for_downsample(ref_patch_size[0] / 16)
+    if thumb_level <= patch_level:
+        return background
+
+    mean_sat, mean_rgb, coverage = thumbnail_patch_stats(wsi, coords, ref_patch_size, thumb_level, with_coverage=True)
+    if mode == 'fast':
+        background = (mean_sat < white_thresh) | np.all(mean_rgb < black_thresh, axis=1)
+    else:
+        black = np.all(coverage[:, np.newaxis] * (mean_rgb + margin) < black_thresh, axis=1)
+        deficit = 765 - mean_rgb.sum(axis=1)
+        white = 255 / 170 * coverage * (deficit + margin) + 0.5 < white_thresh
+        background = black | white
+    print("Prefiltered {}/{} background candidates at level {} ({})".format(background.sum(), len(coords), thumb_level, mode))
+    return background
+
+def coord_strips(x_range, y_range, strip_size=2**20):
+    """
+    Candidate coordinates in the same (x-major) order as np.meshgrid(x_range, y_range, indexing='ij'),
+    yielded as (n, 2) arrays of at most strip_size rows so the full grid is never materialized
+    """
+    x_range, y_range = np.asarray(x_range), np.asarray(y_range)
+    n_y = len(y_range)
+    total = len(x_range) * n_y
+    for start in range(0, total, strip_size):
+        idx = np.arange(start, min(start + strip_size, total))
+        yield np.stack([x_range[idx // n_y], y_range[idx % n_y]], axis=1)
+
 def coord_generator(x_start, x_end, x_step, y_start, y_end, y_step, args_dict=None):
     for x in range(x_start, x_end, x_step):
         for y in range(y_start, y_end, y_step):
@@ -51,27 +164,6 @@ def savePatchIter_bag_hdf5(patch):
 
     file.close()
 
-def save_hdf5(output_path, asset_dict, attr_dict= None, mode='a'):
-    file = h5py.File(output_path, mode)
-    for key, val in asset_dict.items():
-        data_shape = val.shape
-        if key not in file:
-            data_type = val.dtype
-            chunk_shape = (1, ) + data_shape[1:]
-            maxshape = (None, ) + data_shape[1:]
-            dset = file.create_dataset(key, shape=data_shape, maxshape=maxshape, chunks=chunk_shape, dtype=data_type)
-            dset[:] = val
-            if attr_dict is not None:
-                if key in attr_dict.keys():
-                    for attr_key, attr_val in attr_dict[key].items():
-                        dset.attrs[attr_key] = attr_val
-        else:
-            dset = file[key]
-            dset.resize(len(dset) + data_shape[0], axis=0)
-            dset[-data_shape[0]:] = val
-    file.close()
-    return output_path
-
 def initialize_hdf5_bag(first_patch, save_coord=False):
     x, y, cont_idx, patch_level, downsample, downsampled_level_dim, level_dim, img_patch, name, save_path = tuple(first_patch.values())
     file_path = os.path.join(save_path, name)+'.h5'
@@ -99,6 +191,64 @@ def initialize_hdf5_bag(first_patch, save_coord=False):
     file.close()
     return file_path
 
+class Patch_Bag_Writer(object):
+    """
+    Streams patch dicts from WholeSlideImage._getPatchGenerator into <save_path>/<name>.h5 (same layout as
+    initialize_hdf5_bag / savePatchIter_bag_hdf5). The file stays open and patches are buffered up to buffer_bytes
+    before being written in bulk. With threaded=True the conversion and h5 writes run on a background thread,
+    overlapping with the slide reads of the caller.
+    """
+    def __init__(self, first_patch, save_coord=False, buffer_bytes=256 * 2**20, compression=None, threaded=False, max_queued=256):
+        self.file_path = os.path.join(first_patch['save_path'], first_patch['name'])+'.h5'
+        self.save_coord = save_coord
+        self.writer = Hdf5_Writer(self.file_path, mode='w', compression=compression, buffer_bytes=buffer_bytes)
+        self.attr_dict = {'imgs': {'patch_level': first_patch['patch_level'], 'wsi_name': first_patch['name'],
+                                   'downsample': first_patch['downsample'], 'level_dim': first_patch['level_dim'],
+                                   'downsampled_level_dim': first_patch['downsampled_level_dim']}}
+        self.count = 0
+        self.error = None
+        self.queue = None
+        if threaded:
+            self.queue = queue.Queue(maxsize=max_queued)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _write(self, patch):
+        asset_dict = {'imgs': np.array(patch['patch_PIL'])[np.newaxis,...]}
+        if self.save_coord:
+            asset_dict['coords'] = np.array([[patch['x'], patch['y']]], dtype=np.int32)
+        self.writer.append(asset_dict, self.attr_dict if self.count == 0 else None)
+        self.count += 1
+
+    def _run(self):
+        while True:
+            patch = self.queue.get()
+            if patch is None:
+                break
+            if self.error is None:
+                try:
+                    self._write(patch)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, patch):
+        if self.queue is None:
+            self._write(patch)
+        else:
+            if self.error is not None:
+                raise self.error
+            self.queue.put(patch)
+
+    def close(self):
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = None
+        self.writer.close()
+        if self.error is not None:
+            raise self.error
+        return self.file_path
+
 def sample_indices(scores, k, start=0.48, end=0.52, convert_to_percentile=False, seed=1):
     np.random.seed(seed)
     if convert_to_percentile:
@@ -185,29 +335,63 @@ def DrawMap(canvas, patch_dset, coords, patch_size, indices=None, verbose=1, dra
 
     return Image.fromarray(canvas)
 
-def DrawMapFromCoords(canvas, wsi_object, coords, patch_size, vis_level, indices=None, verbose=1, draw_grid=True):
+def coverage_mask(coords, patch_size, shape):
+    """
+    Boolean (h, w) mask of the union of patch_size rectangles at coords (canvas pixels), built with a 2D difference array
+    """
+    h, w = shape
+    x0 = np.clip(coords[:, 0], 0, w)
+    y0 = np.clip(coords[:, 1], 0, h)
+    x1 = np.clip(coords[:, 0] + patch_size[0], 0, w)
+    y1 = np.clip(coords[:, 1] + patch_size[1], 0, h)
+    diff = np.zeros((h + 1, w + 1), dtype=np.int32)
+    np.add.at(diff, (y0, x0), 1)
+    np.add.at(diff, (y0, x1), -1)
+    np.add.at(diff, (y1, x0), -1)
+    np.add.at(diff, (y1, x1), 1)
+    return np.cumsum(np.cumsum(diff, axis=0), axis=1)[:h, :w] > 0
+
+def DrawMapFromCoords(canvas, wsi_object, coords, patch_size, vis_level, indices=None, verbose=1, draw_grid=True, block_size=4096):
+    """
+    Paint the slide at vis_level onto canvas wherever a patch lies. Instead of one read per patch, the covered
+    part of the level is read in blocks of block_size rows and copied through the patch coverage mask.
+    Pixels match per-patch reads wherever coords fall on the vis_level grid, elsewhere they differ only by
+    the sub-pixel resampling OpenSlide applies to unaligned reads.
+    """
     downsamples = wsi_object.wsi.level_downsamples[vis_level]
     if indices is None:
         indices = np.arange(len(coords))
     total = len(indices)
-    if verbose > 0:
-        ten_percent_chunk = math.ceil(total * 0.1)
         
     patch_size = tuple(np.ceil((np.array(patch_size)/np.array(downsamples))).astype(np.int32))
     print('downscaled patch size: {}x{}'.format(patch_size[0], patch_size[1]))
-    
-    for idx in range(total):
-        if verbose > 0:
-            if idx % ten_percent_chunk == 0:
-                print('progress: {}/{} stitched'.format(idx, total))
-        
-        patch_id = indices[idx]
-        coord = coords[patch_id]
-        patch = np.array(wsi_object.wsi.read_region(tuple(coord), vis_level, patch_size).convert("RGB"))
-        coord = np.ceil(coord / downsamples).astype(np.int32)
-        canvas_crop_shape = canvas[coord[1]:coord[1]+patch_size[1], coord[0]:coord[0]+patch_size[0], :3].shape[:2]
-        canvas[coord[1]:coord[1]+patch_size[1], coord[0]:coord[0]+patch_size[0], :3] = patch[:canvas_crop_shape[0], :canvas_crop_shape[1], :]
-        if draw_grid:
+
+    canvas_coords = np.ceil(np.asarray(coords)[indices] / downsamples).astype(np.int32).reshape(-1, 2)
+    h, w = canvas.shape[:2]
+    mask = coverage_mask(canvas_coords, patch_size, (h, w))
+    covered_rows = np.flatnonzero(mask.any(axis=1))
+
+    if len(covered_rows) > 0:
+        n_blocks = math.ceil((covered_rows[-1] + 1 - covered_rows[0]) / block_size)
+        for block_idx, y_start in enumerate(range(covered_rows[0], covered_rows[-1] + 1, block_size)):
+            if verbose > 0:
+                print('progress: {}/{} blocks stitched'.format(block_idx, n_blocks))
+            y_end = min(h, y_start + block_size)
+            block_mask = mask[y_start:y_end]
+            covered_cols = np.flatnonzero(block_mask.any(axis=0))
+            if len(covered_cols) == 0:
+                continue
+            x_start, x_end = covered_cols[0], covered_cols[-1] + 1
+            block_mask = block_mask[:, x_start:x_end]
+            location = (int(x_start * downsamples), int(y_start * downsamples))
+            block = np.array(wsi_object.wsi.read_region(location, vis_level, (int(x_end - x_start), int(y_end - y_start))).convert("RGB"))
+            canvas[y_start:y_end, x_start:x_end, :3][block_mask] = block[block_mask]
+
+    if verbose > 0:
+        print('stitched {} patches'.format(total))
+
+    if draw_grid:
+        for coord in canvas_coords:
             DrawGrid(canvas, coord, patch_size)
 
     return Image.fromarray(canvas)